@@ -0,0 +1,373 @@
+# app_directory.py
+import json
+import re
+import threading
+import time
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import APP_ALIASES_PATH, APP_DICTIONARY_REFRESH_SECONDS, APP_DIRECTORY_CACHE_TTL_SECONDS
+from db import get_pool, get_async_pool, table_watermark
+from schemas import ApplicationRecord, Person
+from metrics import retrieval_timer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+APP_KB_TABLE = "app_kb"
+
+# Column order of the source sheet behind app_kb (the same order the application agent prompt describes)
+APP_KB_COLUMNS = ["Application Name", "Application full name", "Tech Lead", "Assistant tech lead", "IT Owner", "Country", "Platform"]
+ALIAS_KEYS = ["Aliases", "Alias", "Also known as"]
+
+
+def _normalize_key(key: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", key.lower())
+
+
+_COLUMN_BY_KEY = {_normalize_key(c): c for c in APP_KB_COLUMNS + ALIAS_KEYS}
+
+
+def parse_app_row(content: str, metadata: Optional[dict]) -> Dict[str, str]:
+    """
+    Reads the app_kb columns of one row. Values in metadata win; otherwise the
+    'Column: value' lines of the row's content are used. Missing columns are absent.
+    """
+    row = {}
+    for line in (content or "").splitlines():
+        key, sep, value = line.partition(":")
+        column = _COLUMN_BY_KEY.get(_normalize_key(key)) if sep else None
+        if column and value.strip():
+            row[column] = value.strip()
+    for key, value in (metadata or {}).items():
+        column = _COLUMN_BY_KEY.get(_normalize_key(str(key)))
+        if column and value not in (None, ""):
+            row[column] = ", ".join(map(str, value)) if isinstance(value, list) else str(value).strip()
+    return row
+
+
+def _row_aliases(row: Dict[str, str]) -> List[str]:
+    aliases = []
+    for key in ALIAS_KEYS:
+        if row.get(key):
+            aliases.extend(a.strip() for a in re.split(r"[,;|]", row[key]) if a.strip())
+    return aliases
+
+
+def _load_alias_file() -> Dict[str, str]:
+    """Optional JSON file of extra {alias: application name} pairs (e.g. "Maybank2u": "M2U")."""
+    if not APP_ALIASES_PATH:
+        return {}
+    try:
+        with open(APP_ALIASES_PATH, encoding="utf-8") as f:
+            return {str(k): str(v) for k, v in json.load(f).items()}
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not read application aliases from {APP_ALIASES_PATH}: {e}")
+        return {}
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    Compiles words into one regex alternation shaped like a trie, so matching cost
+    depends on the text length rather than on the number of applications.
+    """
+    trie: dict = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node) -> str:
+        if list(node) == [""]:
+            return ""
+        optional = "" in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{pattern})?" if optional else pattern
+
+    return build(trie)
+
+
+def _is_acronym(surface: str) -> bool:
+    # Short all-caps names like MAE or M2U must match case-sensitively ("mae" is not MAE)
+    return len(surface) <= 5 and surface.upper() == surface
+
+
+class ApplicationMatcher:
+    """Finds known application names and aliases in text and maps them to their canonical names."""
+
+    def __init__(self, surface_to_canonical: Dict[str, str]):
+        self._exact = {}
+        self._folded = {}
+        for surface, canonical in surface_to_canonical.items():
+            surface = " ".join(surface.split())
+            if not surface:
+                continue
+            if _is_acronym(surface):
+                self._exact[surface] = canonical
+            else:
+                self._folded[surface.casefold()] = canonical
+        boundary_start, boundary_end = r"(?<![A-Za-z0-9])", r"(?![A-Za-z0-9])"
+        self._exact_re = re.compile(boundary_start + "(" + _trie_pattern(self._exact) + ")" + boundary_end) if self._exact else None
+        self._folded_re = (re.compile(boundary_start + "(" + _trie_pattern(self._folded) + ")" + boundary_end, re.IGNORECASE)
+                           if self._folded else None)
+
+    def __len__(self):
+        return len(self._exact) + len(self._folded)
+
+    def canonical(self, name: str) -> Optional[str]:
+        """Canonical application name for a name or alias, if known."""
+        name = " ".join((name or "").split())
+        return self._exact.get(name) or self._folded.get(name.casefold())
+
+    def find(self, text: str) -> List[str]:
+        """Canonical names of every application mentioned, unique, in order of first mention."""
+        text = " ".join((text or "").split())
+        hits: List[Tuple[int, str]] = []
+        if self._exact_re is not None:
+            hits.extend((m.start(), self._exact[m.group(1)]) for m in self._exact_re.finditer(text))
+        if self._folded_re is not None:
+            hits.extend((m.start(), self._folded[m.group(1).casefold()]) for m in self._folded_re.finditer(text))
+        seen, found = set(), []
+        for _, canonical in sorted(hits):
+            if canonical not in seen:
+                seen.add(canonical)
+                found.append(canonical)
+        return found
+
+
+def build_matcher(rows: Iterable[Tuple[str, Optional[dict]]], extra_aliases: Optional[Dict[str, str]] = None) -> ApplicationMatcher:
+    """Builds a matcher from app_kb (content, metadata) rows plus alias pairs."""
+    surfaces: Dict[str, str] = {}
+    for content, metadata in rows:
+        row = parse_app_row(content, metadata)
+        name = row.get("Application Name")
+        if not name:
+            continue
+        surfaces[name] = name
+        if row.get("Application full name"):
+            surfaces.setdefault(row["Application full name"], name)
+        for alias in _row_aliases(row):
+            surfaces.setdefault(alias, name)
+    for alias, name in (extra_aliases or {}).items():
+        surfaces.setdefault(alias, name)
+    return ApplicationMatcher(surfaces)
+
+
+class ApplicationDictionary:
+    """
+    Process-wide matcher over app_kb. It is rebuilt when the table's watermark
+    changes, checked at most every APP_DICTIONARY_REFRESH_SECONDS.
+    """
+
+    def __init__(self):
+        self._matcher: Optional[ApplicationMatcher] = None
+        self._watermark = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def load_rows(self, rows: Iterable[Tuple[str, Optional[dict]]], watermark=None):
+        """Installs a matcher built from the given rows (used by refresh() and by offline tooling)."""
+        matcher = build_matcher(rows, _load_alias_file())
+        with self._lock:
+            self._matcher = matcher
+            self._watermark = watermark
+            self._checked_at = time.monotonic()
+        logger.info(f"Application dictionary built with {len(matcher)} names and aliases")
+
+    @property
+    def loaded(self) -> bool:
+        return self._matcher is not None
+
+    def is_due(self) -> bool:
+        return self._matcher is None or time.monotonic() - self._checked_at > APP_DICTIONARY_REFRESH_SECONDS
+
+    def refresh(self):
+        """Rebuilds the matcher if app_kb changed. Failures keep the previous matcher."""
+        try:
+            with get_pool().connection() as conn:
+                watermark = table_watermark(conn, APP_KB_TABLE)
+                if self._matcher is not None and watermark == self._watermark:
+                    self._checked_at = time.monotonic()
+                    return
+                with conn.cursor() as cur:
+                    cur.execute(f"SELECT content, metadata FROM {APP_KB_TABLE}")
+                    rows = cur.fetchall()
+            self.load_rows(rows, watermark)
+        except Exception as e:
+            logger.error(f"Refreshing the application dictionary failed: {e}", exc_info=True)
+            # Don't hammer the database on every request while it is unavailable
+            self._checked_at = time.monotonic()
+
+    def find(self, text: str) -> List[str]:
+        matcher = self._matcher
+        return matcher.find(text) if matcher is not None else []
+
+    def canonical(self, name: str) -> str:
+        matcher = self._matcher
+        return (matcher.canonical(name) if matcher is not None else None) or name
+
+    def stats(self) -> dict:
+        return {"names": len(self._matcher) if self._matcher is not None else 0, "watermark": self._watermark}
+
+
+APP_DICTIONARY = ApplicationDictionary()
+
+
+# --- Keyed ownership lookup ---
+
+NAME_INDEX_SQL = f"CREATE INDEX IF NOT EXISTS {APP_KB_TABLE}_application_name_idx ON {APP_KB_TABLE} (lower(metadata->>'Application Name'))"
+# Same expression as the index above, so this is an index scan for any number of names. The
+# names are lowered by Postgres too: Python's casefold()/lower() differ from lower() on
+# non-ASCII names (casefold("ß") is "ss"), which would silently miss their rows
+LOOKUP_SQL = (f"SELECT content, metadata FROM {APP_KB_TABLE} WHERE lower(metadata->>'Application Name') "
+              f"= ANY(ARRAY(SELECT lower(name) FROM unnest(%s::text[]) AS name))")
+
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+
+
+def parse_person(value: Optional[str]) -> Person:
+    """'Aisha Rahman <aisha.r@example.com>' / 'Aisha Rahman (aisha.r@...)' / 'Aisha Rahman' -> Person."""
+    if not value:
+        return Person()
+    email = _EMAIL_RE.search(value)
+    name = _EMAIL_RE.sub("", value).strip(" <>()[],;-")
+    return Person(name=name or "Not Found", email=email.group(0) if email else "Not Found")
+
+
+def record_from_row(system_name: str, content: str, metadata: Optional[dict]) -> ApplicationRecord:
+    row = parse_app_row(content, metadata)
+    return ApplicationRecord(
+        system_name=system_name,
+        tech_lead=parse_person(row.get("Tech Lead")),
+        it_owner=parse_person(row.get("IT Owner")),
+        regional_availability=row.get("Country") or "Not Found",
+        platform=row.get("Platform") or "Not Found",
+    )
+
+
+def not_found_record(system_name: str) -> ApplicationRecord:
+    # Mirrors the "NonExistentSystem" entry of the application agent prompt
+    na = Person(name="N/A", email="N/A")
+    return ApplicationRecord(system_name=system_name, status="Not found in vector store", tech_lead=na, it_owner=na,
+                             regional_availability="N/A", platform="N/A")
+
+
+def ensure_name_index():
+    """Creates the expression index behind LOOKUP_SQL (idempotent)."""
+    with get_pool().connection() as conn:
+        conn.execute(NAME_INDEX_SQL)
+    logger.info(f"Ensured application name index on {APP_KB_TABLE}")
+
+
+class ApplicationDirectory:
+    """
+    Exact, case-insensitive lookup of application ownership records by name or
+    alias: one batched indexed query for all names, behind a per-process TTL cache
+    (negative results are cached too). Names with no row are returned as missing
+    so the caller can fall back to vector search.
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._cache: Dict[str, Tuple[float, Optional[Tuple[str, dict]]]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    def _split(self, names: List[str]):
+        """Returns ({name: cached row or None}, [names to query])."""
+        cached, to_query = {}, []
+        now = time.monotonic()
+        with self._lock:
+            for name in names:
+                entry = self._cache.get(name.casefold())
+                if entry is not None and entry[0] > now:
+                    cached[name] = entry[1]
+                    self.hits += 1
+                else:
+                    to_query.append(name)
+                    self.misses += 1
+        return cached, to_query
+
+    def _remember(self, names: List[str], rows) -> Dict[str, Optional[Tuple[str, dict]]]:
+        by_name = {}
+        for content, metadata in rows:
+            name = parse_app_row(content, metadata).get("Application Name")
+            if name:
+                by_name.setdefault(name.casefold(), (content, metadata))
+        expires = time.monotonic() + self.ttl_seconds
+        found = {}
+        with self._lock:
+            for name in names:
+                row = by_name.get(name.casefold())
+                self._cache[name.casefold()] = (expires, row)
+                found[name] = row
+        return found
+
+    def load_rows(self, rows: Iterable[Tuple[str, Optional[dict]]]):
+        """Caches every named row up front (offline tooling; avoids the query for these names)."""
+        rows = list(rows)
+        names = [n for n in (parse_app_row(c, m).get("Application Name") for c, m in rows) if n]
+        self._remember(names, rows)
+
+    def _records(self, names: List[str], rows_by_name) -> Tuple[List[ApplicationRecord], List[str]]:
+        records, missing = [], []
+        for name in names:
+            row = rows_by_name.get(name)
+            if row is None:
+                missing.append(name)
+            else:
+                records.append(record_from_row(name, *row))
+        return records, missing
+
+    def lookup(self, names: List[str]) -> Tuple[List[ApplicationRecord], List[str]]:
+        """Returns (records found, names with no app_kb row). Aliases resolve to canonical names first."""
+        names = list(dict.fromkeys(APP_DICTIONARY.canonical(n) for n in names))
+        rows_by_name, to_query = self._split(names)
+        if to_query:
+            self.queries += 1
+            try:
+                with retrieval_timer(APP_KB_TABLE, "directory"), get_pool().connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(LOOKUP_SQL, (to_query,), prepare=True)
+                        rows_by_name.update(self._remember(to_query, cur.fetchall()))
+            except Exception as e:
+                # Not cached: the names are reported missing and go to vector search this time only
+                logger.error(f"Application directory lookup failed: {e}")
+        return self._records(names, rows_by_name)
+
+    async def alookup(self, names: List[str]) -> Tuple[List[ApplicationRecord], List[str]]:
+        names = list(dict.fromkeys(APP_DICTIONARY.canonical(n) for n in names))
+        rows_by_name, to_query = self._split(names)
+        if to_query:
+            self.queries += 1
+            try:
+                with retrieval_timer(APP_KB_TABLE, "directory"):
+                    pool = await get_async_pool()
+                    async with pool.connection() as conn:
+                        async with conn.cursor() as cur:
+                            await cur.execute(LOOKUP_SQL, (to_query,), prepare=True)
+                            rows_by_name.update(self._remember(to_query, await cur.fetchall()))
+            except Exception as e:
+                logger.error(f"Application directory lookup failed: {e}")
+        return self._records(names, rows_by_name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "queries": self.queries, "cached_names": len(self._cache)}
+
+
+APP_DIRECTORY = ApplicationDirectory(APP_DIRECTORY_CACHE_TTL_SECONDS)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Application directory maintenance.")
+    parser.add_argument("--create-index", action="store_true", help="create the name index used by the keyed lookup")
+    args = parser.parse_args()
+    if args.create_index:
+        logging.basicConfig(level=logging.INFO)
+        ensure_name_index()
@@ -1,48 +1,182 @@
 # backend/main.py
-from fastapi import FastAPI, Request, status # Import Request and status
-from fastapi.responses import JSONResponse # Import JSONResponse
-from pydantic import BaseModel
-from graph import app as langgraph_app # Import your compiled LangGraph app
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, FastAPI, Request, Response, status # Import Request and status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse # Import JSONResponse
+from pydantic import BaseModel, ValidationError
+from typing import Any, Dict, List, Optional
+from checkpoints import GraphRunError, RunDeadlineExceeded, ainvoke_run, run_status, resume_run, aclose_checkpointer, checkpoint_stats
+import asyncio
+import json
+import uuid
+from config import (
+    get_embeddings_model, SINGLEFLIGHT_WAIT_TIMEOUT_SECONDS, SINGLEFLIGHT_ADVISORY_LOCK,
+    STREAM_HEARTBEAT_SECONDS, BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY, OTEL_EXPORTER_OTLP_ENDPOINT, OTEL_SERVICE_NAME,
+    JOB_WORKERS, REQUEST_DEADLINE_SECONDS,
+)
+from deadlines import request_deadline
+from hedging import hedge_stats
+from db import aclose_pools, pool_stats
+from vector_index import stop_refresher, index_stats
+from result_cache import result_cache, cache_key
+from semantic_cache import semantic_cache, semantic_cache_bypass
+from singleflight import SingleFlight, advisory_lock
+from streaming import analysis_events, with_heartbeat, encode_sse, encode_ndjson
+from batch import analyze_batch, parse_jsonl
+from app_directory import APP_DICTIONARY, APP_DIRECTORY
+from llm_scheduler import scheduler_stats
+from model_registry import MODEL_REGISTRY
+from jobs import QueueFull, job_queue, job_workers, job_stats
+from metrics import (
+    HTTP_IN_FLIGHT, HTTP_SECONDS, GRAPH_RUNS_IN_FLIGHT, STARTUP_SECONDS, configure_tracing, metrics_payload, register_stats_source,
+)
+from startup import readiness, warm_up
 import logging
 
 # Configure basic logging to capture console output
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize the FastAPI app
-api = FastAPI(
-    title="Demand Analysis Agent API",
-    description="An API for interacting with the LangGraph classification agent.",
-    version="1.0.0"
-)
+# Routes are collected on a router; create_app() builds the FastAPI app around it
+router = APIRouter()
 
 # Define the request body model
 class AnalysisRequest(BaseModel):
     raw_input: str
+    bypass_cache: bool = False # force a fresh run (the new result still replaces the cached one)
 
-# Add the middleware (from previous suggestion, helpful for general debugging)
-@api.middleware("http")
+class BatchAnalysisRequest(BaseModel):
+    raw_inputs: List[str]
+    concurrency: Optional[int] = None # defaults to BATCH_CONCURRENCY, capped at BATCH_MAX_CONCURRENCY
+    bypass_cache: bool = False
+
+# Request logging and HTTP metrics (installed by create_app)
 async def log_requests(request: Request, call_next):
     logging.info(f"Incoming Request: {request.method} {request.url}")
     # logging.info(f"Headers: {request.headers}") # Can be very verbose, enable if needed
+    # Raw paths only for our own routes, so unknown URLs cannot blow up the label set
+    path = request.url.path if request.url.path in _ROUTE_PATHS else "other"
+    start = time.perf_counter()
+    status_code = 500
+    HTTP_IN_FLIGHT.labels(path).inc()
     try:
         response = await call_next(request)
+        status_code = response.status_code
         logging.info(f"Outgoing Response Status: {response.status_code}")
         return response
     except Exception as e:
         logging.error(f"Request processing error: {e}", exc_info=True)
         raise # Re-raise the exception after logging
+    finally:
+        HTTP_IN_FLIGHT.labels(path).dec()
+        HTTP_SECONDS.labels(path, str(status_code)).observe(time.perf_counter() - start)
+
+# Identical demands arriving while one is already running share that run
+inflight_runs = SingleFlight()
+
+async def _invoke_graph(raw_input: str, key: str, extracted_info: Optional[Dict[str, Any]] = None):
+    inputs = {"raw_input": raw_input}
+    if extracted_info:
+        # Extraction already done (batched) upstream; the node skips it
+        inputs["extracted_info"] = extracted_info
+    logging.info("Attempting to invoke LangGraph app...")
+    # ainvoke keeps the event loop free while the LLM/DB calls are in flight,
+    # so a worker is not limited by the size of the threadpool
+    # Every node is checkpointed under run_id, so a failed run can be resumed (checkpoints.py)
+    with GRAPH_RUNS_IN_FLIGHT.track_inprogress():
+        final_state, run_id = await ainvoke_run(inputs)
+    logging.info("LangGraph app invoked successfully.")
+
+    if result_cache is not None:
+        await result_cache.set(key, final_state)
+    return final_state, False, run_id
+
+async def _run_once(raw_input: str, key: str, check_cache: bool, extracted_info: Optional[Dict[str, Any]] = None):
+    if not SINGLEFLIGHT_ADVISORY_LOCK:
+        return await _invoke_graph(raw_input, key, extracted_info)
+    # Another worker may be running the same demand: wait for its lock, then
+    # pick its result up from the shared cache instead of running again
+    async with advisory_lock(key, timeout=SINGLEFLIGHT_WAIT_TIMEOUT_SECONDS):
+        if check_cache and result_cache is not None:
+            cached_state = await result_cache.get(key)
+            if cached_state is not None:
+                logging.info("Result produced by another worker while waiting, skipping LangGraph invocation.")
+                return cached_state, True, None
+        return await _invoke_graph(raw_input, key, extracted_info)
+
+async def run_analysis(raw_input: str, bypass_cache: bool = False, extracted_info: Optional[Dict[str, Any]] = None):
+    """
+    Runs the graph for one demand, going through the result cache. Returns
+    (final_state, cache_hit, run_id); run_id is None for cached results.
+    """
+    key = await cache_key(raw_input)
+    if result_cache is not None and not bypass_cache:
+        cached_state = await result_cache.get(key)
+        if cached_state is not None:
+            logging.info("Result cache hit, skipping LangGraph invocation.")
+            return cached_state, True, None
+
+    # Bypassing requests get their own flight so they never receive a run that started from cache
+    flight_key = f"{key}:fresh" if bypass_cache else key
+    # A bypassing run also ignores near-duplicate demands (semantic_cache.py)
+    with semantic_cache_bypass(bypass_cache):
+        final_state, cache_hit, run_id = await inflight_runs.do(
+            flight_key,
+            lambda: _run_once(raw_input, key, check_cache=not bypass_cache, extracted_info=extracted_info),
+            wait_timeout=SINGLEFLIGHT_WAIT_TIMEOUT_SECONDS,
+        )
+    # Coalesced callers share one result object; hand each its own copy
+    return dict(final_state), cache_hit, run_id
+
+def _run_error_response(error_message: str, run_id: Optional[str]) -> JSONResponse:
+    content = {"error": error_message}
+    if run_id:
+        # The nodes that completed are checkpointed: resuming re-runs only the rest
+        content["run_id"] = run_id
+        content["resume_url"] = f"/runs/{run_id}/resume"
+    return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=content)
+
+def _partial_response(e: RunDeadlineExceeded) -> JSONResponse:
+    # What the completed nodes produced; the run stays resumable for the rest
+    content = {**jsonable_encoder(e.partial_state), "partial": True, "completed_nodes": e.completed_nodes, "error": str(e)}
+    headers = {"X-Cache": "MISS", "X-Partial": "true"}
+    if e.run_id:
+        content["run_id"] = e.run_id
+        content["resume_url"] = f"/runs/{e.run_id}/resume"
+        headers["X-Run-Id"] = e.run_id
+    return JSONResponse(status_code=status.HTTP_200_OK, content=content, headers=headers)
 
-@api.post("/analyze")
-def analyze_demand(request: AnalysisRequest):
+@router.post("/analyze")
+async def analyze_demand(request: AnalysisRequest, response: Response):
     logging.info(f"Inside /analyze endpoint. Raw input length: {len(request.raw_input)}")
     logging.info(f"Raw input starts with: '{request.raw_input[:50]}'") # Log first 50 chars
 
     try:
-        inputs = {"raw_input": request.raw_input}
-        logging.info("Attempting to invoke LangGraph app...")
-        final_state = langgraph_app.invoke(inputs)
-        logging.info("LangGraph app invoked successfully.")
+        # The deadline covers the whole run, including waiting on an identical in-flight one
+        with request_deadline(REQUEST_DEADLINE_SECONDS):
+            final_state, cache_hit, run_id = await run_analysis(request.raw_input, bypass_cache=request.bypass_cache)
+        response.headers["X-Cache"] = "HIT" if cache_hit else "MISS"
+        if final_state.get("semantic_cache"):
+            response.headers["X-Semantic-Cache"] = "HIT" if final_state["semantic_cache"]["hit"] else "MISS"
+        if run_id:
+            response.headers["X-Run-Id"] = run_id
         return final_state
+    except asyncio.TimeoutError:
+        # Only coalesced requests time out: the run they were waiting on is still going
+        logging.warning("Timed out waiting for an identical in-flight analysis.")
+        return JSONResponse(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            content={"error": "Timed out waiting for an identical analysis that is already running."}
+        )
+    except RunDeadlineExceeded as e:
+        logging.warning(f"Returning a partial result: {e} (completed: {e.completed_nodes})")
+        return _partial_response(e)
+    except GraphRunError as e:
+        error_message = f"Error during LangGraph invocation: {str(e)}"
+        logging.error(error_message, exc_info=True)
+        return _run_error_response(error_message, e.run_id)
     except Exception as e:
         error_message = f"Error during LangGraph invocation: {str(e)}"
         logging.error(error_message, exc_info=True) # Log exception with traceback
@@ -53,7 +187,232 @@ def analyze_demand(request: AnalysisRequest):
             content={"error": error_message} # Provide the error message as JSON content
         )
 
-@api.get("/")
+@router.post("/analyze/stream")
+async def analyze_demand_stream(request: AnalysisRequest, format: str = "sse"):
+    """
+    Streaming variant of /analyze: node results as they complete, then the report
+    token by token. format=sse (text/event-stream) or format=ndjson (one JSON object per line).
+    """
+    logging.info(f"Inside /analyze/stream endpoint. Raw input length: {len(request.raw_input)}")
+    key = await cache_key(request.raw_input)
+    cached_state = None
+    if result_cache is not None and not request.bypass_cache:
+        cached_state = await result_cache.get(key)
+
+    encode = encode_ndjson if format == "ndjson" else encode_sse
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/event-stream"
+
+    async def body():
+        async for event in with_heartbeat(analysis_events(request.raw_input, cached_state, request.bypass_cache), STREAM_HEARTBEAT_SECONDS):
+            if event is not None and event["event"] == "done" and not event["cached"] and result_cache is not None:
+                await result_cache.set(key, event["data"])
+            yield encode(event)
+
+    return StreamingResponse(
+        body(),
+        media_type=media_type,
+        # Stop nginx-style proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": "HIT" if cached_state else "MISS"},
+    )
+
+async def _cached_result(raw_input: str):
+    return await result_cache.get(await cache_key(raw_input))
+
+@router.post("/analyze/batch")
+async def analyze_demand_batch(request: Request):
+    """
+    Analyzes a list of demands, streaming one NDJSON line per item as it completes.
+    Accepts either a JSON body ({"raw_inputs": [...], "concurrency": n, "bypass_cache": false})
+    or a multipart upload with a JSONL 'file' (one string or {"raw_input": ...} per line).
+    """
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None:
+                raise ValueError("Multipart batch requests need a JSONL 'file' field.")
+            batch_request = BatchAnalysisRequest(
+                raw_inputs=parse_jsonl((await upload.read()).decode("utf-8")),
+                concurrency=form.get("concurrency"),
+                bypass_cache=form.get("bypass_cache", "false"),
+            )
+        else:
+            batch_request = BatchAnalysisRequest.model_validate(await request.json())
+    except (ValueError, ValidationError) as e:
+        return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content={"error": f"Invalid batch request: {str(e)}"})
+
+    concurrency = max(1, min(batch_request.concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    logging.info(f"Inside /analyze/batch endpoint. {len(batch_request.raw_inputs)} demands, concurrency {concurrency}")
+
+    async def run_item(raw_input, extracted_info):
+        final_state, _, _ = await run_analysis(raw_input, bypass_cache=batch_request.bypass_cache, extracted_info=extracted_info)
+        return final_state
+
+    use_cache = result_cache is not None and not batch_request.bypass_cache
+
+    async def body():
+        async for item in analyze_batch(
+            batch_request.raw_inputs,
+            concurrency=concurrency,
+            run_item=run_item,
+            lookup_cached=_cached_result if use_cache else None,
+        ):
+            yield json.dumps(item, default=str) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# Cache and connection counters for this worker, served as JSON on /stats and as gauges on /metrics
+STATS_SOURCES = {
+    "embedding_cache": lambda: get_embeddings_model().stats(),
+    "result_cache": lambda: result_cache.stats() if result_cache is not None else None,
+    "semantic_cache": lambda: semantic_cache.stats() if semantic_cache is not None else None,
+    "singleflight": inflight_runs.stats,
+    "db_pool": pool_stats,
+    "vector_index": index_stats,
+    "app_dictionary": APP_DICTIONARY.stats,
+    "app_directory": APP_DIRECTORY.stats,
+    "llm_scheduler": scheduler_stats,
+    "models": MODEL_REGISTRY.describe,
+    "hedging": hedge_stats,
+    "checkpoints": checkpoint_stats,
+    "jobs": job_stats,
+}
+for _component, _source in STATS_SOURCES.items():
+    register_stats_source(_component, _source)
+
+async def _resume_once(run_id: str):
+    final_state = await resume_run(run_id)
+    if result_cache is not None:
+        await result_cache.set(await cache_key(final_state["raw_input"]), final_state)
+    return final_state
+
+@router.get("/runs/{run_id}")
+async def read_run(run_id: str):
+    """State of a failed run kept for resuming: the nodes still pending and their errors."""
+    run = await run_status(run_id)
+    if run is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"error": f"No resumable run '{run_id}'."})
+    return run
+
+@router.post("/runs/{run_id}/resume")
+async def resume_analysis(run_id: str, response: Response):
+    """Finishes a failed run from its checkpoints, re-running only the nodes that did not complete."""
+    logging.info(f"Inside /runs/{run_id}/resume endpoint.")
+    try:
+        # Concurrent resumes of one run share a single execution
+        final_state = await inflight_runs.do(f"resume:{run_id}", lambda: _resume_once(run_id),
+                                             wait_timeout=SINGLEFLIGHT_WAIT_TIMEOUT_SECONDS)
+    except KeyError:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"error": f"No resumable run '{run_id}'."})
+    except asyncio.TimeoutError:
+        return JSONResponse(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            content={"error": "Timed out waiting for a resume of this run that is already running."}
+        )
+    except GraphRunError as e:
+        error_message = f"Error during LangGraph invocation: {str(e)}"
+        logging.error(error_message, exc_info=True)
+        return _run_error_response(error_message, e.run_id)
+    response.headers["X-Run-Id"] = run_id
+    return dict(final_state)
+
+async def run_job(job: dict):
+    """Job handler (jobs.py): a retried job resumes the previous attempt's checkpointed run if it still exists."""
+    if job["run_id"]:
+        try:
+            return await _resume_once(job["run_id"]), job["run_id"]
+        except KeyError:
+            logging.info(f"Run {job['run_id']} of job {job['id']} is gone, starting over.")
+    final_state, _, run_id = await run_analysis(job["raw_input"], bypass_cache=job["bypass_cache"])
+    return final_state, run_id
+
+@router.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(request: AnalysisRequest, response: Response):
+    """Queues a demand and returns at once; poll GET /jobs/{job_id} for the result."""
+    logging.info(f"Inside /jobs endpoint. Raw input length: {len(request.raw_input)}")
+    try:
+        job_id = await job_queue.submit(request.raw_input, bypass_cache=request.bypass_cache)
+    except QueueFull as e:
+        # Backpressure: the client should slow down rather than pile more work onto the queue
+        logging.warning(f"Job rejected: {e}")
+        return JSONResponse(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={"Retry-After": "10"},
+            content={"error": f"The job queue is full ({e.depth} jobs waiting). Retry later."},
+        )
+    except Exception as e:
+        logging.error(f"Could not queue job: {e}", exc_info=True)
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"error": f"The job queue is unavailable: {str(e)}"})
+    job_workers.wake()
+    response.headers["Location"] = f"/jobs/{job_id}"
+    return {"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}
+
+@router.get("/jobs/{job_id}")
+async def read_job(job_id: str):
+    """Status of a job: queued (with its queue position), running, succeeded (with the final state) or failed."""
+    try:
+        job_uuid = uuid.UUID(job_id)
+    except ValueError:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"error": f"No job '{job_id}'."})
+    job = await job_queue.get(job_uuid)
+    if job is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"error": f"No job '{job_id}'."})
+    return job
+
+@router.get("/stats")
+def read_stats():
+    return {component: source() for component, source in STATS_SOURCES.items()}
+
+@router.get("/ready")
+def read_ready():
+    # Readiness probe: 503 until this worker's KB caches and connection pool are warm
+    report = readiness.report()
+    return JSONResponse(status_code=status.HTTP_200_OK if report["ready"] else status.HTTP_503_SERVICE_UNAVAILABLE, content=report)
+
+@router.get("/metrics")
+def read_metrics():
+    body, content_type = metrics_payload()
+    return Response(content=body, media_type=content_type)
+
+@router.get("/")
 def read_root():
     logging.info("GET / endpoint accessed.")
     return {"status": "Demand Analysis Agent API is running"}
+
+_ROUTE_PATHS = {route.path for route in router.routes}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_tracing(OTEL_EXPORTER_OTLP_ENDPOINT, OTEL_SERVICE_NAME)
+    # Warm-up runs in the background: the worker answers liveness probes right away
+    # and /ready turns 200 once the caches and pool are warm
+    warm_up_task = asyncio.create_task(warm_up())
+    if JOB_WORKERS:
+        job_workers.start(JOB_WORKERS, run_job)
+    yield
+    warm_up_task.cancel()
+    # Jobs in progress go back to the queue for another worker
+    await job_workers.stop()
+    # Return pooled Postgres connections cleanly when the worker exits
+    stop_refresher()
+    await aclose_checkpointer()
+    await aclose_pools()
+
+def create_app() -> FastAPI:
+    """Application factory. Building the app compiles nothing and opens no connections."""
+    app = FastAPI(
+        title="Demand Analysis Agent API",
+        description="An API for interacting with the LangGraph classification agent.",
+        version="1.0.0",
+        lifespan=lifespan,
+    )
+    app.middleware("http")(log_requests)
+    app.include_router(router)
+    return app
+
+# Module-level app for `uvicorn backend:api` / `gunicorn backend:api`
+api = create_app()
+
+_import_seconds = time.perf_counter() - _IMPORT_STARTED
+STARTUP_SECONDS.labels("import").set(_import_seconds)
+logging.info(f"backend imported in {_import_seconds:.3f}s")
@@ -0,0 +1,126 @@
+# batch.py
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import nodes
+from checkpoints import GraphRunError, RunDeadlineExceeded, ainvoke_run
+from deadlines import request_deadline
+from config import BATCH_CONCURRENCY, EXTRACTION_BATCH_SIZE, REQUEST_DEADLINE_SECONDS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# (raw_input, extracted_info or None) -> final state
+ItemRunner = Callable[[str, Optional[Dict[str, Any]]], Awaitable[dict]]
+# raw_input -> cached final state or None
+CacheLookup = Callable[[str], Awaitable[Optional[dict]]]
+
+
+async def _run_graph(raw_input: str, extracted_info: Optional[Dict[str, Any]]) -> dict:
+    inputs = {"raw_input": raw_input}
+    if extracted_info:
+        inputs["extracted_info"] = extracted_info
+    final_state, _ = await ainvoke_run(inputs)
+    return final_state
+
+
+async def _extract_chunk(raw_inputs: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """Runs one batched extraction call; if it fails, the items fall back to per-item extraction."""
+    try:
+        return await nodes.abatch_extract_information(raw_inputs)
+    except Exception as e:
+        logger.warning(f"Batched extraction of {len(raw_inputs)} demands failed, extracting them individually: {e}")
+        return [None] * len(raw_inputs)
+
+
+async def analyze_batch(
+    raw_inputs: List[str],
+    concurrency: int = BATCH_CONCURRENCY,
+    run_item: ItemRunner = _run_graph,
+    lookup_cached: Optional[CacheLookup] = None,
+    extraction_batch_size: int = EXTRACTION_BATCH_SIZE,
+) -> AsyncIterator[dict]:
+    """
+    Analyzes many demands, yielding one result per item as soon as it completes:
+      {"index": i, "status": "ok", "cached": bool, "result": <final state>}
+      {"index": i, "status": "error", "error": "...", "run_id": ...}  (run_id: resumable, if checkpointed)
+      {"index": i, "status": "partial", "result": <completed nodes' state>, "completed_nodes": [...], "error": "...", "run_id": ...}
+    Each graph run gets its own REQUEST_DEADLINE_SECONDS, counted once it leaves the queue.
+    At most `concurrency` graph runs are in flight. Items already in the result
+    cache (lookup_cached) are yielded first; the rest share batched extraction
+    calls, and each chunk's graph runs start as soon as its extraction returns.
+    One item failing never affects the others.
+    """
+    pending = []
+    for index, raw_input in enumerate(raw_inputs):
+        if lookup_cached is not None:
+            try:
+                cached_state = await lookup_cached(raw_input)
+            except Exception as e:
+                logger.warning(f"Cache lookup for batch item {index} failed: {e}")
+                cached_state = None
+            if cached_state is not None:
+                yield {"index": index, "status": "ok", "cached": True, "result": cached_state}
+                continue
+        pending.append(index)
+
+    # Extraction calls and graph runs overlap: a chunk's graph runs start as soon as its
+    # extraction returns, while later chunks are still being extracted
+    batched = extraction_batch_size > 1 and len(pending) > 1
+    size = extraction_batch_size if batched else 1
+    chunks = [pending[start:start + size] for start in range(0, len(pending), size)]
+    extract_semaphore = asyncio.Semaphore(concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    results: asyncio.Queue = asyncio.Queue()
+    tasks: List[asyncio.Future] = []
+
+    async def run_one(index: int, extracted_info: Optional[Dict[str, Any]]):
+        async with semaphore:
+            try:
+                with request_deadline(REQUEST_DEADLINE_SECONDS):
+                    state = await run_item(raw_inputs[index], extracted_info)
+                item = {"index": index, "status": "ok", "cached": False, "result": state}
+            except RunDeadlineExceeded as e:
+                logger.warning(f"Batch item {index} stopped: {e}")
+                item = {"index": index, "status": "partial", "result": e.partial_state, "completed_nodes": e.completed_nodes,
+                        "error": str(e), "run_id": e.run_id}
+            except Exception as e:
+                logger.error(f"Batch item {index} failed: {e}", exc_info=True)
+                item = {"index": index, "status": "error", "error": f"Error during LangGraph invocation: {str(e)}"}
+                if isinstance(e, GraphRunError) and e.run_id:
+                    item["run_id"] = e.run_id
+        results.put_nowait(item)
+
+    async def extract_then_run(indices: List[int]):
+        extracted: List[Optional[Dict[str, Any]]] = [None] * len(indices)
+        if batched:
+            async with extract_semaphore:
+                extracted = await _extract_chunk([raw_inputs[i] for i in indices])
+        for index, info in zip(indices, extracted):
+            tasks.append(asyncio.ensure_future(run_one(index, info)))
+
+    tasks.extend(asyncio.ensure_future(extract_then_run(chunk)) for chunk in chunks)
+    try:
+        for _ in range(len(pending)):
+            yield await results.get()
+    finally:
+        # Consumer stopped early (e.g. client disconnected): don't keep spending on the rest
+        for task in list(tasks):
+            task.cancel()
+
+
+def parse_jsonl(text: str) -> List[str]:
+    """Reads one demand per line: either a JSON string or an object with a 'raw_input' key."""
+    raw_inputs = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if isinstance(item, dict):
+            item = item.get("raw_input")
+        if not isinstance(item, str) or not item:
+            raise ValueError(f"Line {line_number} has no 'raw_input' string.")
+        raw_inputs.append(item)
+    return raw_inputs
@@ -0,0 +1,307 @@
+# benchmarks/bench_load.py
+"""
+Offline load benchmark for POST /analyze.
+
+Runs the real FastAPI app, graph, nodes, tools and caches in-process, with
+the Azure OpenAI clients replaced by the fakes in benchmarks/fakes.py and
+pgvector replaced by the in-memory vector index (RETRIEVAL_BACKEND=memory),
+seeded from benchmarks/dataset.py. No network or database is touched.
+Requests go through httpx's ASGI transport at a fixed concurrency.
+
+Each scenario reports p50/p95/p99 latency, throughput, LLM calls and tokens
+per request, time per node and retrieval time per collection (i.e. per
+node: rules_kb is classify_demand's, domain_kb classify_domain's, app_kb the
+application node's). Results are written as JSON; with --baseline the run
+is compared against an earlier file and exits non-zero on a regression.
+
+Usage (from the repo root; needs httpx):
+    python -m benchmarks.bench_load [--scenario steady --scenario burst] [--profile azure]
+        [--llm-rpm 600 --llm-tpm 200000]
+        [--output bench_results.json] [--baseline previous.json --max-regression 0.2]
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from benchmarks.dataset import demands, kb_rows
+from benchmarks.fakes import PROFILES, FakeChatModel, FakeEmbeddings
+
+
+@dataclass(frozen=True)
+class Scenario:
+    concurrency: int
+    requests: int
+    distinct: Optional[int] = None # fewer distinct demands than requests: cache and single-flight traffic
+    warmup: int = 2
+
+
+SCENARIOS = {
+    "serial": Scenario(concurrency=1, requests=20),
+    "steady": Scenario(concurrency=8, requests=80),
+    "burst": Scenario(concurrency=32, requests=160),
+    "repeats": Scenario(concurrency=8, requests=80, distinct=20),
+}
+
+# Forced before config.py is imported (it reads them once): in-memory retrieval, no refresh threads polling Postgres
+OFFLINE_ENV = {
+    "RETRIEVAL_BACKEND": "memory",
+    "VECTOR_INDEX_REFRESH_SECONDS": "0",
+    "APP_DICTIONARY_REFRESH_SECONDS": "1e9",
+    "APP_DIRECTORY_CACHE_TTL_SECONDS": "1e9",
+    "SINGLEFLIGHT_ADVISORY_LOCK": "false",
+    "EMBEDDING_CACHE_PATH": "",
+}
+# Settings that change what the pipeline does, recorded with the results
+RECORDED_SETTINGS = [
+    "CLASSIFY_DEMAND_MODE", "CLASSIFY_DOMAIN_MODE", "APP_EXTRACTION_MODE", "APPLICATION_LOOKUP_MODE",
+    "FORMAT_OUTPUT_MODE", "RESULT_CACHE_BACKEND", "GRAPH_MAX_CONCURRENCY", "EMBEDDING_BATCH_WINDOW_MS",
+    "LLM_REQUESTS_PER_MINUTE", "LLM_TOKENS_PER_MINUTE", "SEMANTIC_CACHE_BACKEND", "SEMANTIC_CACHE_THRESHOLD",
+]
+COLLECTION_NODES = {"rules_kb": "classify_demand", "domain_kb": "classify_domain", "app_kb": "extract_and_classify_applications"}
+TRACKED_METRICS = {
+    "demand_agent_node_seconds", "demand_agent_llm_calls", "demand_agent_llm_tokens",
+    "demand_agent_retrieval_seconds", "demand_agent_embedding_seconds", "demand_agent_agent_iterations",
+    "demand_agent_llm_queue_wait_seconds",
+}
+
+
+def install_fakes(profile: str, seed: int, result_cache: str, llm_rpm: float = 0, llm_tpm: float = 0):
+    """Points config.py at the fake clients. Must run before the first chain or agent is built."""
+    os.environ.update(OFFLINE_ENV)
+    os.environ["RESULT_CACHE_BACKEND"] = result_cache
+    os.environ["LLM_REQUESTS_PER_MINUTE"] = str(llm_rpm)
+    os.environ["LLM_TOKENS_PER_MINUTE"] = str(llm_tpm)
+
+    import config
+    from embedding_cache import CachedEmbeddings
+    from llm_scheduler import scheduled
+    # Behind the LLM scheduler like the real client, so --llm-rpm/--llm-tpm show behaviour at the quota
+    llm = scheduled(FakeChatModel)(profile_name=profile, seed=seed)
+    embeddings = FakeEmbeddings(profile, seed=seed)
+    config.set_clients(llm=llm, embeddings_model=CachedEmbeddings(
+        embeddings, deployment_name="benchmark", max_size=config.EMBEDDING_CACHE_SIZE,
+        batch_window_ms=config.EMBEDDING_BATCH_WINDOW_MS, max_batch=config.EMBEDDING_BATCH_MAX_SIZE,
+    ))
+    return llm, embeddings
+
+
+def seed_kb(embeddings: FakeEmbeddings, n_apps: int, seed: int):
+    """Loads the seeded KB into the in-memory indexes and the application dictionary/directory."""
+    from vector_index import InMemoryVectorIndex, register_index
+    from app_directory import APP_DICTIONARY, APP_DIRECTORY
+    from result_cache import pin_kb_fingerprint
+
+    rows = kb_rows(n_apps, seed)
+    for collection, collection_rows in rows.items():
+        # Embedded directly: seeding is not part of what is measured
+        register_index(InMemoryVectorIndex.from_rows(
+            collection, [(content, metadata, embeddings._vector(content)) for content, metadata in collection_rows]))
+    APP_DICTIONARY.load_rows(rows["app_kb"])
+    APP_DIRECTORY.load_rows(rows["app_kb"])
+    pin_kb_fingerprint(hashlib.sha256(json.dumps(rows, sort_keys=True).encode("utf-8")).hexdigest())
+
+
+def metric_totals() -> Dict[tuple, float]:
+    """Current value of every tracked sample, keyed by (sample name, sorted labels)."""
+    from prometheus_client import REGISTRY
+    totals = {}
+    for family in REGISTRY.collect():
+        if family.name in TRACKED_METRICS:
+            for sample in family.samples:
+                totals[(sample.name, tuple(sorted(sample.labels.items())))] = sample.value
+    return totals
+
+
+def _delta(before: Dict[tuple, float], after: Dict[tuple, float], sample_name: str, label: str) -> Dict[str, float]:
+    """Increase of a sample since `before`, summed per value of one label."""
+    out: Dict[str, float] = {}
+    for (name, labels), value in after.items():
+        if name == sample_name:
+            key = dict(labels).get(label, "")
+            out[key] = out.get(key, 0.0) + value - before.get((name, labels), 0.0)
+    return out
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Linear interpolation between closest ranks."""
+    if not sorted_values:
+        return 0.0
+    rank = (len(sorted_values) - 1) * p
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+async def run_scenario(client, name: str, scenario: Scenario, llm: FakeChatModel, embeddings: FakeEmbeddings, seed: int) -> dict:
+    inputs = demands(scenario.warmup + scenario.requests, prefix=name,
+                     distinct=scenario.distinct and scenario.warmup + scenario.distinct, seed=seed)
+    for raw_input in inputs[:scenario.warmup]:
+        await client.post("/analyze", json={"raw_input": raw_input})
+    queue = list(reversed(inputs[scenario.warmup:]))
+    latencies, errors, cache_hits = [], 0, 0
+
+    async def worker():
+        nonlocal errors, cache_hits
+        while queue:
+            raw_input = queue.pop()
+            start = time.perf_counter()
+            response = await client.post("/analyze", json={"raw_input": raw_input})
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+            elif response.headers.get("X-Cache") == "HIT":
+                cache_hits += 1
+
+    before, llm_calls, embedding_requests = metric_totals(), llm.calls, embeddings.requests
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(scenario.concurrency)))
+    wall = time.perf_counter() - started
+    after = metric_totals()
+
+    n = scenario.requests
+    latencies.sort()
+    node_sum = _delta(before, after, "demand_agent_node_seconds_sum", "node")
+    node_count = _delta(before, after, "demand_agent_node_seconds_count", "node")
+    retrieval_sum = _delta(before, after, "demand_agent_retrieval_seconds_sum", "collection")
+    retrieval_count = _delta(before, after, "demand_agent_retrieval_seconds_count", "collection")
+    tokens = _delta(before, after, "demand_agent_llm_tokens_total", "kind")
+    queue_sum = _delta(before, after, "demand_agent_llm_queue_wait_seconds_sum", "priority")
+    queue_count = _delta(before, after, "demand_agent_llm_queue_wait_seconds_count", "priority")
+    return {
+        "scenario": asdict(scenario),
+        "requests": n,
+        "errors": errors,
+        "cache_hits": cache_hits,
+        "wall_seconds": wall,
+        "throughput_rps": n / wall if wall else 0.0,
+        "latency_seconds": {
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else 0.0,
+        },
+        "llm_calls_per_request": (llm.calls - llm_calls) / n,
+        "llm_tokens_per_request": {kind: value / n for kind, value in tokens.items()},
+        "llm_queue_wait_seconds_mean": {priority: queue_sum[priority] / count for priority, count in queue_count.items() if count},
+        "embedding_requests_per_request": (embeddings.requests - embedding_requests) / n,
+        "node_seconds_mean": {node: node_sum[node] / count for node, count in node_count.items() if count},
+        "retrieval": {
+            collection: {
+                "node": COLLECTION_NODES.get(collection),
+                "calls_per_request": count / n,
+                "seconds_per_request": retrieval_sum.get(collection, 0.0) / n,
+                "seconds_mean": retrieval_sum.get(collection, 0.0) / count,
+            }
+            for collection, count in retrieval_count.items() if count
+        },
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, max_regression: float) -> List[str]:
+    """Regressions of this run against a baseline file, as readable lines."""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None:
+            continue
+        checks = [
+            ("p95 latency", current["latency_seconds"]["p95"], previous["latency_seconds"]["p95"], True),
+            ("LLM calls/request", current["llm_calls_per_request"], previous["llm_calls_per_request"], True),
+            ("throughput", current["throughput_rps"], previous["throughput_rps"], False),
+        ]
+        for label, now, before, lower_is_better in checks:
+            if not before:
+                continue
+            change = (now - before) / before
+            if (change > max_regression) if lower_is_better else (change < -max_regression):
+                regressions.append(f"{name}: {label} {before:.3f} -> {now:.3f} ({change:+.0%})")
+    return regressions
+
+
+async def run(args) -> dict:
+    llm, embeddings = install_fakes(args.profile, args.seed, args.result_cache, args.llm_rpm, args.llm_tpm)
+    seed_kb(embeddings, args.apps, args.seed)
+
+    import httpx
+    import config
+    from backend import api
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "profile": {"name": args.profile, **asdict(PROFILES[args.profile])},
+            "seed": args.seed,
+            "apps": args.apps,
+            "settings": {name: getattr(config, name, None) for name in RECORDED_SETTINGS},
+        },
+        "scenarios": {},
+    }
+    transport = httpx.ASGITransport(app=api)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        for name in args.scenario or list(SCENARIOS):
+            # The nodes print every step; keep the benchmark output readable
+            with contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext():
+                results["scenarios"][name] = await run_scenario(client, name, SCENARIOS[name], llm, embeddings, args.seed)
+            summary = results["scenarios"][name]
+            latency = summary["latency_seconds"]
+            print(f"{name:10} c={SCENARIOS[name].concurrency:<3} n={summary['requests']:<4} "
+                  f"p50={latency['p50']:.3f}s p95={latency['p95']:.3f}s p99={latency['p99']:.3f}s "
+                  f"rps={summary['throughput_rps']:.2f} llm/req={summary['llm_calls_per_request']:.2f} "
+                  f"errors={summary['errors']} cache_hits={summary['cache_hits']}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="repeatable; default: all")
+    parser.add_argument("--profile", choices=list(PROFILES), default="fast")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--apps", type=int, default=40, help="applications in the seeded app_kb")
+    parser.add_argument("--result-cache", choices=["memory", "none"], default="memory")
+    parser.add_argument("--llm-rpm", type=float, default=0, help="LLM scheduler request limit per minute (default: none)")
+    parser.add_argument("--llm-tpm", type=float, default=0, help="LLM scheduler token limit per minute (default: none)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed relative change (default 0.2)")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own output")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    results = asyncio.run(run(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
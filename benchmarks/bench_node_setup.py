@@ -0,0 +1,73 @@
+# benchmarks/bench_node_setup.py
+"""
+Micro-benchmark for the per-request setup work that nodes.py used to do.
+
+Every node used to rebuild its prompt, agent and AgentExecutor (and
+extract_information its Pydantic model and structured-output binding) on each
+call. This times those builders, i.e. the CPU each request no longer spends
+now that they are built once per process. The clients are the offline fakes
+of benchmarks/fakes.py, so it runs anywhere: no credentials, no LLM or
+database calls.
+
+Usage (from the repo root):
+    python -m benchmarks.bench_node_setup [--iterations 200]
+"""
+import argparse
+import statistics
+import time
+
+from pydantic import create_model
+
+import config
+import nodes
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings
+from embedding_cache import CachedEmbeddings
+
+
+def _rebuild_extracted_info_model():
+    # Same fields as nodes.ExtractedInfo, created the way a per-request class statement would
+    fields = {name: (field.annotation, field) for name, field in nodes.ExtractedInfo.model_fields.items()}
+    return create_model("ExtractedInfo", **fields)
+
+
+BUILDERS = {
+    "ExtractedInfo model": _rebuild_extracted_info_model,
+    "extract_information chain": nodes._build_extraction_chain,
+    "classify_demand agent": nodes._build_demand_agent,
+    "classify_domain agent": nodes._build_domain_agent,
+    "application extractor chain": nodes._build_app_extractor_chain,
+    "application classifier agent": nodes._build_app_classifier_agent,
+    "format_output chain": nodes._build_formatter_chain,
+}
+
+
+def time_builder(builder, iterations: int):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        builder()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    # Building an agent only binds the client; the fakes avoid needing Azure credentials for it
+    config.set_clients(llm=FakeChatModel(profile_name="instant"),
+                       embeddings_model=CachedEmbeddings(FakeEmbeddings("instant"), deployment_name="benchmark"))
+
+    total = 0.0
+    print(f"{'component':32} {'mean (ms)':>10} {'p95 (ms)':>10}")
+    for name, builder in BUILDERS.items():
+        samples = sorted(time_builder(builder, args.iterations))
+        mean = statistics.fmean(samples)
+        p95 = samples[int(0.95 * (len(samples) - 1))]
+        total += mean
+        print(f"{name:32} {mean * 1000:10.3f} {p95 * 1000:10.3f}")
+    print(f"{'saved per request':32} {total * 1000:10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# benchmarks/bench_retrieval.py
+"""
+Recall and latency of the ANN-indexed KB similarity search against Postgres.
+
+For each table, the exact top-k of every query (the index switched off, so a
+full scan ranks all rows) is compared with what the indexed query of
+tools.search_collection returns, at each --ef-search (HNSW) or --probes
+(IVFFlat) setting. Reports recall@k and p50/p95 query latency per setting,
+so the accuracy/speed trade-off of KB_RETRIEVERS can be chosen from numbers.
+
+Queries are stored embeddings of the table with a little noise added, so they
+resemble real demands rather than random points. With --synthetic, scratch
+tables of the given sizes are created (clustered random vectors), indexed the
+way kb_index.py would and dropped afterwards, which shows how latency grows
+with the table size with and without the index.
+
+Needs a reachable Postgres with pgvector (the DB_* settings).
+
+Usage (from the repo root):
+    python -m benchmarks.bench_retrieval [app_kb rules_kb] [--queries 200 --k 5]
+        [--ef-search 20 --ef-search 40 --ef-search 100] [--probes 1 --probes 10]
+        [--synthetic 10000,100000 --dims 1536 --index hnsw] [--output retrieval_results.json]
+"""
+import argparse
+import json
+import logging
+import time
+from dataclasses import replace
+from typing import Dict, List
+
+import numpy as np
+
+from benchmarks.bench_load import percentile
+from db import get_pool
+from kb_index import _create_index_sql, _table_info
+from vector_index import as_array
+from tools import RetrieverConfig, retriever_config, _similarity_sql, _similarity_params, _apply_settings
+
+SYNTHETIC_PREFIX = "bench_retrieval_"
+
+
+def _sample_queries(conn, table: str, n: int, seed: int) -> np.ndarray:
+    rows = conn.execute(f"SELECT embedding FROM {table} ORDER BY random() LIMIT %s", (n,)).fetchall()
+    if not rows:
+        raise ValueError(f"Table {table} is empty")
+    vectors = np.stack([as_array(r[0]) for r in rows])
+    vectors = vectors[np.arange(n) % len(vectors)]
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(size=vectors.shape).astype(np.float32)
+    # From the vectors: a bare "vector" column has no declared dimensions
+    scale = 0.1 * np.linalg.norm(vectors, axis=1, keepdims=True) / np.sqrt(vectors.shape[1])
+    return vectors + noise * scale
+
+
+def _search(conn, table: str, query: np.ndarray, k: int, filters: dict, prepare: bool = True) -> List[str]:
+    rows = conn.execute(_similarity_sql(table, bool(filters)), _similarity_params(query, filters, k), prepare=prepare).fetchall()
+    return [r[0] for r in rows]
+
+
+def _exact(conn, table: str, queries: np.ndarray, k: int, filters: dict):
+    """The true top-k of each query and the latency of finding it without the index."""
+    truth, latencies = [], []
+    with conn.transaction():
+        # ANN indexes are only used through index scans. Not prepared: a plan cached
+        # here would keep the full scan for the ANN phase, which runs the same SQL
+        conn.execute("SET LOCAL enable_indexscan = off")
+        for q in queries:
+            start = time.perf_counter()
+            truth.append(_search(conn, table, q, k, filters, prepare=False))
+            latencies.append(time.perf_counter() - start)
+    return truth, sorted(latencies)
+
+
+def _settings_sweep(config: RetrieverConfig, ef_search: List[int], probes: List[int]) -> List[RetrieverConfig]:
+    if config.index == "hnsw" and ef_search:
+        return [replace(config, ef_search=ef) for ef in ef_search]
+    if config.index == "ivfflat" and probes:
+        return [replace(config, probes=p) for p in probes]
+    return [config]
+
+
+def bench_table(conn, table: str, config: RetrieverConfig, queries: np.ndarray, k: int,
+                ef_search: List[int], probes: List[int]) -> dict:
+    rows, dims = _table_info(conn, table)
+    truth, exact_latencies = _exact(conn, table, queries, k, config.filters)
+    result = {
+        "table": table, "rows": rows, "dims": dims, "index": config.index, "k": k, "queries": len(queries),
+        "exact": {"p50": percentile(exact_latencies, 0.5), "p95": percentile(exact_latencies, 0.95)},
+        "settings": [],
+    }
+    for setting in _settings_sweep(config, ef_search, probes):
+        _apply_settings(conn, setting.session_settings())
+        for q in queries[:5]: # warm the plan cache and the index pages
+            _search(conn, table, q, k, setting.filters)
+        latencies, hits = [], 0
+        for q, expected in zip(queries, truth):
+            start = time.perf_counter()
+            found = _search(conn, table, q, k, setting.filters)
+            latencies.append(time.perf_counter() - start)
+            hits += len(set(found) & set(expected))
+        latencies.sort()
+        result["settings"].append({
+            **setting.session_settings(),
+            "recall": round(hits / max(1, sum(len(t) for t in truth)), 4),
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+        })
+    return result
+
+
+def create_synthetic(conn, rows: int, dims: int, config: RetrieverConfig, seed: int) -> str:
+    """A scratch table of clustered random vectors, indexed like kb_index.py would."""
+    table = f"{SYNTHETIC_PREFIX}{rows}"
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, rows // 100), dims)).astype(np.float32)
+    conn.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.execute(f"CREATE TABLE {table} (id bigserial PRIMARY KEY, content text NOT NULL, metadata jsonb, embedding vector({dims}))")
+    with conn.cursor() as cur:
+        with cur.copy(f"COPY {table} (content, embedding) FROM STDIN WITH (FORMAT BINARY)") as copy:
+            copy.set_types(["text", "vector"])
+            for start in range(0, rows, 10_000):
+                size = min(10_000, rows - start)
+                block = centers[rng.integers(len(centers), size=size)] + 0.3 * rng.normal(size=(size, dims)).astype(np.float32)
+                for i, vector in enumerate(block):
+                    copy.write_row((f"row {start + i}", vector))
+    if config.index != "none":
+        logging.info(f"Building {config.index} index on {table} ({rows} x {dims})")
+        conn.execute(_create_index_sql(table, config, rows))
+    conn.execute(f"ANALYZE {table}")
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tables", nargs="*", help="KB tables to measure, with their KB_RETRIEVERS settings")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, help="results per query (default: each table's top_k)")
+    parser.add_argument("--ef-search", type=int, action="append", default=[], help="repeatable; HNSW settings to compare")
+    parser.add_argument("--probes", type=int, action="append", default=[], help="repeatable; IVFFlat settings to compare")
+    parser.add_argument("--synthetic", help="comma-separated row counts of scratch tables to create and measure")
+    parser.add_argument("--dims", type=int, default=1536, help="dimensions of the synthetic vectors")
+    parser.add_argument("--index", choices=["hnsw", "ivfflat", "none"], help="index of the synthetic tables (default: KB_INDEX_TYPE)")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic tables")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="retrieval_results.json")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    results = []
+    targets: Dict[str, RetrieverConfig] = {table: retriever_config(table) for table in args.tables}
+    synthetic: List[str] = []
+    with get_pool().connection() as conn:
+        try:
+            if args.synthetic:
+                config = RetrieverConfig() if args.index is None else RetrieverConfig(index=args.index)
+                for rows in (int(n) for n in args.synthetic.split(",")):
+                    table = create_synthetic(conn, rows, args.dims, config, args.seed)
+                    synthetic.append(table)
+                    targets[table] = config
+            for table, config in targets.items():
+                k = args.k or config.top_k
+                queries = _sample_queries(conn, table, args.queries, args.seed)
+                result = bench_table(conn, table, config, queries, k, args.ef_search, args.probes)
+                results.append(result)
+                print(f"{table} ({result['rows']} rows, {config.index}, k={k}): "
+                      f"exact p50={result['exact']['p50'] * 1000:.2f}ms p95={result['exact']['p95'] * 1000:.2f}ms")
+                for setting in result["settings"]:
+                    knobs = {name: value for name, value in setting.items() if name not in ("recall", "p50", "p95")}
+                    print(f"  {knobs or 'defaults'}: recall@{k}={setting['recall']:.3f} "
+                          f"p50={setting['p50'] * 1000:.2f}ms p95={setting['p95'] * 1000:.2f}ms")
+        finally:
+            if not args.keep:
+                for table in synthetic:
+                    conn.execute(f"DROP TABLE IF EXISTS {table}")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
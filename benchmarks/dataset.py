@@ -0,0 +1,102 @@
+# benchmarks/dataset.py
+"""
+Seeded knowledge base and demand generator for the offline benchmarks.
+
+The rows follow the shapes the nodes expect: rules_kb holds one demand
+sub-category per row, domain_kb one business domain, and app_kb one
+application in the "Column: value" layout of the source sheet (see
+app_directory.APP_KB_COLUMNS). Everything is derived from a seed, so two runs
+with the same seed send identical demands against an identical KB.
+"""
+import random
+from typing import Dict, List, Optional, Tuple
+
+RULES = [
+    ("Non-Discretionary", "Regulatory Compliance", "Mandated by a regulator such as BNM, SC or PDPA.", "BNM, regulator, compliance, mandate, audit"),
+    ("Non-Discretionary", "Risk & Security Remediation", "Closes a security, fraud or operational risk finding.", "vulnerability, penetration test, fraud, remediation"),
+    ("Non-Discretionary", "Business Continuity", "Keeps an existing service running: outages, end of life, capacity.", "outage, end of life, upgrade, capacity, failure"),
+    ("Discretionary", "Revenue Generation", "New products or pricing that bring in revenue.", "revenue, new product, cross-sell, pricing, launch"),
+    ("Discretionary", "High-Impact CX Initiative", "Directly affects customer satisfaction, loyalty or retention.", "customer journey, onboarding, NPS, loyalty"),
+    ("Discretionary", "Low-Impact CX Initiative", "Minor usability improvements with limited end-user visibility.", "UI tweak, label, layout, minor enhancement"),
+    ("Discretionary", "Cost Optimisation", "Reduces running or operational cost.", "automation, decommission, cost saving, efficiency"),
+]
+
+DOMAINS = [
+    ("Payments", "QR, DuitNow, bill payments and transfers.", "Farah Aziz"),
+    ("Cards", "Credit and debit card issuance, limits and rewards.", "Daniel Tan"),
+    ("Lending", "Personal, mortgage and SME loan origination and servicing.", "Priya Nair"),
+    ("Deposits", "CASA, fixed deposits and account servicing.", "Hafiz Rahman"),
+    ("Wealth", "Unit trusts, bancassurance and investment products.", "Grace Lim"),
+    ("Digital Channels", "Mobile and internet banking front ends.", "Arjun Menon"),
+    ("Risk & Compliance", "AML, fraud monitoring and regulatory reporting.", "Siti Ismail"),
+]
+
+COUNTRIES = ["MY", "SG", "ID", "PH", "KH"]
+PLATFORMS = ["Mobile Banking Platform", "Web Banking Portal", "Core Banking System", "Card Management System",
+             "Payments Hub", "Loan Origination System", "Data Platform"]
+FIRST_NAMES = ["Aisha", "Budi", "Charles", "Diana", "Ethan", "Fatimah", "Gopal", "Hannah", "Irfan", "Joanne", "Kumar", "Lina"]
+LAST_NAMES = ["Rahman", "Santoso", "Lee", "Velez", "Ong", "Hassan", "Pillai", "Wong", "Yusof", "Cruz", "Raj", "Chen"]
+
+DEMAND_TEMPLATES = [
+    "Regulator BNM requires {app} to {action} before the audit deadline.",
+    "Customers complain that {app} fails to {action}; please fix the error ASAP.",
+    "Launch a new feature in {app} to {action} and drive revenue from cross-sell.",
+    "Enhancement 2.0 for {app}: {action} with a better onboarding journey.",
+    "Automate the manual process in {app} to {action} and cut operational cost.",
+    "Investigate whether {app} and {app2} can {action} for the SP digital programme.",
+]
+ACTIONS = ["support DuitNow QR payments", "show loyalty points on the dashboard", "send card limit notifications",
+           "capture e-KYC documents", "report suspicious transactions", "reset passwords without branch visits",
+           "offer instant personal loan approval", "display fixed deposit maturity alerts"]
+
+
+def _person(rng: random.Random) -> Tuple[str, str]:
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    return f"{first} {last}", f"{first.lower()}.{last.lower()}@example.com"
+
+
+def applications(n_apps: int = 40, seed: int = 7) -> List[Dict[str, str]]:
+    """Application records; the first few use real-looking acronyms, the rest are numbered."""
+    rng = random.Random(seed)
+    names = ["MAE", "M2U", "CASA", "CMS", "LOS", "EDW", "IBG", "RPP", "FDS", "AML"]
+    names += [f"APP{i:03d}" for i in range(n_apps - len(names))]
+    apps = []
+    for name in names[:n_apps]:
+        tech_lead, owner = _person(rng), _person(rng)
+        apps.append({
+            "Application Name": name,
+            "Application full name": f"{name} {rng.choice(['Gateway', 'Portal', 'Engine', 'Service'])}",
+            "Tech Lead": f"{tech_lead[0]} <{tech_lead[1]}>",
+            "IT Owner": f"{owner[0]} <{owner[1]}>",
+            "Country": rng.choice(COUNTRIES),
+            "Platform": rng.choice(PLATFORMS),
+            "Aliases": f"{name} app",
+        })
+    return apps
+
+
+def kb_rows(n_apps: int = 40, seed: int = 7) -> Dict[str, List[Tuple[str, dict]]]:
+    """(content, metadata) rows per KB collection."""
+    rules = [(f"Category: {category}\nSub-category: {sub}\nDefinition: {definition}\nCommon Keywords: {keywords}",
+              {"category": category, "sub_category": sub}) for category, sub, definition, keywords in RULES]
+    domains = [(f"Domain: {name}\nDescription: {description}\nDomain Lead: {lead}", {"domain": name})
+               for name, description, lead in DOMAINS]
+    apps = [("\n".join(f"{key}: {value}" for key, value in app.items()), {"Application Name": app["Application Name"]})
+            for app in applications(n_apps, seed)]
+    return {"rules_kb": rules, "domain_kb": domains, "app_kb": apps}
+
+
+def demands(n: int, prefix: str, distinct: Optional[int] = None, n_apps: int = 40, seed: int = 7) -> List[str]:
+    """
+    n raw demands. With distinct < n only that many different texts are
+    generated and then repeated, which exercises the result cache and the
+    single-flight coalescing. The prefix keeps scenarios from sharing results.
+    """
+    rng = random.Random(f"{seed}-{prefix}")
+    app_names = [app["Application Name"] for app in applications(n_apps, seed)]
+    unique = []
+    for i in range(distinct or n):
+        app, app2 = rng.sample(app_names, 2)
+        text = rng.choice(DEMAND_TEMPLATES).format(app=app, app2=app2, action=rng.choice(ACTIONS))
+        unique.append(f"Title: {prefix}-{i} {app} request\nDescription: {text}")
+    return [unique[i % len(unique)] for i in range(n)]
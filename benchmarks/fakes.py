@@ -0,0 +1,218 @@
+# benchmarks/fakes.py
+"""
+Local stand-ins for the Azure OpenAI chat and embedding deployments.
+
+FakeChatModel answers every prompt nodes.py sends (structured extraction,
+the tool-calling agents, the application extractor and the formatter) with
+well-formed canned output, and sleeps like a real deployment would: a time to
+first token plus the completion length at a fixed token rate. It reports
+usage_metadata, so the token metrics are populated too. FakeEmbeddings
+returns deterministic bag-of-words vectors, so similar texts are close.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, List
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from benchmarks.dataset import DOMAINS, RULES
+
+
+@dataclass(frozen=True)
+class LatencyProfile:
+    first_token_seconds: float
+    tokens_per_second: float
+    embedding_seconds: float
+    jitter: float = 0.1 # +/- fraction applied to every sleep
+
+
+PROFILES = {
+    "instant": LatencyProfile(0.0, math.inf, 0.0, 0.0),
+    "fast": LatencyProfile(0.05, 400.0, 0.005),
+    "azure": LatencyProfile(0.4, 80.0, 0.05),
+    "slow": LatencyProfile(1.5, 30.0, 0.2),
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class _Sleeper:
+    """Seeded jitter shared by the fakes; the lock keeps the random stream deterministic enough across threads."""
+
+    def __init__(self, profile: LatencyProfile, seed: int):
+        self.profile = profile
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def seconds(self, base: float) -> float:
+        if base <= 0 or not self.profile.jitter:
+            return max(base, 0.0)
+        with self._lock:
+            return base * self._rng.uniform(1 - self.profile.jitter, 1 + self.profile.jitter)
+
+    def completion(self, completion_tokens: int) -> float:
+        return self.seconds(self.profile.first_token_seconds + completion_tokens / self.profile.tokens_per_second)
+
+
+def _fake_value(schema: dict, defs: dict, name: str, source: str):
+    """
+    A value matching a JSON schema, for with_structured_output() calls. Title and
+    description come from the demand text, so downstream prompts differ per demand.
+    """
+    if "$ref" in schema:
+        return _fake_value(defs[schema["$ref"].split("/")[-1]], defs, name, source)
+    if "anyOf" in schema:
+        return _fake_value(next(s for s in schema["anyOf"] if s.get("type") != "null"), defs, name, source)
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        return {key: _fake_value(value, defs, key, source) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_fake_value(schema.get("items", {}), defs, name, source)]
+    if kind == "integer":
+        return 0
+    if kind == "number":
+        return 0.0
+    if kind == "boolean":
+        return False
+    if name == "title":
+        return source.strip().splitlines()[0][:120] if source.strip() else "benchmark title"
+    if name == "description":
+        return source.strip()[:600]
+    return _STRUCTURED_STRINGS.get(name, f"benchmark {name.replace('_', ' ')}")
+
+
+_STRUCTURED_STRINGS = {
+    "category": RULES[0][0], "sub_category": RULES[0][1],
+    "domain": DOMAINS[0][0], "role": "Accountable", "domain_lead": DOMAINS[0][2],
+}
+
+_DEMAND_BLOCK_RE = re.compile(r"^DEMAND (\d+)[^\n]*\n(.*?)(?=^DEMAND \d+|\Z)", re.MULTILINE | re.DOTALL)
+_APP_NAME_RE = re.compile(r"\b(?:[A-Z][A-Z0-9]{1,}\d*)\b")
+
+
+class FakeChatModel(BaseChatModel):
+    """Canned answers for the prompts in nodes.py, with profile-driven latency."""
+
+    profile_name: str = "fast"
+    model_name: str = "benchmark-fake" # reported as the model label of the LLM metrics
+    seed: int = 0
+    calls: int = 0
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._sleeper = _Sleeper(PROFILES[self.profile_name], self.seed)
+        self._calls_lock = threading.Lock()
+
+    @property
+    def _llm_type(self) -> str:
+        return "benchmark-fake"
+
+    def bind_tools(self, tools, tool_choice=None, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(t) for t in tools], tool_choice=tool_choice, **kwargs)
+
+    def _structured(self, messages, tool: dict) -> AIMessage:
+        function = tool["function"]
+        parameters = function["parameters"]
+        human = messages[-1].content
+        args = _fake_value(parameters, parameters.get("$defs", {}), function["name"], human)
+        if "demands" in args:
+            # Batched extraction: one item per "DEMAND <i>" block of the prompt
+            item_schema = parameters["properties"]["demands"]["items"]
+            args["demands"] = [dict(_fake_value(item_schema, parameters.get("$defs", {}), "demand", block), demand_index=int(i))
+                               for i, block in _DEMAND_BLOCK_RE.findall(human)]
+        return AIMessage(content="", tool_calls=[{"name": function["name"], "args": args, "id": "call_structured"}])
+
+    def _text(self, system: str, human: str) -> str:
+        if "Systems/Applications" in system:
+            names = [n for n in dict.fromkeys(_APP_NAME_RE.findall(human)) if n not in {"DEMAND", "BNM", "SP", "ASAP"}]
+            return "```json\n" + json.dumps({"Systems/Applications": names[:3]}) + "\n```"
+        if "system_name" in system:
+            return json.dumps([{"system_name": name, "tech_lead": {"name": "Not Found", "email": "Not Found"},
+                                "it_owner": {"name": "Not Found", "email": "Not Found"},
+                                "regional_availability": "MY", "platform": "Not Found"}
+                               for name in dict.fromkeys(_APP_NAME_RE.findall(human))])
+        if "Sub-category" in system:
+            category, sub, _, keywords = RULES[int(hashlib.md5(human.encode()).hexdigest(), 16) % len(RULES)]
+            return f"Category : {category}\nSub-category : {sub}\nJustification : The demand mentions {keywords.split(',')[0]}."
+        if "Rules of Engagement" in system:
+            main, impacted = DOMAINS[0], DOMAINS[5]
+            return (f"Main Domain (Accountable): {main[0]}\nDomain Lead: {main[2]}\nReasoning: {main[1]}\n\n"
+                    f"Impacted Domain (Consulted/Informed): {impacted[0]}\nDomain Lead: {impacted[2]}\nReasoning: {impacted[1]}")
+        return "CATEGORY:\nBenchmark report\n" + human[:400]
+
+    def _respond(self, messages, **kwargs) -> AIMessage:
+        with self._calls_lock:
+            self.calls += 1
+        tools = kwargs.get("tools")
+        system = next((m.content for m in messages if isinstance(m, SystemMessage)), "")
+        human = messages[-1].content if isinstance(messages[-1].content, str) else str(messages[-1].content)
+        if tools and kwargs.get("tool_choice"):
+            message = self._structured(messages, tools[0])
+        elif tools and not any(isinstance(m, ToolMessage) for m in messages):
+            # Agents: one knowledge-base lookup, then the final answer
+            function = tools[0]["function"]
+            argument = next(iter(function["parameters"].get("properties", {})), "__arg1")
+            message = AIMessage(content="", tool_calls=[{"name": function["name"], "args": {argument: human[:300]}, "id": "call_kb"}])
+        else:
+            message = AIMessage(content=self._text(system, human))
+        prompt_tokens = sum(estimate_tokens(str(m.content)) for m in messages)
+        completion_tokens = estimate_tokens(message.content or json.dumps([c["args"] for c in message.tool_calls]))
+        message.usage_metadata = {"input_tokens": prompt_tokens, "output_tokens": completion_tokens,
+                                  "total_tokens": prompt_tokens + completion_tokens}
+        return message
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages, **kwargs)
+        time.sleep(self._sleeper.completion(message.usage_metadata["output_tokens"]))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self._respond(messages, **kwargs)
+        await asyncio.sleep(self._sleeper.completion(message.usage_metadata["output_tokens"]))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag-of-words vectors, L2-normalized; one profile-driven sleep per request."""
+
+    def __init__(self, profile_name: str = "fast", size: int = 256, seed: int = 0):
+        self.size = size
+        self.requests = 0
+        self._sleeper = _Sleeper(PROFILES[profile_name], seed)
+
+    def _vector(self, text: str) -> List[float]:
+        vector = [0.0] * self.size
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode()).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.size] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.requests += 1
+        time.sleep(self._sleeper.seconds(self._sleeper.profile.embedding_seconds))
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.requests += 1
+        await asyncio.sleep(self._sleeper.seconds(self._sleeper.profile.embedding_seconds))
+        return [self._vector(t) for t in texts]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
@@ -0,0 +1,217 @@
+# checkpoints.py
+import asyncio
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import CHECKPOINT_BACKEND, CHECKPOINT_SQLITE_PATH, CHECKPOINT_DURABILITY, CHECKPOINT_MAX_FAILED_RUNS
+from deadlines import DeadlineExceeded
+from graph import get_app
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CHECKPOINTS_ENABLED = CHECKPOINT_BACKEND != "none"
+
+
+class GraphRunError(RuntimeError):
+    """
+    A graph run failed. With checkpoints enabled its completed nodes are kept
+    under run_id, and resume_run(run_id) re-runs only the ones that did not finish.
+    """
+
+    def __init__(self, run_id: Optional[str], error: Exception):
+        super().__init__(str(error))
+        self.run_id = run_id
+
+
+class RunDeadlineExceeded(GraphRunError):
+    """
+    A node of the run hit its own or the request's deadline (deadlines.py).
+    partial_state holds the input and the outputs of the nodes that completed.
+    """
+
+    def __init__(self, run_id: Optional[str], error: DeadlineExceeded, partial_state: Dict[str, Any], completed_nodes: List[str]):
+        super().__init__(run_id, error)
+        self.partial_state = partial_state
+        self.completed_nodes = completed_nodes
+
+
+# One checkpointer and checkpointed graph per process, opened on first use (after the fork)
+_checkpointer = None
+_sqlite_conn = None
+_run_app = None
+_run_app_lock: Optional[asyncio.Lock] = None
+# Failed runs of this process, oldest first, so they can be dropped beyond CHECKPOINT_MAX_FAILED_RUNS
+_failed_runs: "OrderedDict[str, float]" = OrderedDict()
+
+
+async def _open_checkpointer():
+    global _sqlite_conn
+    if CHECKPOINT_BACKEND == "memory":
+        from langgraph.checkpoint.memory import InMemorySaver
+        return InMemorySaver()
+    if CHECKPOINT_BACKEND == "sqlite":
+        import aiosqlite
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+        _sqlite_conn = await aiosqlite.connect(CHECKPOINT_SQLITE_PATH)
+        saver = AsyncSqliteSaver(_sqlite_conn)
+    elif CHECKPOINT_BACKEND == "postgres":
+        from langgraph.checkpoint.postgres.aio import AsyncPostgresSaver
+        from db import get_async_pool
+        # Shares the KB pool: the saver uses its own dict_row cursors on the autocommit connections
+        saver = AsyncPostgresSaver(await get_async_pool())
+    else:
+        raise ValueError(f"Unknown CHECKPOINT_BACKEND '{CHECKPOINT_BACKEND}'")
+    # Creates the checkpoint tables on first use
+    await saver.setup()
+    return saver
+
+
+async def get_run_app():
+    """The compiled graph every run goes through: checkpointed, or get_app() with CHECKPOINT_BACKEND=none."""
+    global _checkpointer, _run_app, _run_app_lock
+    if not CHECKPOINTS_ENABLED:
+        return get_app()
+    if _run_app is None:
+        if _run_app_lock is None:
+            _run_app_lock = asyncio.Lock()
+        async with _run_app_lock:
+            if _run_app is None:
+                _checkpointer = await _open_checkpointer()
+                # The graph compiled by startup.preload (in the gunicorn master), with this
+                # worker's checkpointer attached, rather than a second compilation per worker
+                _run_app = get_app().copy({"checkpointer": _checkpointer})
+                logger.info(f"Checkpointed LangGraph app ready ({CHECKPOINT_BACKEND} checkpoints).")
+    return _run_app
+
+
+async def aclose_checkpointer():
+    global _sqlite_conn
+    if _sqlite_conn is not None:
+        await _sqlite_conn.close()
+        _sqlite_conn = None
+
+
+def new_run_id() -> Optional[str]:
+    return uuid.uuid4().hex if CHECKPOINTS_ENABLED else None
+
+
+def run_config(run_id: Optional[str]) -> Dict[str, Any]:
+    # Each run is its own LangGraph thread
+    return {"configurable": {"thread_id": run_id}} if run_id else {}
+
+
+def run_kwargs() -> Dict[str, Any]:
+    return {"durability": CHECKPOINT_DURABILITY} if CHECKPOINTS_ENABLED else {}
+
+
+async def _delete(run_id: str):
+    try:
+        await _checkpointer.adelete_thread(run_id)
+    except Exception as e:
+        logger.warning(f"Could not delete checkpoints of run {run_id}: {e}")
+
+
+async def run_finished(run_id: Optional[str]):
+    """Drops a completed run's checkpoints; only failed runs are kept for resuming."""
+    if run_id is None or _checkpointer is None:
+        return
+    _failed_runs.pop(run_id, None)
+    await _delete(run_id)
+
+
+def run_failed(run_id: Optional[str]):
+    """Keeps a failed run's checkpoints, dropping the oldest failed runs beyond CHECKPOINT_MAX_FAILED_RUNS."""
+    if run_id is None:
+        return
+    _failed_runs[run_id] = time.time()
+    _failed_runs.move_to_end(run_id)
+    while len(_failed_runs) > CHECKPOINT_MAX_FAILED_RUNS:
+        oldest, _ = _failed_runs.popitem(last=False)
+        asyncio.ensure_future(_delete(oldest))
+    logger.info(f"Run {run_id} failed; completed nodes are checkpointed and can be resumed.")
+
+
+async def ainvoke_run(inputs: Dict[str, Any]) -> Tuple[dict, Optional[str]]:
+    """
+    Runs the graph once as a new run, within the current request deadline if
+    any. Returns (final_state, run_id); failures raise GraphRunError, deadlines
+    RunDeadlineExceeded with what the completed nodes produced.
+    """
+    app = await get_run_app()
+    run_id = new_run_id()
+    final_state, partial_state, completed_nodes = None, dict(inputs), []
+    try:
+        # Node updates arrive as each node finishes, so they are known even when the run stops mid-step
+        async for mode, chunk in app.astream(inputs, run_config(run_id), stream_mode=["updates", "values"], **run_kwargs()):
+            if mode == "values":
+                final_state = chunk
+                continue
+            for node, update in chunk.items():
+                completed_nodes.append(node)
+                partial_state.update(update or {})
+    except DeadlineExceeded as e:
+        run_failed(run_id)
+        raise RunDeadlineExceeded(run_id, e, partial_state, completed_nodes) from e
+    except Exception as e:
+        run_failed(run_id)
+        raise GraphRunError(run_id, e) from e
+    except asyncio.CancelledError:
+        # Client went away or a deadline passed: what finished so far is still resumable
+        run_failed(run_id)
+        raise
+    await run_finished(run_id)
+    return final_state, run_id
+
+
+async def run_status(run_id: str) -> Optional[dict]:
+    """What is known about a kept run, or None if there is none (unknown, completed or dropped)."""
+    if not CHECKPOINTS_ENABLED:
+        return None
+    app = await get_run_app()
+    snapshot = await app.aget_state(run_config(run_id))
+    if snapshot.created_at is None:
+        return None
+    # Nodes of the interrupted step that did finish are already applied to values
+    return {
+        "run_id": run_id,
+        "status": "incomplete" if snapshot.next else "completed",
+        "pending_nodes": list(snapshot.next),
+        "errors": {task.name: str(task.error) for task in snapshot.tasks if task.error is not None},
+        "updated_at": snapshot.created_at,
+        "state": snapshot.values,
+    }
+
+
+async def resume_run(run_id: str) -> dict:
+    """
+    Finishes a kept run from its last checkpoint: only the nodes that did not
+    complete run again. Raises KeyError if the run is not kept and
+    GraphRunError if it fails again (it stays resumable).
+    """
+    if not CHECKPOINTS_ENABLED:
+        raise KeyError(run_id)
+    app = await get_run_app()
+    config = run_config(run_id)
+    snapshot = await app.aget_state(config)
+    if snapshot.created_at is None:
+        raise KeyError(run_id)
+    if not snapshot.next:
+        final_state = snapshot.values
+    else:
+        logger.info(f"Resuming run {run_id} at {list(snapshot.next)}")
+        try:
+            # None as the input continues the thread from its checkpoint
+            final_state = await app.ainvoke(None, config, **run_kwargs())
+        except Exception as e:
+            run_failed(run_id)
+            raise GraphRunError(run_id, e) from e
+    await run_finished(run_id)
+    return final_state
+
+
+def checkpoint_stats() -> dict:
+    return {"backend": CHECKPOINT_BACKEND, "failed_runs_kept": len(_failed_runs)}
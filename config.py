@@ -1,7 +1,13 @@
 # config.py
 import os
+import threading
+import logging
+from typing import Optional
 from dotenv import load_dotenv
-from langchain_openai import AzureChatOpenAI, AzureOpenAIEmbeddings
+from embedding_cache import CachedEmbeddings
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 load_dotenv()
 
@@ -16,25 +22,222 @@ AZURE_OPENAI_API_KEY_EMBEDDING = os.getenv("AZURE_OPENAI_API_KEY_EMBEDDING")
 AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME")
 API_VERSION_EMBEDDING = os.getenv("API_VERSION_EMBEDDING", "2024-02-01")
 
+# Embedding cache: in-memory LRU size and optional SQLite file shared by all workers on the host
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH") # unset = memory only
+# Concurrent query embeddings arriving within this window share one provider request (0 = off)
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "64"))
+
 DB_HOST = os.getenv("DB_HOST")
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 
-# Initialize Azure OpenAI Chat Model
-llm = AzureChatOpenAI(
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    api_key=AZURE_OPENAI_API_KEY,
-    azure_deployment=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME,
-    openai_api_version=API_VERSION,
-    
-)
-
-# Initialize Azure OpenAI Embeddings Model
-embeddings_model = AzureOpenAIEmbeddings(
-    azure_endpoint=AZURE_OPENAI_ENDPOINT_EMBEDDING,
-    api_key=AZURE_OPENAI_API_KEY_EMBEDDING,
-    azure_deployment=AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME,
-    openai_api_version=API_VERSION_EMBEDDING
-)
-print("Configuration loaded and clients initialized.")
\ No newline at end of file
+# Connection pool shared by the pgvector retrievers (see db.py)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "600"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "3600"))
+
+# Retrieval backend for the KB tools: "pgvector" queries Postgres on every call,
+# "memory" serves from an in-process mirror of each table (see vector_index.py)
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "pgvector").lower()
+VECTOR_INDEX_REFRESH_SECONDS = float(os.getenv("VECTOR_INDEX_REFRESH_SECONDS", "60"))
+
+# Per-collection retrieval settings as JSON (see tools.RetrieverConfig), e.g.
+# {"app_kb": {"top_k": 5, "min_score": 0.3, "filters": {"Country": "MY"}, "ef_search": 100}}
+KB_RETRIEVERS = os.getenv("KB_RETRIEVERS")
+KB_TOP_K = int(os.getenv("KB_TOP_K", "3"))
+# ANN index kept on each KB table by kb_index.py: "hnsw", "ivfflat" or "none"
+KB_INDEX_TYPE = os.getenv("KB_INDEX_TYPE", "hnsw").lower()
+KB_HNSW_M = int(os.getenv("KB_HNSW_M", "16"))
+KB_HNSW_EF_CONSTRUCTION = int(os.getenv("KB_HNSW_EF_CONSTRUCTION", "64"))
+# Search-time accuracy/speed knobs, set per session (0 = server default: ef_search 40, probes 1)
+KB_HNSW_EF_SEARCH = int(os.getenv("KB_HNSW_EF_SEARCH", "0"))
+KB_IVFFLAT_PROBES = int(os.getenv("KB_IVFFLAT_PROBES", "0"))
+
+# KB ingestion (see ingest.py): chunk size and overlap in characters, texts per embedding request
+# and embedding requests in flight
+INGEST_CHUNK_CHARS = int(os.getenv("INGEST_CHUNK_CHARS", "2000"))
+INGEST_CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "200"))
+INGEST_EMBED_BATCH_SIZE = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "256"))
+INGEST_EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", "4"))
+
+# Whole-pipeline result cache (see result_cache.py): "memory", "postgres" (shared by all workers) or "none"
+RESULT_CACHE_BACKEND = os.getenv("RESULT_CACHE_BACKEND", "memory").lower()
+RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "86400"))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000"))
+KB_FINGERPRINT_TTL_SECONDS = float(os.getenv("KB_FINGERPRINT_TTL_SECONDS", "60"))
+
+# Opt-in cache of past demands by embedding (see semantic_cache.py): a new demand whose raw input is at
+# least SEMANTIC_CACHE_THRESHOLD cosine-similar to an analyzed one reuses its classifier results.
+# "none", "memory" or "postgres" (shared by all workers)
+SEMANTIC_CACHE_BACKEND = os.getenv("SEMANTIC_CACHE_BACKEND", "none").lower()
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "604800"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+# Classifier nodes whose results are reused (leave out extract_and_classify_applications if
+# reworded demands often name other applications)
+SEMANTIC_CACHE_NODES = [name.strip() for name in os.getenv(
+    "SEMANTIC_CACHE_NODES", "classify_demand,classify_domain,extract_and_classify_applications").split(",") if name.strip()]
+
+# Coalescing of concurrent identical /analyze requests (see singleflight.py)
+SINGLEFLIGHT_WAIT_TIMEOUT_SECONDS = float(os.getenv("SINGLEFLIGHT_WAIT_TIMEOUT_SECONDS", "300"))
+# Also coalesce across workers with a Postgres advisory lock (pairs with RESULT_CACHE_BACKEND=postgres)
+SINGLEFLIGHT_ADVISORY_LOCK = os.getenv("SINGLEFLIGHT_ADVISORY_LOCK", "false").lower() == "true"
+
+# Seconds of silence on /analyze/stream before a keep-alive is written
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+
+# Batch analysis (see batch.py)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))         # default graph runs in flight per batch
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "32")) # upper bound a caller may request
+EXTRACTION_BATCH_SIZE = int(os.getenv("EXTRACTION_BATCH_SIZE", "5"))  # demands per extraction call (1 = no batching)
+
+# classify_demand / classify_domain execution mode: "agent" (tool-calling AgentExecutor loop) or
+# "single_shot" (embed once, fetch SINGLE_SHOT_TOP_K KB rows, one structured-output LLM call)
+CLASSIFY_DEMAND_MODE = os.getenv("CLASSIFY_DEMAND_MODE", "agent").lower()
+CLASSIFY_DOMAIN_MODE = os.getenv("CLASSIFY_DOMAIN_MODE", "agent").lower()
+SINGLE_SHOT_TOP_K = int(os.getenv("SINGLE_SHOT_TOP_K", "5"))
+
+# Application-name extraction: "dictionary" matches app_kb names/aliases in the demand and only
+# calls the LLM extractor when nothing matches; "llm" always uses the LLM extractor
+APP_EXTRACTION_MODE = os.getenv("APP_EXTRACTION_MODE", "dictionary").lower()
+APP_ALIASES_PATH = os.getenv("APP_ALIASES_PATH") # optional JSON {alias: application name}
+APP_DICTIONARY_REFRESH_SECONDS = float(os.getenv("APP_DICTIONARY_REFRESH_SECONDS", "300"))
+
+# Ownership lookup for extracted applications: "directory" does one indexed app_kb query for all
+# names (vector search only for names without a row); "agent" uses the application agent
+APPLICATION_LOOKUP_MODE = os.getenv("APPLICATION_LOOKUP_MODE", "directory").lower()
+APP_DIRECTORY_CACHE_TTL_SECONDS = float(os.getenv("APP_DIRECTORY_CACHE_TTL_SECONDS", "300"))
+# Minimum similarity for a vector-search hit to be accepted for a name with no exact row
+APP_VECTOR_MATCH_MIN_SCORE = float(os.getenv("APP_VECTOR_MATCH_MIN_SCORE", "0.8"))
+
+# format_output: "template" renders the report in Python from the typed node results,
+# "llm" uses the original LLM formatter. The fallback sends unparseable results to the LLM.
+FORMAT_OUTPUT_MODE = os.getenv("FORMAT_OUTPUT_MODE", "template").lower()
+FORMAT_OUTPUT_LLM_FALLBACK = os.getenv("FORMAT_OUTPUT_LLM_FALLBACK", "false").lower() == "true"
+
+# Optional OpenTelemetry spans (needs opentelemetry-sdk and opentelemetry-exporter-otlp), e.g. http://localhost:4318/v1/traces
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "demand-analysis-agent")
+
+# Per-node checkpoints of each graph run (see checkpoints.py): "memory" (this worker only), "sqlite",
+# "postgres" (the KB database; survives restarts, shared by all workers) or "none". A failed run can
+# be finished with POST /runs/{run_id}/resume, which re-runs only the nodes that did not complete.
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "memory").lower()
+CHECKPOINT_SQLITE_PATH = os.getenv("CHECKPOINT_SQLITE_PATH", "checkpoints.sqlite")
+# "async" writes a step's checkpoint while the next step runs, "sync" before it starts, "exit" only when the run ends
+CHECKPOINT_DURABILITY = os.getenv("CHECKPOINT_DURABILITY", "async").lower()
+# Completed runs are deleted at once; beyond this many failed runs the oldest are dropped
+CHECKPOINT_MAX_FAILED_RUNS = int(os.getenv("CHECKPOINT_MAX_FAILED_RUNS", "1000"))
+
+# Asynchronous jobs (see jobs.py): POST /jobs queues a demand in Postgres, job workers run it and
+# GET /jobs/{id} returns its status and result. Workers run inside each API process (JOB_WORKERS)
+# and/or as separate processes (`python jobs.py --workers N`).
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "0"))                # in-process job workers per API worker (0 = none, opt-in)
+JOB_MAX_QUEUE_DEPTH = int(os.getenv("JOB_MAX_QUEUE_DEPTH", "500"))  # POST /jobs answers 429 once this many jobs are queued
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))   # a job whose worker stops renewing this is run again
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", "604800")) # finished jobs are deleted after this
+
+# Client-side LLM scheduler (see llm_scheduler.py). Every chat completion waits for a slot under
+# these limits, highest demand priority first. The limits are per process: give each worker its
+# share of the deployment's quota (e.g. RPM / WEB_CONCURRENCY). 0 = no limit.
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "0"))
+LLM_BUCKET_BURST_SECONDS = float(os.getenv("LLM_BUCKET_BURST_SECONDS", "10")) # quota a full bucket may spend at once
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "120"))
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "512")) # reserved per call until usage is known
+# Retries of throttled (429, honouring retry-after) and transient failures; replaces the client's own retries
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "1"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "30"))
+
+# --- Model routing ---
+# Extra named chat deployments as JSON, e.g. {"fast": {"deployment": "gpt-4o-mini", "timeout": 20}};
+# "default" is the AZURE_OPENAI_CHAT_DEPLOYMENT_NAME one (see model_registry.py)
+LLM_MODELS = os.getenv("LLM_MODELS")
+# Stage -> model name as JSON, e.g. {"extract_information": "fast", "format_output": "fast"}; unmapped stages use "default"
+LLM_NODE_MODELS = os.getenv("LLM_NODE_MODELS")
+# Request timeout of the chat client(s); unset keeps the client default
+LLM_REQUEST_TIMEOUT_SECONDS = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS")) if os.getenv("LLM_REQUEST_TIMEOUT_SECONDS") else None
+
+# --- Deadlines and hedging ---
+# Time budget of one /analyze (or batch item) run; on expiry the completed nodes are returned as a partial result (0 = none)
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "0"))
+# Time budget of each graph node (0 = none), and per-node overrides as JSON, e.g. {"format_output": 30}
+NODE_DEADLINE_SECONDS = float(os.getenv("NODE_DEADLINE_SECONDS", "0"))
+NODE_DEADLINES = os.getenv("NODE_DEADLINES")
+# A model with a "hedge_model" (LLM_MODELS) duplicates a call to it once the call is slower than this
+# percentile of its recent latencies; until enough calls were seen, LLM_HEDGE_DELAY_SECONDS is used
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "50"))
+LLM_HEDGE_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "20"))
+
+# Max number of graph nodes run in parallel within a step (unset/0 = no limit)
+GRAPH_MAX_CONCURRENCY = int(os.getenv("GRAPH_MAX_CONCURRENCY", "0")) or None
+
+# The Azure clients are built on first use, not at import: importing the app (or
+# a test) stays cheap, and under gunicorn --preload they are built once in the master.
+_llm = None
+_embeddings_model = None
+_clients_lock = threading.Lock()
+
+
+def get_llm(node: Optional[str] = None):
+    """
+    The Azure OpenAI chat model for a graph stage (see model_registry.py), rate
+    limited by the LLM scheduler. Clients installed by set_clients serve every stage.
+    """
+    if _llm is not None:
+        return _llm
+    from model_registry import MODEL_REGISTRY
+    return MODEL_REGISTRY.for_node(node)
+
+
+def get_embeddings_model() -> CachedEmbeddings:
+    """The shared Azure OpenAI embeddings client, behind the embedding cache."""
+    global _embeddings_model
+    if _embeddings_model is None:
+        with _clients_lock:
+            if _embeddings_model is None:
+                from langchain_openai import AzureOpenAIEmbeddings
+                _embeddings_model = CachedEmbeddings(
+                    AzureOpenAIEmbeddings(
+                        azure_endpoint=AZURE_OPENAI_ENDPOINT_EMBEDDING,
+                        api_key=AZURE_OPENAI_API_KEY_EMBEDDING,
+                        azure_deployment=AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME,
+                        openai_api_version=API_VERSION_EMBEDDING
+                    ),
+                    deployment_name=AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME,
+                    max_size=EMBEDDING_CACHE_SIZE,
+                    sqlite_path=EMBEDDING_CACHE_PATH,
+                    batch_window_ms=EMBEDDING_BATCH_WINDOW_MS,
+                    max_batch=EMBEDDING_BATCH_MAX_SIZE,
+                )
+                logger.info("Azure OpenAI embeddings client initialized.")
+    return _embeddings_model
+
+
+def set_clients(llm=None, embeddings_model: Optional[CachedEmbeddings] = None):
+    """Installs other clients (e.g. the benchmark fakes); the chat model then serves every stage. Call before the first graph run."""
+    global _llm, _embeddings_model
+    with _clients_lock:
+        if llm is not None:
+            _llm = llm
+        if embeddings_model is not None:
+            _embeddings_model = embeddings_model
+
+
+def __getattr__(name: str):
+    # Keeps `config.llm` / `config.embeddings_model` working for scripts, lazily
+    if name == "llm":
+        return get_llm()
+    if name == "embeddings_model":
+        return get_embeddings_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,156 @@
+# db.py
+import threading
+import asyncio
+import logging
+from psycopg import AsyncConnection
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import ConnectionPool, AsyncConnectionPool
+from pgvector.psycopg import register_vector, register_vector_async
+
+from config import (
+    DB_HOST, DB_NAME, DB_USER, DB_PASSWORD,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_IDLE, DB_POOL_MAX_LIFETIME,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# One sync and one async pool per process, shared by every KB retriever.
+# They are created lazily on first use so that gunicorn workers open their own
+# connections after the fork instead of inheriting sockets from the master.
+_pool = None
+_async_pool = None
+_pool_lock = threading.Lock()
+_async_pool_lock = None
+# Session advisory locks (singleflight.py) live outside the pools: a lock is held
+# for a whole graph run, whose retrievers need pool connections themselves
+_lock_conn = None
+_lock_conn_lock = None
+
+
+def _conninfo() -> str:
+    return make_conninfo(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+
+
+def _pool_kwargs() -> dict:
+    return dict(
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,          # how long a caller waits for a free connection
+        max_idle=DB_POOL_MAX_IDLE,        # idle connections above min_size are closed after this
+        max_lifetime=DB_POOL_MAX_LIFETIME,  # connections are recycled after this, even if healthy
+        # autocommit so a pooled connection never sits "idle in transaction" between queries
+        kwargs={"autocommit": True},
+    )
+
+
+def _configure(conn):
+    # Runs once per physical connection, not once per query
+    register_vector(conn)
+
+
+async def _aconfigure(conn):
+    await register_vector_async(conn)
+
+
+def get_pool() -> ConnectionPool:
+    """Returns the process-wide sync pool, opening it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                logger.info(f"Opening Postgres pool (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+                _pool = ConnectionPool(
+                    _conninfo(),
+                    configure=_configure,
+                    # Health check on checkout: broken connections are discarded and replaced
+                    check=ConnectionPool.check_connection,
+                    name="kb-sync",
+                    open=True,
+                    **_pool_kwargs(),
+                )
+    return _pool
+
+
+async def get_async_pool() -> AsyncConnectionPool:
+    """Returns the process-wide async pool, opening it on first use."""
+    global _async_pool, _async_pool_lock
+    if _async_pool is None:
+        if _async_pool_lock is None:
+            _async_pool_lock = asyncio.Lock()
+        async with _async_pool_lock:
+            if _async_pool is None:
+                logger.info(f"Opening async Postgres pool (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+                pool = AsyncConnectionPool(
+                    _conninfo(),
+                    configure=_aconfigure,
+                    check=AsyncConnectionPool.check_connection,
+                    name="kb-async",
+                    open=False,
+                    **_pool_kwargs(),
+                )
+                await pool.open()
+                _async_pool = pool
+    return _async_pool
+
+
+async def get_lock_connection() -> AsyncConnection:
+    """
+    The process's one connection for session advisory locks, (re)opened on use.
+    Any number of locks share it; if it drops, the server releases all of them.
+    """
+    global _lock_conn, _lock_conn_lock
+    if _lock_conn is None or _lock_conn.closed:
+        if _lock_conn_lock is None:
+            _lock_conn_lock = asyncio.Lock()
+        async with _lock_conn_lock:
+            if _lock_conn is None or _lock_conn.closed:
+                _lock_conn = await AsyncConnection.connect(_conninfo(), autocommit=True, connect_timeout=max(1, int(DB_POOL_TIMEOUT)))
+    return _lock_conn
+
+
+def pool_stats() -> dict:
+    """Connection counters for whichever pools have been opened."""
+    stats = {}
+    if _pool is not None:
+        stats["sync"] = _pool.get_stats()
+    if _async_pool is not None:
+        stats["async"] = _async_pool.get_stats()
+    return stats
+
+
+def close_pools():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
+async def aclose_pools():
+    global _async_pool, _lock_conn
+    if _lock_conn is not None:
+        await _lock_conn.close()
+        _lock_conn = None
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+    close_pools()
+
+
+def table_watermark(conn, table_name: str):
+    """
+    Cheap change detector for a KB table: (row count, highest xmin).
+    Any INSERT/UPDATE creates a tuple with a newer xmin and any DELETE changes
+    the count, so an unchanged watermark means the table content is unchanged.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*), coalesce(max(xmin::text::bigint), 0) FROM {table_name}")
+        count, max_xmin = cur.fetchone()
+    return int(count), int(max_xmin)
+
+
+async def atable_watermark(conn, table_name: str):
+    async with conn.cursor() as cur:
+        await cur.execute(f"SELECT count(*), coalesce(max(xmin::text::bigint), 0) FROM {table_name}")
+        count, max_xmin = await cur.fetchone()
+    return int(count), int(max_xmin)
@@ -0,0 +1,78 @@
+# deadlines.py
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import time
+import logging
+from typing import Callable, Dict, Optional
+
+from config import NODE_DEADLINE_SECONDS, NODE_DEADLINES
+from metrics import DEADLINES_EXCEEDED
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# time.monotonic() by which the graph run started in this context must finish; None = no deadline.
+# Graph nodes run in copies of the caller's context, so it reaches every node of the run.
+_deadline: contextvars.ContextVar = contextvars.ContextVar("request_deadline", default=None)
+
+# Per-node time budgets overriding NODE_DEADLINE_SECONDS (0 = none)
+NODE_BUDGETS: Dict[str, float] = {name: float(seconds) for name, seconds in json.loads(NODE_DEADLINES or "{}").items()}
+
+
+class DeadlineExceeded(RuntimeError):
+    """A graph node ran out of its own time budget ("node") or of the request's ("request")."""
+
+    def __init__(self, node: str, scope: str, seconds: float):
+        super().__init__(f"Node {node} stopped by the {scope} deadline after {seconds:.1f}s")
+        self.node = node
+        self.scope = scope
+
+
+@contextlib.contextmanager
+def request_deadline(seconds: Optional[float]):
+    """Graph runs started inside this block must finish within `seconds` (None/0 = no deadline)."""
+    token = _deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current request's deadline, or None without one."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def bound_node(name: str, func: Callable, afunc: Callable):
+    """
+    Wraps a node's async implementation so it is cancelled once its own budget
+    or the request's remaining time runs out, whichever is sooner; its LLM calls
+    (queued, retried or hedged) are cancelled with it. The sync implementation
+    is returned as is: a thread cannot be cancelled.
+    """
+    budget = NODE_BUDGETS.get(name, NODE_DEADLINE_SECONDS)
+
+    @functools.wraps(afunc)
+    async def abounded(state):
+        left = remaining()
+        if left is not None and (not budget or left < budget):
+            timeout, scope = left, "request"
+        elif budget:
+            timeout, scope = budget, "node"
+        else:
+            return await afunc(state)
+        if timeout <= 0:
+            DEADLINES_EXCEEDED.labels(name, scope).inc()
+            raise DeadlineExceeded(name, scope, 0)
+        try:
+            return await asyncio.wait_for(afunc(state), timeout)
+        except asyncio.TimeoutError:
+            DEADLINES_EXCEEDED.labels(name, scope).inc()
+            logger.warning(f"Node {name} stopped after {timeout:.1f}s ({scope} deadline)")
+            raise DeadlineExceeded(name, scope, timeout) from None
+
+    return func, abounded
@@ -0,0 +1,276 @@
+# embedding_cache.py
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import weakref
+import time
+import logging
+from array import array
+from collections import OrderedDict
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from metrics import embedding_timer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def normalize_text(text: str) -> str:
+    """Collapses whitespace and case so trivially different queries share a cache entry."""
+    return " ".join(text.split()).casefold()
+
+
+class _SqliteTier:
+    """
+    Persistent second tier. SQLite in WAL mode lets every gunicorn worker on the
+    host read and write the same file, and the entries survive restarts.
+    Vectors are stored as raw float64 so a disk hit is bit-identical to the API result.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Opened on first use and again after a fork: a SQLite handle must not be shared
+        # between processes (the app may be built in a gunicorn master with --preload)
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            row = self._connection().execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return array("d", row[0]).tolist()
+
+    def put(self, key: str, vector: List[float]):
+        blob = array("d", vector).tobytes()
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, created_at) VALUES (?, ?, ?)",
+                    (key, blob, time.time()),
+                )
+                conn.commit()
+        except sqlite3.Error as e:
+            # The disk tier is best effort; a locked/full database must not fail the request
+            logger.warning(f"Could not persist embedding to disk cache: {e}")
+
+
+class _QueryBatcher:
+    """
+    Coalesces aembed_query calls that arrive within `window` seconds of each other
+    into one embed_documents request (up to max_batch texts). Under concurrency
+    (batch runs, parallel agents) this turns many provider round trips into a few.
+    """
+
+    def __init__(self, embeddings: Embeddings, window: float, max_batch: int):
+        self.embeddings = embeddings
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        # Sends in flight: the event loop only holds weak references to tasks
+        self._tasks = set()
+        self.requests = 0 # provider calls made
+        self.texts = 0    # texts sent in them
+
+    async def embed(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        self.requests += 1
+        self.texts += len(batch)
+        try:
+            with embedding_timer("batched_query", len(batch)):
+                vectors = await self.embeddings.aembed_documents([text for text, _ in batch])
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            # Also on cancellation (e.g. at loop shutdown): no caller may be left waiting
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("The batched embedding request was cancelled or returned no vector for this text"))
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an Embeddings client with a bounded in-memory LRU and an optional
+    SQLite tier. Keys are the normalized text plus the deployment name, so
+    switching embedding deployments never serves stale vectors.
+    """
+
+    def __init__(self, embeddings: Embeddings, deployment_name: str, max_size: int = 2048, sqlite_path: Optional[str] = None,
+                 batch_window_ms: float = 0, max_batch: int = 64):
+        self.embeddings = embeddings
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self._batchers = weakref.WeakKeyDictionary() # one per event loop; futures cannot cross loops
+        self._inflight = {}
+        self.deployment_name = deployment_name or ""
+        self.max_size = max_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = _SqliteTier(sqlite_path) if sqlite_path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.deployment_name}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector
+        if self._disk is not None:
+            vector = self._disk.get(key)
+            if vector is not None:
+                self._remember(key, vector)
+                with self._lock:
+                    self.disk_hits += 1
+                return vector
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key: str, vector: List[float]):
+        with self._lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+                self.evictions += 1
+
+    def _store(self, key: str, vector: List[float]):
+        self._remember(key, vector)
+        if self._disk is not None:
+            self._disk.put(key, vector)
+
+    # --- Embeddings interface ---
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._lookup(key)
+        if vector is None:
+            with embedding_timer("query", 1):
+                vector = self.embeddings.embed_query(text)
+            self._store(key, vector)
+        return vector
+
+    def _batcher(self) -> Optional[_QueryBatcher]:
+        if self.batch_window <= 0:
+            return None
+        loop = asyncio.get_running_loop()
+        batcher = self._batchers.get(loop)
+        if batcher is None:
+            batcher = self._batchers[loop] = _QueryBatcher(self.embeddings, self.batch_window, self.max_batch)
+        return batcher
+
+    async def _afetch(self, key: str, text: str) -> List[float]:
+        batcher = self._batcher()
+        if batcher is not None:
+            # Same vector as embed_query: the OpenAI client embeds queries and documents identically
+            vector = await batcher.embed(text)
+        else:
+            with embedding_timer("query", 1):
+                vector = await self.embeddings.aembed_query(text)
+        self._store(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._lookup(key)
+        if vector is not None:
+            return vector
+        # Parallel nodes often embed the same text at the same moment: share one request
+        task = self._inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(self._afetch(key, text))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+        return await asyncio.shield(task)
+
+    def _split_cached(self, texts: List[str]):
+        keys = [self._key(t) for t in texts]
+        vectors = [self._lookup(k) for k in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        return keys, vectors, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, missing = self._split_cached(texts)
+        if missing:
+            # Only the uncached texts go to the provider, in a single request
+            with embedding_timer("documents", len(missing)):
+                fresh = self.embeddings.embed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                vectors[i] = vector
+                self._store(keys[i], vector)
+        return vectors
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, vectors, missing = self._split_cached(texts)
+        if missing:
+            with embedding_timer("documents", len(missing)):
+                fresh = await self.embeddings.aembed_documents([texts[i] for i in missing])
+            for i, vector in zip(missing, fresh):
+                vectors[i] = vector
+                self._store(keys[i], vector)
+        return vectors
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._memory),
+                "max_size": self.max_size,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "batched_requests": sum(b.requests for b in list(self._batchers.values())),
+                "batched_texts": sum(b.texts for b in list(self._batchers.values())),
+            }
@@ -1,26 +1,74 @@
 # graph.py
-from langgraph.graph import StateGraph, END
+import threading
+import logging
 from state import WorkflowState
+from config import GRAPH_MAX_CONCURRENCY
+from metrics import instrument_node, metrics_callback
+from llm_scheduler import prioritize
+from deadlines import bound_node
+from semantic_cache import semantic_node
 import nodes as nodes
 
-# This file builds and compiles the app, which can then be imported
-workflow = StateGraph(WorkflowState)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
-workflow.add_node("extract_information", nodes.extract_information)
-workflow.add_node("classify_demand", nodes.classify_demand)
-workflow.add_node("classify_domain", nodes.classify_domain)
-workflow.add_node("extract_and_classify_applications", nodes.extract_and_classify_applications)
-workflow.add_node("format_output", nodes.format_output)
+# The three classifiers only read 'extracted_info' and each writes its own state key,
+# so they fan out from the extractor and run in the same superstep.
+CLASSIFIER_NODES = ["classify_demand", "classify_domain", "extract_and_classify_applications"]
 
 
+def build_graph(checkpointer=None):
+    """
+    Builds and compiles the workflow. Use get_app() for the shared compiled copy, or
+    checkpoints.get_run_app() for the same copy with the worker's checkpointer attached.
+    """
+    from langgraph.graph import StateGraph, END
+    from langchain_core.runnables import RunnableLambda
 
-workflow.set_entry_point("extract_information")
-workflow.add_edge("extract_information", "classify_demand")
-workflow.add_edge("classify_demand", "classify_domain")
-workflow.add_edge("classify_domain", "extract_and_classify_applications")
-workflow.add_edge("extract_and_classify_applications", "format_output")
-workflow.add_edge("format_output",END)
+    workflow = StateGraph(WorkflowState)
 
+    # Every node has a sync and an async implementation: invoke() runs the sync one,
+    # ainvoke()/astream() the async one. Both are timed per node (metrics.py), and
+    # their LLM calls queue with the demand's priority (llm_scheduler.py). The async
+    # one is also bounded by the node's and the request's deadline (deadlines.py), and
+    # can be answered from a near-duplicate earlier demand (semantic_cache.py).
+    for name in ["extract_information", *CLASSIFIER_NODES, "format_output"]:
+        func, afunc = bound_node(name, *prioritize(*semantic_node(name, getattr(nodes, name), getattr(nodes, f"a{name}"))))
+        workflow.add_node(name, RunnableLambda(*instrument_node(name, func, afunc)))
 
-app = workflow.compile()
-print("LangGraph app compiled successfully.")
\ No newline at end of file
+    workflow.set_entry_point("extract_information")
+    for node_name in CLASSIFIER_NODES:
+        workflow.add_edge("extract_information", node_name)
+    # Fan-in: format_output only runs once all three branches have finished
+    workflow.add_edge(CLASSIFIER_NODES, "format_output")
+    workflow.add_edge("format_output",END)
+
+    app = workflow.compile(checkpointer=checkpointer)
+    # Attributes LLM calls, tokens and agent iterations to the node they ran in
+    app = app.with_config(callbacks=[metrics_callback])
+    if GRAPH_MAX_CONCURRENCY:
+        # Caps how many branches of a superstep run at once (e.g. 1 restores the old serial behaviour)
+        app = app.with_config(max_concurrency=GRAPH_MAX_CONCURRENCY)
+    return app
+
+
+_app = None
+_app_lock = threading.Lock()
+
+
+def get_app():
+    """The process-wide compiled graph, compiled on first use."""
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                _app = build_graph()
+                logger.info("LangGraph app compiled successfully.")
+    return _app
+
+
+def __getattr__(name: str):
+    # `from graph import app` keeps working; it compiles on first access
+    if name == "app":
+        return get_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,28 @@
+# gunicorn.conf.py
+# Run with: gunicorn -c gunicorn.conf.py
+import gc
+import os
+
+wsgi_app = "backend:api"
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# Agent runs can take a minute; don't let the arbiter kill a busy worker
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+# Import the app once in the master and fork workers from it
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+
+def on_starting(server):
+    if not preload_app:
+        return
+    # Build the clients, chains, agents and compiled graph before forking, so every
+    # worker starts with them (shared copy-on-write). Nothing here opens a socket
+    # or starts a thread; pools, KB caches and refreshers are per worker (startup.warm_up).
+    from startup import preload
+    preload()
+    # Keep the preloaded objects out of the collector's generations, so the first
+    # gc pass in a worker does not touch (and un-share) their pages
+    gc.freeze()
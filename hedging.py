@@ -0,0 +1,109 @@
+# hedging.py
+import asyncio
+import math
+import threading
+import time
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+from config import LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES, LLM_HEDGE_DELAY_SECONDS
+from metrics import LLM_HEDGES, LLM_HEDGES_WON
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class LatencyTracker:
+    """The last `window` call latencies of one model, for its hedge delay."""
+
+    def __init__(self, window: int = 500):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < max(1, min_samples):
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+# Model name -> function returning the client its slow calls are duplicated to (registered by model_registry.py)
+_HEDGE_TARGETS: Dict[str, Callable[[], object]] = {}
+_LATENCIES: Dict[str, LatencyTracker] = {}
+
+
+def register_hedge(model_name: str, get_hedge_client: Callable[[], object]):
+    _HEDGE_TARGETS[model_name] = get_hedge_client
+    _LATENCIES.setdefault(model_name, LatencyTracker())
+
+
+def hedge_target(model_name: Optional[str]):
+    get_hedge_client = _HEDGE_TARGETS.get(model_name)
+    return get_hedge_client() if get_hedge_client is not None else None
+
+
+def hedge_delay(model_name: str) -> float:
+    """How long a call waits for the primary before it is duplicated."""
+    observed = _LATENCIES[model_name].percentile(LLM_HEDGE_PERCENTILE, LLM_HEDGE_MIN_SAMPLES)
+    return observed if observed is not None else LLM_HEDGE_DELAY_SECONDS
+
+
+async def ahedged(model_name: str, primary: Callable[[], Awaitable], hedge: Callable[[], Awaitable]):
+    """
+    Runs primary(); if it has not answered after hedge_delay(model_name), also
+    runs hedge() and returns whichever answers first, cancelling the other. A
+    failure only counts once both failed (the primary's error is raised). If
+    the caller is cancelled (a deadline, a client gone), both calls are cancelled
+    with it. Only completions are hedged: a streamed call has already handed
+    tokens to its caller by the time it is slow.
+    """
+    tracker = _LATENCIES[model_name]
+    start = time.perf_counter()
+    primary_task = asyncio.ensure_future(primary())
+    hedge_task = None
+    try:
+        done, _ = await asyncio.wait({primary_task}, timeout=hedge_delay(model_name))
+        if done:
+            tracker.observe(time.perf_counter() - start)
+            return primary_task.result()
+
+        LLM_HEDGES.labels(model_name).inc()
+        logger.info(f"Chat model call to '{model_name}' still running after {time.perf_counter() - start:.1f}s; hedging")
+        hedge_task = asyncio.ensure_future(hedge())
+        pending = {primary_task, hedge_task}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is hedge_task:
+                        LLM_HEDGES_WON.labels(model_name).inc()
+                    else:
+                        tracker.observe(time.perf_counter() - start)
+                    return task.result()
+        return primary_task.result()
+    finally:
+        unfinished = [task for task in (primary_task, hedge_task) if task is not None and not task.done()]
+        if hedge_task is not None and primary_task in unfinished:
+            # Censored: the primary took at least this long
+            tracker.observe(time.perf_counter() - start)
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            # Wait for the cancellations, so no call keeps its scheduler slot (or spends tokens) after this returns
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+
+def hedge_stats() -> dict:
+    return {
+        name: {"samples": len(tracker), "delay_seconds": round(hedge_delay(name), 3)}
+        for name, tracker in _LATENCIES.items()
+    }
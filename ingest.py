@@ -0,0 +1,308 @@
+# ingest.py
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import time
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+from psycopg.types.json import Jsonb
+
+from config import (
+    get_embeddings_model, AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME,
+    INGEST_CHUNK_CHARS, INGEST_CHUNK_OVERLAP, INGEST_EMBED_BATCH_SIZE, INGEST_EMBED_CONCURRENCY,
+)
+from db import get_async_pool
+from tools import KB_COLLECTIONS
+from app_directory import APP_KB_TABLE, APP_KB_COLUMNS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Metadata keys set by the ingestion; every other key comes from the source
+SOURCE_KEY = "source"
+HASH_KEY = "content_hash"
+
+# CSV columns copied into each row's metadata when none are given (app_kb: the key of the keyed lookup,
+# plus the columns retriever filters usually select on, see tools.RetrieverConfig)
+DEFAULT_METADATA_COLUMNS = {APP_KB_TABLE: [APP_KB_COLUMNS[0], "Country", "Platform"]}
+
+# (content, metadata) of one row of a KB table
+Chunk = Tuple[str, dict]
+
+
+def _splitter(chunk_chars: int, chunk_overlap: int):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    # Paragraphs first, then lines, then words: a chunk only breaks mid-sentence if it has to
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_chars, chunk_overlap=chunk_overlap)
+
+
+def read_csv(path: str, metadata_columns: List[str]) -> Iterator[Chunk]:
+    """One row per CSV record, in the 'Column: value' layout the app_kb rows use (see app_directory.parse_app_row)."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for record in csv.DictReader(f):
+            values = {k.strip(): (v or "").strip() for k, v in record.items() if k}
+            content = "\n".join(f"{k}: {v}" for k, v in values.items() if v)
+            if content:
+                yield content, {k: values[k] for k in metadata_columns if values.get(k)}
+
+
+def read_jsonl(path: str, chunk_chars: int, chunk_overlap: int) -> Iterator[Chunk]:
+    """One document per line: a string, or an object with "content" (or "text") and an optional "metadata" object."""
+    splitter = _splitter(chunk_chars, chunk_overlap)
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            if isinstance(document, str):
+                text, metadata = document, {}
+            elif isinstance(document, dict) and isinstance(document.get("content", document.get("text")), str):
+                text, metadata = document.get("content", document.get("text")), dict(document.get("metadata") or {})
+            else:
+                raise ValueError(f"{path}:{line_number}: expected a string or an object with a 'content' string")
+            for piece in splitter.split_text(text):
+                yield piece, dict(metadata)
+
+
+def read_markdown(path: str, chunk_chars: int, chunk_overlap: int) -> Iterator[Chunk]:
+    """Splits at headings, then by size; every chunk starts with its heading path, also kept as "section"."""
+    from langchain_text_splitters import MarkdownHeaderTextSplitter
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    by_heading = MarkdownHeaderTextSplitter([("#", "h1"), ("##", "h2"), ("###", "h3")])
+    splitter = _splitter(chunk_chars, chunk_overlap)
+    for section in by_heading.split_text(text):
+        heading = " > ".join(section.metadata[h] for h in ("h1", "h2", "h3") if section.metadata.get(h))
+        for piece in splitter.split_text(section.page_content):
+            yield (f"{heading}\n\n{piece}", {"section": heading}) if heading else (piece, {})
+
+
+def read_source(path: str, collection_name: str, metadata_columns: Optional[List[str]] = None,
+                chunk_chars: int = INGEST_CHUNK_CHARS, chunk_overlap: int = INGEST_CHUNK_OVERLAP) -> Iterator[Chunk]:
+    """Streams the chunks of one source file, by extension (.csv, .jsonl/.ndjson, .md/.markdown)."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        columns = metadata_columns if metadata_columns is not None else DEFAULT_METADATA_COLUMNS.get(collection_name, [])
+        return read_csv(path, columns)
+    if extension in (".jsonl", ".ndjson"):
+        return read_jsonl(path, chunk_chars, chunk_overlap)
+    if extension in (".md", ".markdown"):
+        return read_markdown(path, chunk_chars, chunk_overlap)
+    raise ValueError(f"Don't know how to ingest '{path}' (expected .csv, .jsonl or .md)")
+
+
+def content_hash(content: str, metadata: dict) -> str:
+    """
+    Identity of a row: its content, its metadata (except the source file name, so a
+    renamed or moved file is not re-embedded) and the embedding deployment.
+    A row whose hash is already in the table is not re-embedded.
+    """
+    metadata = {k: v for k, v in metadata.items() if k not in (SOURCE_KEY, HASH_KEY)}
+    payload = json.dumps([AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME or "", content, metadata], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _tag(chunks: Iterable[Chunk], source: str) -> Iterator[Chunk]:
+    for content, metadata in chunks:
+        metadata = {**metadata, SOURCE_KEY: source}
+        metadata[HASH_KEY] = content_hash(content, metadata)
+        yield content, metadata
+
+
+async def _ensure_table(conn, collection_name: str, dims: int):
+    # The KB tables normally exist already; this creates a new collection in the same layout
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {collection_name} (
+            id bigserial PRIMARY KEY,
+            content text NOT NULL,
+            metadata jsonb,
+            embedding vector({dims})
+        )""")
+
+
+async def _existing_hashes(conn, collection_name: str) -> Optional[Dict[str, Optional[str]]]:
+    """content_hash -> source of the ingested rows (rows loaded some other way have no hash); None if there is no table."""
+    cur = await conn.execute("SELECT to_regclass(%s) IS NOT NULL", (collection_name,))
+    if not (await cur.fetchone())[0]:
+        return None
+    cur = await conn.execute(
+        f"SELECT metadata->>'{HASH_KEY}', metadata->>'{SOURCE_KEY}' FROM {collection_name} WHERE metadata ? '{HASH_KEY}'")
+    return {row_hash: source for row_hash, source in await cur.fetchall()}
+
+
+def _windows(chunks: Iterable[Chunk], size: int) -> Iterator[List[Chunk]]:
+    window = []
+    for chunk in chunks:
+        window.append(chunk)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+async def _embed(embeddings, chunks: List[Chunk], batch_size: int) -> List[np.ndarray]:
+    """Embeds one window of chunks as concurrent embed_documents requests of batch_size texts."""
+    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
+    results = await asyncio.gather(*(embeddings.aembed_documents([content for content, _ in batch]) for batch in batches))
+    return [np.asarray(vector, dtype=np.float32) for vectors in results for vector in vectors]
+
+
+async def _copy_rows(conn, collection_name: str, chunks: List[Chunk], vectors: List[np.ndarray]):
+    async with conn.cursor() as cur:
+        # Binary COPY: no per-row statements and no text round trip for the vectors
+        async with cur.copy(f"COPY {collection_name} (content, metadata, embedding) FROM STDIN WITH (FORMAT BINARY)") as copy:
+            copy.set_types(["text", "jsonb", "vector"])
+            for (content, metadata), vector in zip(chunks, vectors):
+                await copy.write_row((content, Jsonb(metadata), vector))
+
+
+def _uncached_embeddings():
+    """
+    The embedding client behind the query cache (embedding_cache.CachedEmbeddings):
+    chunk vectors are never queried again, and would only evict hot query
+    embeddings and grow the cache's SQLite file.
+    """
+    embeddings = get_embeddings_model()
+    return getattr(embeddings, "embeddings", embeddings)
+
+
+async def _load(conn, collection_name: str, chunks: Iterable[Chunk], batch_size: int, window_size: int, report: dict):
+    """Embeds and COPYs the chunks window by window; the next window is embedded while the previous one is written."""
+    embeddings = _uncached_embeddings()
+    table_ready = False
+    pending = None # (window, its embedding task)
+    try:
+        for window in _windows(chunks, window_size):
+            task = asyncio.ensure_future(_embed(embeddings, window, batch_size))
+            if pending is not None:
+                await _write(conn, collection_name, *pending, table_ready, report)
+                table_ready = True
+            pending = (window, task)
+        if pending is not None:
+            await _write(conn, collection_name, *pending, table_ready, report)
+            pending = None
+    finally:
+        if pending is not None:
+            pending[1].cancel()
+
+
+async def _write(conn, collection_name: str, window: List[Chunk], task, table_ready: bool, report: dict):
+    vectors = await task
+    if not table_ready:
+        await _ensure_table(conn, collection_name, len(vectors[0]))
+    await _copy_rows(conn, collection_name, window, vectors)
+    report["embedded"] += len(window)
+    logger.info(f"{collection_name}: {report['embedded']} chunks embedded and loaded, {report['unchanged']} unchanged so far")
+
+
+async def _delete_stale(conn, collection_name: str, stale_hashes: List[str], include_unhashed: bool, dry_run: bool) -> int:
+    condition = f"metadata->>'{HASH_KEY}' = ANY(%s)"
+    if include_unhashed:
+        condition += f" OR metadata IS NULL OR NOT metadata ? '{HASH_KEY}'"
+    if dry_run:
+        cur = await conn.execute(f"SELECT count(*) FROM {collection_name} WHERE {condition}", (stale_hashes,))
+        return (await cur.fetchone())[0]
+    cur = await conn.execute(f"DELETE FROM {collection_name} WHERE {condition}", (stale_hashes,))
+    return cur.rowcount
+
+
+async def _move_rows(conn, collection_name: str, moved: Dict[str, List[str]]) -> int:
+    """Records the new source of unchanged rows whose file was renamed, so prune="sources" keeps finding them."""
+    count = 0
+    for source, hashes in moved.items():
+        cur = await conn.execute(
+            f"UPDATE {collection_name} SET metadata = jsonb_set(metadata, '{{{SOURCE_KEY}}}', to_jsonb(%s::text)) "
+            f"WHERE metadata->>'{HASH_KEY}' = ANY(%s)", (source, hashes))
+        count += cur.rowcount
+    return count
+
+
+async def ingest(collection_name: str, paths: List[str], metadata_columns: Optional[List[str]] = None,
+                 prune: str = "sources", dry_run: bool = False,
+                 chunk_chars: int = INGEST_CHUNK_CHARS, chunk_overlap: int = INGEST_CHUNK_OVERLAP,
+                 batch_size: int = INGEST_EMBED_BATCH_SIZE, concurrency: int = INGEST_EMBED_CONCURRENCY) -> dict:
+    """
+    Loads source files into a KB table in one transaction, so readers see
+    either the old or the new contents. Chunks whose content_hash is already
+    in the table are skipped: only new or changed ones are embedded, in
+    windows of batch_size * concurrency texts (a skipped row from a renamed
+    file only gets its new source recorded; rows only the old file had need
+    prune="all"). Stale rows are then deleted:
+    prune="sources" removes the rows of the given files that are no longer in
+    them, "all" every row not in the given files (including rows loaded some
+    other way), "none" nothing. dry_run only counts. Returns the counters and rows/sec.
+    """
+    if prune not in ("sources", "all", "none"):
+        raise ValueError(f"Unknown prune mode '{prune}'")
+    start = time.perf_counter()
+    report = {"collection": collection_name, "chunks": 0, "unchanged": 0, "embedded": 0, "moved": 0, "deleted": 0, "dry_run": dry_run}
+    sources = [os.path.basename(path) for path in paths]
+    seen: Set[str] = set()
+    # source -> hashes of unchanged rows recorded under another source
+    moved: Dict[str, List[str]] = {}
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        existing = await _existing_hashes(conn, collection_name)
+
+        def new_chunks() -> Iterator[Chunk]:
+            for path, source in zip(paths, sources):
+                for content, metadata in _tag(read_source(path, collection_name, metadata_columns, chunk_chars, chunk_overlap), source):
+                    if metadata[HASH_KEY] in seen:
+                        continue # the same row twice: it is loaded once
+                    seen.add(metadata[HASH_KEY])
+                    report["chunks"] += 1
+                    if existing and metadata[HASH_KEY] in existing:
+                        report["unchanged"] += 1
+                        if existing[metadata[HASH_KEY]] != source:
+                            moved.setdefault(source, []).append(metadata[HASH_KEY])
+                    else:
+                        yield content, metadata
+
+        def stale_hashes() -> List[str]:
+            if prune == "none" or not existing:
+                return []
+            return [h for h, source in existing.items() if h not in seen and (prune == "all" or source in sources)]
+
+        if dry_run:
+            report["embedded"] = sum(1 for _ in new_chunks())
+            report["moved"] = sum(len(hashes) for hashes in moved.values())
+            if existing is not None:
+                report["deleted"] = await _delete_stale(conn, collection_name, stale_hashes(), prune == "all", dry_run=True)
+        else:
+            async with conn.transaction():
+                await _load(conn, collection_name, new_chunks(), batch_size, max(1, batch_size * concurrency), report)
+                report["moved"] = await _move_rows(conn, collection_name, moved)
+                if existing is not None and prune != "none":
+                    report["deleted"] = await _delete_stale(conn, collection_name, stale_hashes(), prune == "all", dry_run=False)
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    report["rows_per_second"] = round(report["chunks"] / report["seconds"], 1) if report["seconds"] else 0.0
+    logger.info(f"Ingestion of {collection_name} finished: {report}")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Loads CSV, JSONL or markdown files into a KB table, re-embedding only new or changed chunks.")
+    parser.add_argument("collection", help=f"table to load, e.g. one of {', '.join(KB_COLLECTIONS)}")
+    parser.add_argument("paths", nargs="+", help=".csv (one row per record), .jsonl or .md files")
+    parser.add_argument("--metadata-columns", help="comma-separated CSV columns copied into the metadata "
+                                                   f"(default for {APP_KB_TABLE}: {', '.join(DEFAULT_METADATA_COLUMNS[APP_KB_TABLE])})")
+    parser.add_argument("--prune", choices=["sources", "all", "none"], default="sources",
+                        help="stale rows to delete: of the given files (default), every row not in them, or none")
+    parser.add_argument("--chunk-chars", type=int, default=INGEST_CHUNK_CHARS)
+    parser.add_argument("--chunk-overlap", type=int, default=INGEST_CHUNK_OVERLAP)
+    parser.add_argument("--batch-size", type=int, default=INGEST_EMBED_BATCH_SIZE, help="texts per embedding request")
+    parser.add_argument("--concurrency", type=int, default=INGEST_EMBED_CONCURRENCY, help="embedding requests in flight")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be embedded and deleted")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    columns = [c.strip() for c in args.metadata_columns.split(",") if c.strip()] if args.metadata_columns is not None else None
+    result = asyncio.run(ingest(args.collection, args.paths, columns, prune=args.prune, dry_run=args.dry_run,
+                                chunk_chars=args.chunk_chars, chunk_overlap=args.chunk_overlap,
+                                batch_size=args.batch_size, concurrency=args.concurrency))
+    print(json.dumps(result, indent=2))
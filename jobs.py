@@ -0,0 +1,360 @@
+# jobs.py
+import asyncio
+import uuid
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from psycopg.types.json import Jsonb
+
+from config import (
+    JOB_MAX_QUEUE_DEPTH, JOB_POLL_INTERVAL_SECONDS, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETENTION_SECONDS,
+)
+from db import get_async_pool
+from metrics import JOBS_SUBMITTED, JOBS_FINISHED, JOB_WAIT_SECONDS, JOBS_RUNNING
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# job row -> (final state, run id or None)
+JobHandler = Callable[[dict], Awaitable[Tuple[dict, Optional[str]]]]
+
+_JOB_COLUMNS = "id, raw_input, bypass_cache, status, attempts, run_id, error, created_at, started_at, finished_at"
+
+
+class QueueFull(Exception):
+    """POST /jobs is refused: JOB_MAX_QUEUE_DEPTH jobs are already waiting."""
+
+    def __init__(self, depth: int):
+        super().__init__(f"{depth} jobs are already queued")
+        self.depth = depth
+
+
+class PostgresJobQueue:
+    """
+    Durable job queue in one table. Workers claim the oldest queued job with
+    FOR UPDATE SKIP LOCKED, so any number of workers in any number of processes
+    share the queue without handing a job out twice. A claimed job carries a
+    lease that its worker renews while it runs; a job whose lease ran out (its
+    worker died) is queued again. The attempt number fences out a worker that
+    lost its lease, so it cannot overwrite the result of the new attempt.
+    """
+
+    def __init__(self, max_depth: int, lease_seconds: float, max_attempts: int, table_name: str = "analysis_jobs"):
+        self.max_depth = max_depth
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.table_name = table_name
+        self._table_ready = False
+        self.depth = None # queued jobs at the last submit
+        self.accepted = 0
+        self.rejected = 0
+
+    async def _ensure_table(self, conn):
+        if not self._table_ready:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    id uuid PRIMARY KEY,
+                    raw_input text NOT NULL,
+                    bypass_cache boolean NOT NULL DEFAULT false,
+                    status text NOT NULL DEFAULT 'queued', -- queued, running, succeeded, failed
+                    attempts integer NOT NULL DEFAULT 0,
+                    run_id text,                           -- checkpointed run of the last attempt
+                    result jsonb,
+                    error text,
+                    created_at timestamptz NOT NULL DEFAULT now(),
+                    not_before timestamptz NOT NULL DEFAULT now(),
+                    started_at timestamptz,
+                    lease_until timestamptz,
+                    finished_at timestamptz
+                )""")
+            # Partial indexes: claiming and counting only ever look at the few unfinished rows
+            await conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_queued_idx ON {self.table_name} (created_at) WHERE status = 'queued'")
+            await conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_lease_idx ON {self.table_name} (lease_until) WHERE status = 'running'")
+            await conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_finished_idx ON {self.table_name} (finished_at) WHERE finished_at IS NOT NULL")
+            self._table_ready = True
+
+    async def submit(self, raw_input: str, bypass_cache: bool = False) -> str:
+        """Queues a demand and returns the job id. Raises QueueFull past max_depth (admission control)."""
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await self._ensure_table(conn)
+            async with conn.transaction():
+                # Submits of all processes take turns between the count and the insert,
+                # otherwise concurrent ones could all pass the check and overfill the queue
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{self.table_name}:submit",))
+                cur = await conn.execute(f"SELECT count(*) FROM {self.table_name} WHERE status = 'queued'")
+                self.depth = (await cur.fetchone())[0]
+                if self.max_depth and self.depth >= self.max_depth:
+                    self.rejected += 1
+                    JOBS_SUBMITTED.labels("rejected").inc()
+                    raise QueueFull(self.depth)
+                job_id = uuid.uuid4()
+                await conn.execute(
+                    f"INSERT INTO {self.table_name} (id, raw_input, bypass_cache) VALUES (%s, %s, %s)",
+                    (job_id, raw_input, bypass_cache),
+                )
+        self.accepted += 1
+        JOBS_SUBMITTED.labels("accepted").inc()
+        return str(job_id)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        """The job's status, its result once it succeeded, and its place in the queue while it waits."""
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await self._ensure_table(conn)
+            cur = await conn.execute(f"SELECT {_JOB_COLUMNS}, result FROM {self.table_name} WHERE id = %s", (job_id,))
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            job = dict(zip([c.name for c in cur.description], row))
+            if job["status"] == "queued":
+                cur = await conn.execute(
+                    f"SELECT count(*) FROM {self.table_name} WHERE status = 'queued' AND created_at < %s", (job["created_at"],)
+                )
+                job["queue_position"] = (await cur.fetchone())[0] + 1
+        job["id"] = str(job["id"])
+        return job
+
+    async def claim(self) -> Optional[dict]:
+        """Takes the oldest runnable job, or returns None if there is none."""
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await self._ensure_table(conn)
+            cur = await conn.execute(
+                f"""UPDATE {self.table_name}
+                    SET status = 'running', attempts = attempts + 1, started_at = now(),
+                        lease_until = now() + make_interval(secs => %s)
+                    WHERE id = (
+                        SELECT id FROM {self.table_name}
+                        WHERE status = 'queued' AND not_before <= now()
+                        ORDER BY created_at
+                        FOR UPDATE SKIP LOCKED
+                        LIMIT 1)
+                    RETURNING {_JOB_COLUMNS}""",
+                (self.lease_seconds,),
+            )
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            job = dict(zip([c.name for c in cur.description], row))
+        JOB_WAIT_SECONDS.observe((job["started_at"] - job["created_at"]).total_seconds())
+        return job
+
+    async def renew(self, job: dict) -> bool:
+        """Extends the lease of a running job. False once the job no longer belongs to this attempt."""
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            cur = await conn.execute(
+                f"""UPDATE {self.table_name} SET lease_until = now() + make_interval(secs => %s)
+                    WHERE id = %s AND status = 'running' AND attempts = %s""",
+                (self.lease_seconds, job["id"], job["attempts"]),
+            )
+            return cur.rowcount == 1
+
+    async def complete(self, job: dict, result: dict, run_id: Optional[str]):
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await conn.execute(
+                f"""UPDATE {self.table_name}
+                    SET status = 'succeeded', result = %s, run_id = %s, error = NULL, finished_at = now(), lease_until = NULL
+                    WHERE id = %s AND status = 'running' AND attempts = %s""",
+                (Jsonb(result), run_id, job["id"], job["attempts"]),
+            )
+        JOBS_FINISHED.labels("succeeded").inc()
+
+    async def fail(self, job: dict, error: str, run_id: Optional[str]):
+        """Queues the job again after a backoff, or marks it failed after max_attempts."""
+        retry = job["attempts"] < self.max_attempts
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            if retry:
+                # run_id is kept, so the next attempt resumes from the checkpoints of this one
+                await conn.execute(
+                    f"""UPDATE {self.table_name}
+                        SET status = 'queued', error = %s, run_id = coalesce(%s, run_id), lease_until = NULL,
+                            not_before = now() + make_interval(secs => %s)
+                        WHERE id = %s AND status = 'running' AND attempts = %s""",
+                    (error, run_id, 10 * 2 ** (job["attempts"] - 1), job["id"], job["attempts"]),
+                )
+            else:
+                await conn.execute(
+                    f"""UPDATE {self.table_name}
+                        SET status = 'failed', error = %s, run_id = coalesce(%s, run_id), finished_at = now(), lease_until = NULL
+                        WHERE id = %s AND status = 'running' AND attempts = %s""",
+                    (error, run_id, job["id"], job["attempts"]),
+                )
+        JOBS_FINISHED.labels("retried" if retry else "failed").inc()
+
+    async def release(self, job: dict):
+        """Hands a job back untouched (its worker is shutting down); the attempt does not count."""
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await conn.execute(
+                f"""UPDATE {self.table_name} SET status = 'queued', attempts = attempts - 1, lease_until = NULL
+                    WHERE id = %s AND status = 'running' AND attempts = %s""",
+                (job["id"], job["attempts"]),
+            )
+
+    async def maintain(self, retention_seconds: float):
+        """Requeues jobs whose worker died (failing those out of attempts) and deletes old finished jobs."""
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await self._ensure_table(conn)
+            cur = await conn.execute(
+                f"""UPDATE {self.table_name}
+                    SET status = CASE WHEN attempts < %s THEN 'queued' ELSE 'failed' END,
+                        error = 'job worker stopped responding', lease_until = NULL,
+                        finished_at = CASE WHEN attempts < %s THEN NULL ELSE now() END
+                    WHERE status = 'running' AND lease_until < now()
+                    RETURNING status""",
+                (self.max_attempts, self.max_attempts),
+            )
+            expired = [row[0] for row in await cur.fetchall()]
+            if expired:
+                failed = expired.count("failed")
+                logger.warning(f"Requeued {len(expired) - failed} and failed {failed} jobs with an expired lease")
+                # These attempts ended without their worker reporting them (see fail())
+                JOBS_FINISHED.labels("retried").inc(len(expired) - failed)
+                JOBS_FINISHED.labels("failed").inc(failed)
+            await conn.execute(
+                f"DELETE FROM {self.table_name} WHERE finished_at < now() - make_interval(secs => %s)", (retention_seconds,)
+            )
+
+    def stats(self) -> dict:
+        return {"queued_at_last_submit": self.depth, "accepted": self.accepted, "rejected": self.rejected}
+
+
+class JobWorkers:
+    """
+    A pool of asyncio tasks that claim and run jobs. Idle workers poll every
+    JOB_POLL_INTERVAL_SECONDS; a submit in the same process wakes them at once.
+    """
+
+    def __init__(self, queue: PostgresJobQueue, poll_interval: float):
+        self.queue = queue
+        self.poll_interval = poll_interval
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self.running = 0
+        self.finished = 0
+
+    def start(self, n: int, handler: JobHandler):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work(i, handler)) for i in range(n)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+        logger.info(f"Started {n} job workers")
+
+    async def stop(self):
+        # Jobs in progress are handed back to the queue (see _run) for another worker to pick up
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _idle(self, seconds: float):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _work(self, index: int, handler: JobHandler):
+        backoff = self.poll_interval
+        while True:
+            try:
+                job = await self.queue.claim()
+                backoff = self.poll_interval
+            except Exception as e:
+                # Postgres not reachable yet or any more: back off instead of spinning
+                logger.warning(f"Job worker {index} could not claim a job: {e}")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            if job is None:
+                await self._idle(self.poll_interval)
+                continue
+            await self._run(job, handler)
+
+    async def _renew_lease(self, job: dict):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            try:
+                if not await self.queue.renew(job):
+                    logger.warning(f"Lost the lease of job {job['id']}; another worker may run it")
+                    return
+            except Exception as e:
+                logger.warning(f"Could not renew the lease of job {job['id']}: {e}")
+
+    async def _run(self, job: dict, handler: JobHandler):
+        logger.info(f"Running job {job['id']} (attempt {job['attempts']})")
+        renewal = asyncio.create_task(self._renew_lease(job))
+        self.running += 1
+        JOBS_RUNNING.inc()
+        try:
+            final_state, run_id = await handler(job)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.queue.release(job))
+            raise
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {e}", exc_info=True)
+            await self.queue.fail(job, f"Error during LangGraph invocation: {str(e)}", getattr(e, "run_id", None))
+        else:
+            await self.queue.complete(job, final_state, run_id)
+        finally:
+            renewal.cancel()
+            self.running -= 1
+            self.finished += 1
+            JOBS_RUNNING.dec()
+
+    async def _maintain(self):
+        while True:
+            try:
+                await self.queue.maintain(JOB_RETENTION_SECONDS)
+            except Exception as e:
+                logger.warning(f"Job queue maintenance failed: {e}")
+            await asyncio.sleep(self.queue.lease_seconds / 2)
+
+    def stats(self) -> dict:
+        return {"workers": max(0, len(self._tasks) - 1), "running": self.running, "finished": self.finished}
+
+
+job_queue = PostgresJobQueue(JOB_MAX_QUEUE_DEPTH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
+job_workers = JobWorkers(job_queue, JOB_POLL_INTERVAL_SECONDS)
+
+
+def job_stats() -> Dict[str, dict]:
+    return {"queue": job_queue.stats(), "workers": job_workers.stats()}
+
+
+async def _run_workers(n: int):
+    import signal
+    from backend import run_job
+    from checkpoints import aclose_checkpointer
+    from db import aclose_pools
+    from startup import warm_up
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    warm_up_task = asyncio.create_task(warm_up())
+    job_workers.start(n, run_job)
+    await stopping.wait()
+    logger.info("Stopping job workers; jobs in progress go back to the queue")
+    warm_up_task.cancel()
+    await job_workers.stop()
+    await aclose_checkpointer()
+    await aclose_pools()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs job workers outside the API processes.")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent jobs in this process (default 4)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_run_workers(args.workers))
@@ -0,0 +1,166 @@
+# kb_index.py
+import json
+import math
+import sys
+import logging
+from typing import List
+
+from db import get_pool
+from tools import KB_COLLECTIONS, RetrieverConfig, retriever_config, _similarity_sql, _similarity_params
+from app_directory import APP_KB_TABLE, ensure_name_index
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# pgvector operator class matching the <=> (cosine distance) operator of the similarity queries
+OPCLASS = "vector_cosine_ops"
+
+
+def index_name(collection_name: str, method: str) -> str:
+    return f"{collection_name}_embedding_{method}_idx"
+
+
+def _table_info(conn, collection_name: str):
+    """(row count, embedding dimensions) of a KB table, or None when it does not exist."""
+    row = conn.execute(
+        """SELECT a.atttypmod FROM pg_attribute a
+           WHERE a.attrelid = to_regclass(%s) AND a.attname = 'embedding' AND NOT a.attisdropped""",
+        (collection_name,),
+    ).fetchone()
+    if row is None:
+        return None
+    rows = conn.execute(f"SELECT count(*) FROM {collection_name}").fetchone()[0]
+    # vector(n) stores n as the typmod; a bare "vector" column has none (-1)
+    return int(rows), (row[0] if row[0] > 0 else None)
+
+
+def _embedding_indexes(conn, collection_name: str) -> List[dict]:
+    rows = conn.execute(
+        """SELECT i.relname, am.amname, opc.opcname, x.indisvalid
+           FROM pg_index x
+           JOIN pg_class i ON i.oid = x.indexrelid
+           JOIN pg_am am ON am.oid = i.relam
+           JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = x.indkey[0]
+           JOIN pg_opclass opc ON opc.oid = x.indclass[0]
+           WHERE x.indrelid = to_regclass(%s) AND a.attname = 'embedding'""",
+        (collection_name,),
+    ).fetchall()
+    return [{"name": r[0], "method": r[1], "opclass": r[2], "valid": r[3]} for r in rows]
+
+
+def ivfflat_lists(config: RetrieverConfig, rows: int) -> int:
+    """pgvector's guidance: rows / 1000 up to 1M rows, sqrt(rows) above."""
+    if config.ivfflat_lists:
+        return config.ivfflat_lists
+    return max(10, int(math.sqrt(rows)) if rows > 1_000_000 else rows // 1000)
+
+
+def _create_index_sql(collection_name: str, config: RetrieverConfig, rows: int) -> str:
+    name = index_name(collection_name, config.index)
+    if config.index == "hnsw":
+        options = f"m = {config.hnsw_m}, ef_construction = {config.hnsw_ef_construction}"
+    else:
+        options = f"lists = {ivfflat_lists(config, rows)}"
+    return (f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {collection_name} "
+            f"USING {config.index} (embedding {OPCLASS}) WITH ({options})")
+
+
+def ensure_index(collection_name: str) -> dict:
+    """
+    Creates the ANN index configured for a collection (idempotent), without
+    blocking writes. An index left invalid by an interrupted build is dropped and
+    rebuilt. Collections with metadata filters also get a GIN index for them.
+    """
+    config = retriever_config(collection_name)
+    report = {"collection": collection_name, "index": config.index, "created": []}
+    with get_pool().connection() as conn:
+        info = _table_info(conn, collection_name)
+        if info is None:
+            raise ValueError(f"Table {collection_name} has no embedding column (has it been ingested?)")
+        rows, dims = info
+        report.update(rows=rows, dims=dims)
+        if config.index != "none":
+            if dims is None:
+                raise ValueError(f"{collection_name}.embedding has no dimensions; ANN indexes need vector(n). "
+                                 f"Fix with: ALTER TABLE {collection_name} ALTER COLUMN embedding TYPE vector(<n>)")
+            name = index_name(collection_name, config.index)
+            existing = {i["name"]: i for i in _embedding_indexes(conn, collection_name)}
+            if name in existing and not existing[name]["valid"]:
+                logger.warning(f"Index {name} is invalid (interrupted build); rebuilding")
+                conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                del existing[name]
+            if name not in existing:
+                logger.info(f"Building {config.index} index {name} on {rows} rows of {collection_name}")
+                conn.execute(_create_index_sql(collection_name, config, rows))
+                report["created"].append(name)
+        if config.filters:
+            name = f"{collection_name}_metadata_idx"
+            conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {collection_name} "
+                         f"USING gin (metadata jsonb_path_ops)")
+            report["metadata_index"] = name
+    if collection_name == APP_KB_TABLE:
+        ensure_name_index()
+    logger.info(f"Ensured indexes on {collection_name}: {report}")
+    return report
+
+
+def _plan_uses_index(conn, collection_name: str, config: RetrieverConfig, name: str, dims: int) -> bool:
+    """Whether the similarity query of tools.search_collection can be answered from the index."""
+    probe = "[" + ",".join(["0"] * (dims - 1) + ["1"]) + "]"
+    with conn.transaction():
+        # Only asks whether the index is usable; whether the planner prefers it depends on the table size
+        conn.execute("SET LOCAL enable_seqscan = off")
+        plan = conn.execute("EXPLAIN (FORMAT JSON) " + _similarity_sql(collection_name, bool(config.filters)),
+                            _similarity_params(probe, config.filters, config.top_k)).fetchone()[0]
+    return name in json.dumps(plan)
+
+
+def validate(collection_name: str) -> dict:
+    """Checks that a collection's configured index exists, is valid, matches the cosine operator and is usable."""
+    config = retriever_config(collection_name)
+    report = {"collection": collection_name, "index": config.index, "problems": []}
+    problems = report["problems"]
+    with get_pool().connection() as conn:
+        info = _table_info(conn, collection_name)
+        if info is None:
+            problems.append("table or embedding column missing")
+            return report
+        report["rows"], report["dims"] = info
+        if config.index == "none":
+            return report
+        name = index_name(collection_name, config.index)
+        indexes = _embedding_indexes(conn, collection_name)
+        report["indexes"] = indexes
+        index = next((i for i in indexes if i["name"] == name), None)
+        if index is None:
+            problems.append(f"index {name} missing (run kb_index.py --create)")
+        elif not index["valid"]:
+            problems.append(f"index {name} is invalid (run kb_index.py --create to rebuild it)")
+        elif index["method"] != config.index or index["opclass"] != OPCLASS:
+            problems.append(f"index {name} is {index['method']}/{index['opclass']}, expected {config.index}/{OPCLASS}")
+        else:
+            report["used"] = _plan_uses_index(conn, collection_name, config, name, report["dims"])
+            if not report["used"]:
+                problems.append(f"the similarity query cannot use {name}")
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Creates and checks the ANN indexes of the KB tables (see KB_INDEX_TYPE / KB_RETRIEVERS).")
+    parser.add_argument("collections", nargs="*", default=KB_COLLECTIONS, help=f"default: {', '.join(KB_COLLECTIONS)}")
+    parser.add_argument("--create", action="store_true", help="create missing indexes and rebuild invalid ones")
+    parser.add_argument("--validate", action="store_true", help="check the indexes exist, are valid and usable (exit 1 if not)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    results: List[dict] = []
+    failed = False
+    for collection in args.collections:
+        if args.create:
+            results.append(ensure_index(collection))
+        if args.validate or not args.create:
+            result = validate(collection)
+            failed = failed or bool(result["problems"])
+            results.append(result)
+    print(json.dumps(results, indent=2))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,552 @@
+# llm_scheduler.py
+import asyncio
+import contextvars
+import email.utils
+import functools
+import heapq
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import logging
+from typing import Any, Callable, Dict, Optional
+
+from config import (
+    LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_IN_FLIGHT, LLM_BUCKET_BURST_SECONDS,
+    LLM_QUEUE_TIMEOUT_SECONDS, LLM_MAX_RETRIES, LLM_BACKOFF_BASE_SECONDS, LLM_BACKOFF_MAX_SECONDS,
+    LLM_EXPECTED_COMPLETION_TOKENS,
+)
+from hedging import ahedged, hedge_target
+from metrics import LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT_SECONDS, LLM_QUEUE_TIMEOUTS, LLM_RETRIES
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2
+PRIORITY_NAMES = {PRIORITY_HIGH: "high", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+
+# Priority of the chat model calls made in the current context; set per node by prioritize()
+_priority: contextvars.ContextVar = contextvars.ContextVar("llm_priority", default=PRIORITY_NORMAL)
+
+
+# regulatory_impact is free text, so only an explicit "yes" or a named regulator or
+# regulation that is not negated counts ("Unknown", "None identified" or "There is no
+# regulatory impact" do not)
+_REGULATORY_AFFIRMATIVE = re.compile(r"^yes\b")
+_REGULATORY_NEGATION = re.compile(r"\b(no|not|none|nil|n/a|without|unknown|unclear)\b|n't\b")
+_REGULATORY_KEYWORDS = re.compile(
+    r"\b(bnm|bank negara|pdpa|gdpr|pci[ -]?dss|aml|e-?kyc|rmit|sox|basel|fatca|mandatory|regulator)\b"
+)
+
+
+def has_regulatory_impact(regulatory_impact: Any) -> bool:
+    text = str(regulatory_impact or "").strip().lower()
+    if _REGULATORY_AFFIRMATIVE.match(text):
+        return True
+    return not _REGULATORY_NEGATION.search(text) and bool(_REGULATORY_KEYWORDS.search(text))
+
+
+def demand_priority(extracted_info: Optional[Dict[str, Any]]) -> int:
+    """High for High business priority or an affirmed regulatory impact, low for Low business priority."""
+    if not extracted_info:
+        return PRIORITY_NORMAL
+    business = str(extracted_info.get("business_priority") or "").strip().lower()
+    if business.startswith("high") or has_regulatory_impact(extracted_info.get("regulatory_impact")):
+        return PRIORITY_HIGH
+    if business.startswith("low"):
+        return PRIORITY_LOW
+    return PRIORITY_NORMAL
+
+
+def prioritize(func: Callable, afunc: Callable):
+    """Wraps a node's sync and async implementations so their LLM calls queue with the demand's priority."""
+
+    @functools.wraps(func)
+    def prioritized(state):
+        token = _priority.set(demand_priority(state.get("extracted_info")))
+        try:
+            return func(state)
+        finally:
+            _priority.reset(token)
+
+    @functools.wraps(afunc)
+    async def aprioritized(state):
+        token = _priority.set(demand_priority(state.get("extracted_info")))
+        try:
+            return await afunc(state)
+        finally:
+            _priority.reset(token)
+
+    return prioritized, aprioritized
+
+
+class LLMQueueTimeout(RuntimeError):
+    """A chat model call waited longer than LLM_QUEUE_TIMEOUT_SECONDS for a slot."""
+
+
+class TokenBucket:
+    """
+    Refills at per_minute / 60 per second and holds at most burst_seconds worth,
+    so a full bucket cannot spend a minute's quota in one burst (Azure enforces
+    its per-minute limits over shorter windows). per_minute <= 0 disables it.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.per_minute = per_minute
+        self.capacity = max(1.0, per_minute * burst_seconds / 60)
+        self.level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until amount can be taken; a call larger than the bucket waits for a full one."""
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) * 60 / self.per_minute)
+
+    def take(self, amount: float):
+        if self.per_minute > 0:
+            self.level -= amount
+
+    def adjust(self, delta: float):
+        """Charges the difference between what was taken and what was used (may leave the bucket in debt)."""
+        if self.per_minute > 0:
+            self.level = min(self.capacity, self.level - delta)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "enqueued", "event", "loop")
+
+    def __init__(self, priority: int, seq: int, tokens: int, loop: Optional[asyncio.AbstractEventLoop]):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.loop = loop
+        self.event = asyncio.Event() if loop is not None else threading.Event()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass # the waiter's loop is closed; it is gone
+
+
+class LLMScheduler:
+    """
+    Single dispatch point for chat model calls in this process. Calls wait in a
+    priority queue (FIFO within a priority) and are released by request and token
+    buckets sized to the deployment's RPM/TPM quota, so load above the quota
+    queues instead of bouncing off 429s. Token use is estimated before the call
+    and corrected from the reported usage afterwards. Throttled and transient
+    failures are retried here, with full-jitter backoff; a 429 also pauses the
+    whole queue for its retry-after, so callers do not retry into the same limit.
+    Works for threads and event loops alike.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, max_in_flight: int = 0,
+                 burst_seconds: float = 10.0, queue_timeout: float = 120.0, max_retries: int = 4,
+                 backoff_base: float = 1.0, backoff_max: float = 30.0, expected_completion_tokens: int = 512):
+        self._requests = TokenBucket(requests_per_minute, burst_seconds)
+        self._tokens = TokenBucket(tokens_per_minute, burst_seconds)
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.expected_completion_tokens = expected_completion_tokens
+        self.enabled = requests_per_minute > 0 or tokens_per_minute > 0 or max_in_flight > 0
+        self._lock = threading.Lock()
+        self._queue: list = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._cooldown_until = 0.0
+        self.granted = 0   # calls that got a slot
+        self.retries = 0   # attempts repeated after a throttled or transient failure
+        self.throttled = 0 # 429 responses
+        self.timeouts = 0  # calls that gave up waiting in the queue
+
+    @classmethod
+    def from_config(cls, requests_per_minute: float, tokens_per_minute: float) -> "LLMScheduler":
+        """A scheduler for one deployment's quota, with the LLM_* queue and retry settings."""
+        return cls(
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_in_flight=LLM_MAX_IN_FLIGHT,
+            burst_seconds=LLM_BUCKET_BURST_SECONDS,
+            queue_timeout=LLM_QUEUE_TIMEOUT_SECONDS,
+            max_retries=LLM_MAX_RETRIES,
+            backoff_base=LLM_BACKOFF_BASE_SECONDS,
+            backoff_max=LLM_BACKOFF_MAX_SECONDS,
+            expected_completion_tokens=LLM_EXPECTED_COMPLETION_TOKENS,
+        )
+
+    # --- Queue ---
+
+    def _enqueue(self, priority: int, tokens: int, loop) -> _Waiter:
+        waiter = _Waiter(priority, next(self._seq), tokens, loop)
+        with self._lock:
+            heapq.heappush(self._queue, waiter)
+        LLM_QUEUE_DEPTH.labels(PRIORITY_NAMES[priority]).inc()
+        return waiter
+
+    def _wake_head(self):
+        # Only the head of the queue can be granted, so only it needs waking
+        if self._queue:
+            self._queue[0].wake()
+
+    def _remove(self, waiter: _Waiter):
+        # Caller holds the lock
+        if waiter in self._queue:
+            self._queue.remove(waiter)
+            heapq.heapify(self._queue)
+            LLM_QUEUE_DEPTH.labels(PRIORITY_NAMES[waiter.priority]).dec()
+            self._wake_head()
+
+    def _next_wait(self, waiter: _Waiter) -> Optional[float]:
+        """None once the waiter holds a slot, otherwise how long to sleep before polling again."""
+        now = time.monotonic()
+        with self._lock:
+            delay = None # not at the head, or max_in_flight reached: sleep until woken
+            if self._queue[0] is waiter and not (self.max_in_flight and self._in_flight >= self.max_in_flight):
+                delay = max(self._cooldown_until - now,
+                            self._requests.wait_time(1, now), self._tokens.wait_time(waiter.tokens, now))
+                if delay <= 0:
+                    self._requests.take(1)
+                    self._tokens.take(waiter.tokens)
+                    heapq.heappop(self._queue)
+                    self._in_flight += 1
+                    self.granted += 1
+                    self._wake_head()
+                    name = PRIORITY_NAMES[waiter.priority]
+                    LLM_QUEUE_DEPTH.labels(name).dec()
+                    LLM_QUEUE_WAIT_SECONDS.labels(name).observe(now - waiter.enqueued)
+                    return None
+            remaining = waiter.enqueued + self.queue_timeout - now
+            if remaining <= 0:
+                self._remove(waiter)
+                self.timeouts += 1
+                LLM_QUEUE_TIMEOUTS.labels(PRIORITY_NAMES[waiter.priority]).inc()
+                raise LLMQueueTimeout(f"LLM call waited {now - waiter.enqueued:.1f}s for a slot")
+            return remaining if delay is None else min(delay, remaining)
+
+    def acquire(self, priority: int, tokens: int):
+        if not self.enabled:
+            return
+        waiter = self._enqueue(priority, tokens, None)
+        try:
+            while True:
+                # Cleared before polling, so a wake-up between the poll and the wait is not lost
+                waiter.event.clear()
+                wait = self._next_wait(waiter)
+                if wait is None:
+                    return
+                waiter.event.wait(wait)
+        except BaseException:
+            with self._lock:
+                self._remove(waiter)
+            raise
+
+    async def aacquire(self, priority: int, tokens: int):
+        if not self.enabled:
+            return
+        waiter = self._enqueue(priority, tokens, asyncio.get_running_loop())
+        try:
+            while True:
+                waiter.event.clear()
+                wait = self._next_wait(waiter)
+                if wait is None:
+                    return
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # Includes cancellation: the slot must not stay reserved for a caller that is gone
+            with self._lock:
+                self._remove(waiter)
+            raise
+
+    def release(self, tokens: int, used_tokens: Optional[int] = None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._in_flight -= 1
+            if used_tokens:
+                self._tokens.adjust(used_tokens - tokens)
+            self._wake_head()
+
+    # --- Retries ---
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to back off before retrying, or None if the error should be raised."""
+        reason = _retry_reason(error)
+        if reason is None or attempt >= self.max_retries:
+            return None
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        if reason == "rate_limited":
+            self.throttled += 1
+            retry_after = _retry_after(error)
+            hold = retry_after if retry_after is not None else backoff
+            with self._lock:
+                # Every queued call waits out the limit, not only the one that hit it
+                self._cooldown_until = max(self._cooldown_until, time.monotonic() + hold)
+            logger.warning(f"LLM deployment throttled; pausing dispatch for {hold:.1f}s")
+        self.retries += 1
+        LLM_RETRIES.labels(reason).inc()
+        # Full jitter spreads the retries, then the call queues again (behind any cooldown)
+        return random.uniform(0, backoff)
+
+    def call(self, fn: Callable, tokens: int):
+        """Runs fn() (one chat completion) once a slot is free, retrying transient failures."""
+        priority = _priority.get()
+        for attempt in itertools.count():
+            self.acquire(priority, tokens)
+            used = None
+            try:
+                result = fn()
+                used = _used_tokens(result)
+                return result
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                logger.warning(f"LLM call failed ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            finally:
+                self.release(tokens, used)
+            time.sleep(delay)
+
+    async def acall(self, fn: Callable, tokens: int):
+        """Async call(): fn() returns the completion's coroutine."""
+        priority = _priority.get()
+        for attempt in itertools.count():
+            await self.aacquire(priority, tokens)
+            used = None
+            try:
+                result = await fn()
+                used = _used_tokens(result)
+                return result
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                logger.warning(f"LLM call failed ({e}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            finally:
+                self.release(tokens, used)
+            await asyncio.sleep(delay)
+
+    def stream(self, fn: Callable, tokens: int):
+        """call() for a streamed completion; only a stream that failed before its first chunk is retried."""
+        priority = _priority.get()
+        for attempt in itertools.count():
+            self.acquire(priority, tokens)
+            used, started = None, False
+            try:
+                for chunk in fn():
+                    started = True
+                    used = _add_chunk_tokens(used, chunk)
+                    yield chunk
+                return
+            except Exception as e:
+                delay = None if started else self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self.release(tokens, used)
+            time.sleep(delay)
+
+    async def astream(self, fn: Callable, tokens: int):
+        priority = _priority.get()
+        for attempt in itertools.count():
+            await self.aacquire(priority, tokens)
+            used, started = None, False
+            try:
+                async for chunk in fn():
+                    started = True
+                    used = _add_chunk_tokens(used, chunk)
+                    yield chunk
+                return
+            except Exception as e:
+                delay = None if started else self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self.release(tokens, used)
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            for waiter in self._queue:
+                depth[PRIORITY_NAMES[waiter.priority]] += 1
+            self._requests._refill(now)
+            self._tokens._refill(now)
+            return {
+                "enabled": self.enabled,
+                "queued": depth,
+                "in_flight": self._in_flight,
+                "cooldown_seconds": max(0.0, self._cooldown_until - now),
+                "request_bucket": self._requests.level if self._requests.per_minute > 0 else None,
+                "token_bucket": self._tokens.level if self._tokens.per_minute > 0 else None,
+                "granted": self.granted,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "timeouts": self.timeouts,
+            }
+
+
+def _retry_reason(error: Exception) -> Optional[str]:
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return "rate_limited"
+    if status in (408, 409) or (isinstance(status, int) and status >= 500):
+        return "server_error"
+    try:
+        import openai
+    except ImportError:
+        return None
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    return None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds from the retry-after-ms / retry-after headers of a throttled response."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_tokens(messages, kwargs: dict, completion_tokens: int) -> int:
+    """Rough prompt size (about 4 characters a token, tool schemas included) plus the completion budget."""
+    chars = 0
+    for message in messages:
+        content = message.content
+        chars += len(content) if isinstance(content, str) else len(json.dumps(content, default=str))
+        if getattr(message, "tool_calls", None):
+            chars += len(json.dumps(message.tool_calls, default=str))
+    for key in ("tools", "functions", "response_format"):
+        if key in kwargs:
+            chars += len(json.dumps(kwargs[key], default=str))
+    return chars // 4 + 4 * len(messages) + completion_tokens
+
+
+def _used_tokens(result) -> Optional[int]:
+    token_usage = (getattr(result, "llm_output", None) or {}).get("token_usage") or {}
+    if token_usage.get("total_tokens"):
+        return token_usage["total_tokens"]
+    for generation in getattr(result, "generations", []):
+        usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+        if usage:
+            return usage.get("total_tokens")
+    return None
+
+
+def _add_chunk_tokens(used: Optional[int], chunk) -> Optional[int]:
+    usage = getattr(getattr(chunk, "message", None), "usage_metadata", None)
+    if usage and usage.get("total_tokens"):
+        return (used or 0) + usage["total_tokens"]
+    return used
+
+
+LLM_SCHEDULER = LLMScheduler.from_config(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+# Models with a quota of their own (model_registry.py) get their own scheduler; the rest share LLM_SCHEDULER
+_SCHEDULERS: Dict[str, LLMScheduler] = {}
+
+
+def register_scheduler(model_name: str, scheduler: LLMScheduler):
+    _SCHEDULERS[model_name] = scheduler
+
+
+def scheduler_for(model) -> LLMScheduler:
+    return _SCHEDULERS.get((model.metadata or {}).get("llm_model"), LLM_SCHEDULER)
+
+
+def scheduler_stats() -> dict:
+    return {"default": LLM_SCHEDULER.stats(), **{name: scheduler.stats() for name, scheduler in _SCHEDULERS.items()}}
+
+
+@functools.lru_cache(maxsize=None)
+def scheduled(model_cls):
+    """
+    Subclass of a LangChain chat model class whose completions all go through
+    its scheduler (scheduler_for), and whose slow async completions are hedged
+    when its model has a hedge model (hedging.py). Everything else (bind_tools,
+    with_structured_output, callbacks) is the parent's, so chains and agents use
+    it like the plain client. Build it with the client's own retries off
+    (max_retries=0): the scheduler retries.
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+
+    class Scheduled(model_cls):
+        def _budget(self, messages, kwargs: dict) -> int:
+            return estimate_tokens(messages, kwargs, getattr(self, "max_tokens", None) or LLM_SCHEDULER.expected_completion_tokens)
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            generate = super()._generate
+            return scheduler_for(self).call(lambda: generate(messages, stop=stop, run_manager=run_manager, **kwargs),
+                                            self._budget(messages, kwargs))
+
+        async def _agenerate_once(self, messages, stop=None, run_manager=None, **kwargs):
+            agenerate = super()._agenerate
+            return await scheduler_for(self).acall(lambda: agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+                                                   self._budget(messages, kwargs))
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            # Only async calls are hedged: a sync call cannot be cancelled once the hedge has won
+            model_name = (self.metadata or {}).get("llm_model")
+            hedge = hedge_target(model_name)
+            if hedge is None:
+                return await self._agenerate_once(messages, stop, run_manager, **kwargs)
+            return await ahedged(
+                model_name,
+                lambda: self._agenerate_once(messages, stop, run_manager, **kwargs),
+                # The hedge's own hedge is not used, and it does not report to this call's callbacks
+                lambda: hedge._agenerate_once(messages, stop, None, **kwargs),
+            )
+
+        # Only override the streaming hooks the parent implements: LangChain decides
+        # whether a model can stream by checking whether they are overridden
+        if model_cls._stream is not BaseChatModel._stream:
+            def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+                stream = super()._stream
+                yield from scheduler_for(self).stream(lambda: stream(messages, stop=stop, run_manager=run_manager, **kwargs),
+                                                      self._budget(messages, kwargs))
+
+        if model_cls._astream is not BaseChatModel._astream:
+            # Not hedged (see hedging.ahedged): the tokens streamed so far cannot be taken back
+            async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+                astream = super()._astream
+                async for chunk in scheduler_for(self).astream(lambda: astream(messages, stop=stop, run_manager=run_manager, **kwargs),
+                                                               self._budget(messages, kwargs)):
+                    yield chunk
+
+    Scheduled.__name__ = Scheduled.__qualname__ = f"Scheduled{model_cls.__name__}"
+    return Scheduled
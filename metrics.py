@@ -0,0 +1,279 @@
+# metrics.py
+import os
+import time
+import logging
+import functools
+import contextlib
+from typing import Any, Callable, Dict, Optional
+from uuid import UUID
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Node and LLM latencies run from tens of milliseconds (template formatting) to a minute (agents)
+_SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+NODE_SECONDS = Histogram("demand_agent_node_seconds", "Wall time of one graph node run", ["node"], buckets=_SLOW_BUCKETS)
+NODE_ERRORS = Counter("demand_agent_node_errors_total", "Graph node runs that raised", ["node"])
+LLM_CALLS = Counter("demand_agent_llm_calls_total", "Chat model calls", ["node", "model"])
+LLM_ERRORS = Counter("demand_agent_llm_errors_total", "Chat model calls that raised", ["node", "model"])
+LLM_SECONDS = Histogram("demand_agent_llm_seconds", "Latency of one chat model call", ["node", "model"], buckets=_SLOW_BUCKETS)
+LLM_TOKENS = Counter("demand_agent_llm_tokens_total", "Tokens reported by the chat model", ["node", "model", "kind"])
+AGENT_ITERATIONS = Histogram("demand_agent_agent_iterations", "Tool-calling iterations per agent run", ["node"],
+                             buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 15))
+TOOL_CALLS = Counter("demand_agent_tool_calls_total", "Agent tool calls", ["node", "tool"])
+EMBEDDING_SECONDS = Histogram("demand_agent_embedding_seconds", "Latency of one embedding provider request", ["operation"])
+EMBEDDING_TEXTS = Counter("demand_agent_embedding_texts_total", "Texts sent to the embedding provider", ["operation"])
+RETRIEVAL_SECONDS = Histogram("demand_agent_retrieval_seconds", "Latency of one KB similarity search or lookup", ["collection", "backend"])
+RETRIEVAL_ERRORS = Counter("demand_agent_retrieval_errors_total", "KB searches or lookups that raised", ["collection", "backend"])
+HTTP_IN_FLIGHT = Gauge("demand_agent_http_requests_in_flight", "HTTP requests being handled", ["path"], multiprocess_mode="livesum")
+HTTP_SECONDS = Histogram("demand_agent_http_request_seconds", "Time to the response headers", ["path", "status"], buckets=_SLOW_BUCKETS)
+STARTUP_SECONDS = Gauge("demand_agent_startup_seconds", "Duration of each startup phase of this process", ["phase"],
+                        multiprocess_mode="max")
+LLM_QUEUE_DEPTH = Gauge("demand_agent_llm_queue_depth", "Chat model calls waiting in the LLM scheduler", ["priority"],
+                        multiprocess_mode="livesum")
+LLM_QUEUE_WAIT_SECONDS = Histogram("demand_agent_llm_queue_wait_seconds", "Time a chat model call waited in the LLM scheduler",
+                                   ["priority"], buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80))
+LLM_RETRIES = Counter("demand_agent_llm_retries_total", "Chat model calls retried by the LLM scheduler", ["reason"])
+LLM_QUEUE_TIMEOUTS = Counter("demand_agent_llm_queue_timeouts_total", "Chat model calls that gave up waiting in the LLM scheduler",
+                             ["priority"])
+LLM_HEDGES = Counter("demand_agent_llm_hedges_total", "Chat model calls duplicated to the hedge model after the hedge delay", ["model"])
+LLM_HEDGES_WON = Counter("demand_agent_llm_hedges_won_total", "Hedged chat model calls answered first by the hedge model", ["model"])
+DEADLINES_EXCEEDED = Counter("demand_agent_deadlines_exceeded_total", "Graph nodes stopped by their own or the request's deadline",
+                             ["node", "scope"])
+JOBS_SUBMITTED = Counter("demand_agent_jobs_submitted_total", "POST /jobs requests", ["outcome"])
+JOBS_FINISHED = Counter("demand_agent_jobs_finished_total", "Job attempts finished by the job workers", ["status"])
+JOB_WAIT_SECONDS = Histogram("demand_agent_job_wait_seconds", "Time a job waited in the queue before a worker took it",
+                             buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+JOBS_RUNNING = Gauge("demand_agent_jobs_running", "Jobs being run by this process's job workers", multiprocess_mode="livesum")
+SEMANTIC_CACHE_LOOKUPS = Counter("demand_agent_semantic_cache_lookups_total", "Semantic cache lookups of new demands", ["result"])
+SEMANTIC_CACHE_SIMILARITY = Histogram("demand_agent_semantic_cache_similarity", "Similarity of the closest past demand per lookup",
+                                      buckets=(0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.92, 0.94, 0.95, 0.96, 0.97, 0.98, 0.99, 1.0))
+SEMANTIC_CACHE_REUSED = Counter("demand_agent_semantic_cache_reused_total", "Classifier node runs replaced by a semantic cache match",
+                                ["node"])
+GRAPH_RUNS_IN_FLIGHT = Gauge("demand_agent_graph_runs_in_flight", "LangGraph runs in progress", multiprocess_mode="livesum")
+
+
+# --- Tracing (optional) ---
+
+_tracer = None
+
+
+def configure_tracing(endpoint: Optional[str], service_name: str):
+    """
+    Exports OpenTelemetry spans for nodes, LLM calls and retrievals to an OTLP
+    collector. Needs opentelemetry-sdk and opentelemetry-exporter-otlp; without
+    them (or without an endpoint) spans are a no-op.
+    """
+    global _tracer
+    if not endpoint:
+        return
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    except ImportError as e:
+        logger.warning(f"OpenTelemetry tracing requested but not installed ({e}); spans are disabled")
+        return
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(__name__)
+    logger.info(f"OpenTelemetry spans exported to {endpoint}")
+
+
+def span(name: str, **attributes):
+    """Context manager for one span; a no-op unless configure_tracing() enabled tracing."""
+    if _tracer is None:
+        return contextlib.nullcontext()
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+# --- Timers ---
+
+@contextlib.contextmanager
+def embedding_timer(operation: str, n_texts: int):
+    EMBEDDING_TEXTS.labels(operation).inc(n_texts)
+    start = time.perf_counter()
+    with span("embedding", operation=operation, texts=n_texts):
+        try:
+            yield
+        finally:
+            EMBEDDING_SECONDS.labels(operation).observe(time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def retrieval_timer(collection: str, backend: str):
+    start = time.perf_counter()
+    with span("retrieval", collection=collection, backend=backend):
+        try:
+            yield
+        except Exception:
+            RETRIEVAL_ERRORS.labels(collection, backend).inc()
+            raise
+        finally:
+            RETRIEVAL_SECONDS.labels(collection, backend).observe(time.perf_counter() - start)
+
+
+def instrument_node(name: str, func: Callable, afunc: Callable):
+    """Wraps a node's sync and async implementations with a wall-time histogram and a span."""
+
+    @functools.wraps(func)
+    def timed(state):
+        start = time.perf_counter()
+        with span(f"node.{name}"):
+            try:
+                return func(state)
+            except Exception:
+                NODE_ERRORS.labels(name).inc()
+                raise
+            finally:
+                NODE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+    @functools.wraps(afunc)
+    async def atimed(state):
+        start = time.perf_counter()
+        with span(f"node.{name}"):
+            try:
+                return await afunc(state)
+            except Exception:
+                NODE_ERRORS.labels(name).inc()
+                raise
+            finally:
+                NODE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+    return timed, atimed
+
+
+# --- LangChain callbacks: LLM calls, tokens, agent iterations ---
+
+def _usage(response) -> Dict[str, int]:
+    """Prompt/completion tokens of an LLMResult, from the message usage or the provider's token_usage."""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return {"prompt": usage.get("input_tokens", 0), "completion": usage.get("output_tokens", 0)}
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    return {"prompt": token_usage.get("prompt_tokens", 0), "completion": token_usage.get("completion_tokens", 0)}
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Attributes every chat model call, tool call and agent iteration to the graph
+    node it ran in (LangGraph puts the node name in the run metadata).
+    """
+
+    run_inline = True # counters only; no need for a thread hop on async runs
+
+    def __init__(self):
+        self._llm_runs: Dict[UUID, tuple] = {}
+        self._agent_runs: Dict[UUID, list] = {}
+
+    @staticmethod
+    def _node(metadata: Optional[dict]) -> str:
+        return (metadata or {}).get("langgraph_node", "none")
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs: Any):
+        # Registry model name (model_registry.py) when set, else the deployment LangChain reports
+        model = (metadata or {}).get("llm_model") or (metadata or {}).get("ls_model_name") or "unknown"
+        node = self._node(metadata)
+        LLM_CALLS.labels(node, model).inc()
+        self._llm_runs[run_id] = (node, model, time.perf_counter())
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any):
+        run = self._llm_runs.pop(run_id, None)
+        if run is None:
+            return
+        node, model, start = run
+        LLM_SECONDS.labels(node, model).observe(time.perf_counter() - start)
+        for kind, tokens in _usage(response).items():
+            if tokens:
+                LLM_TOKENS.labels(node, model, kind).inc(tokens)
+
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs: Any):
+        run = self._llm_runs.pop(run_id, None)
+        if run is not None:
+            LLM_ERRORS.labels(run[0], run[1]).inc()
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs: Any):
+        if kwargs.get("name") == "AgentExecutor":
+            self._agent_runs[run_id] = [self._node(metadata), 0]
+
+    def on_agent_action(self, action, *, run_id: UUID, **kwargs: Any):
+        run = self._agent_runs.get(run_id)
+        if run is not None:
+            run[1] += 1
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any):
+        run = self._agent_runs.pop(run_id, None)
+        if run is not None:
+            AGENT_ITERATIONS.labels(run[0]).observe(run[1])
+
+    def on_chain_error(self, error, *, run_id: UUID, **kwargs: Any):
+        self._agent_runs.pop(run_id, None)
+
+    def on_tool_start(self, serialized, input_str, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs: Any):
+        TOOL_CALLS.labels(self._node(metadata), (serialized or {}).get("name") or kwargs.get("name") or "unknown").inc()
+
+
+metrics_callback = MetricsCallbackHandler()
+
+
+# --- Component stats (caches, pools, indexes) as gauges at scrape time ---
+
+def _flatten(prefix: str, value, out: Dict[str, float]):
+    if isinstance(value, dict):
+        for key, inner in value.items():
+            _flatten(f"{prefix}.{key}" if prefix else str(key), inner, out)
+    elif isinstance(value, (bool, int, float)):
+        out[prefix] = float(value)
+
+
+class _StatsCollector:
+    """Exposes the numeric fields of the /stats sources as demand_agent_component_stat{component,stat}."""
+
+    def __init__(self):
+        self.sources: Dict[str, Callable[[], Any]] = {}
+
+    def collect(self):
+        family = GaugeMetricFamily("demand_agent_component_stat", "Counters reported by caches, pools and indexes",
+                                   labels=["component", "stat"])
+        for component, source in list(self.sources.items()):
+            try:
+                values: Dict[str, float] = {}
+                _flatten("", source(), values)
+            except Exception as e:
+                logger.warning(f"Stats source {component} failed: {e}")
+                continue
+            for stat, value in values.items():
+                family.add_metric([component, stat], value)
+        yield family
+
+
+_stats_collector = _StatsCollector()
+REGISTRY.register(_stats_collector)
+
+
+def register_stats_source(component: str, source: Callable[[], Any]):
+    _stats_collector.sources[component] = source
+
+
+def metrics_payload() -> tuple:
+    """(body, content type) for /metrics. Under gunicorn with PROMETHEUS_MULTIPROC_DIR set the
+    counters of all workers are merged; component stats are then those of the answering worker."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(_stats_collector)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -0,0 +1,166 @@
+# model_registry.py
+import hashlib
+import json
+import threading
+import logging
+from dataclasses import asdict, dataclass, fields, replace
+from typing import Dict, Optional
+
+from config import (
+    AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY, AZURE_OPENAI_CHAT_DEPLOYMENT_NAME, API_VERSION,
+    LLM_MODELS, LLM_NODE_MODELS, LLM_REQUEST_TIMEOUT_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DEFAULT_MODEL = "default"
+
+# Stages that can be routed to their own model: the graph nodes, plus the application-name
+# extractor, which runs inside extract_and_classify_applications before its agent
+NODE_STAGES = {
+    "extract_information", "classify_demand", "classify_domain", "application_extractor",
+    "extract_and_classify_applications", "format_output",
+}
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """One named chat deployment. Unset fields of a non-default model are taken from the default one."""
+    name: str
+    deployment: Optional[str] = None
+    endpoint: Optional[str] = None
+    api_key: Optional[str] = None
+    api_version: Optional[str] = None
+    temperature: Optional[float] = None
+    max_tokens: Optional[int] = None
+    timeout: Optional[float] = None
+    # Quota of this deployment for its own LLM scheduler (0 = no limit); the default model uses LLM_*_PER_MINUTE
+    requests_per_minute: float = 0
+    tokens_per_minute: float = 0
+    # Another model (e.g. the same deployment in a second region) that slow calls are duplicated to (hedging.py)
+    hedge_model: Optional[str] = None
+
+    def fingerprint_fields(self) -> dict:
+        # What changes the answers (not the credentials or limits)
+        return {"deployment": self.deployment, "temperature": self.temperature, "max_tokens": self.max_tokens,
+                "hedge_model": self.hedge_model}
+
+
+def parse_model_specs(models_json: Optional[str]) -> Dict[str, ModelSpec]:
+    """
+    Reads LLM_MODELS, e.g.
+        {"fast": {"deployment": "gpt-4o-mini", "timeout": 20, "max_tokens": 1500, "temperature": 0},
+         "default": {"hedge_model": "westeurope"}, "westeurope": {"endpoint": "https://...", "deployment": "gpt-4o"}}
+    The "default" model comes from the AZURE_OPENAI_* settings and may be overridden the same way.
+    """
+    default = ModelSpec(
+        DEFAULT_MODEL,
+        deployment=AZURE_OPENAI_CHAT_DEPLOYMENT_NAME,
+        endpoint=AZURE_OPENAI_ENDPOINT,
+        api_key=AZURE_OPENAI_API_KEY,
+        api_version=API_VERSION,
+        timeout=LLM_REQUEST_TIMEOUT_SECONDS,
+    )
+    raw = json.loads(models_json) if models_json else {}
+    known = {f.name for f in fields(ModelSpec)} - {"name"}
+    for name, settings in raw.items():
+        unknown = set(settings) - known
+        if unknown:
+            raise ValueError(f"LLM_MODELS['{name}'] has unknown settings {sorted(unknown)}")
+    if DEFAULT_MODEL in raw:
+        default = replace(default, **raw[DEFAULT_MODEL])
+    specs = {DEFAULT_MODEL: default}
+    for name, settings in raw.items():
+        if name != DEFAULT_MODEL:
+            inherited = {k: v for k, v in asdict(default).items() if k in ("endpoint", "api_key", "api_version", "timeout")}
+            specs[name] = ModelSpec(name, **{**inherited, **settings})
+    for spec in specs.values():
+        if spec.hedge_model is not None and (spec.hedge_model not in specs or spec.hedge_model == spec.name):
+            raise ValueError(f"LLM_MODELS['{spec.name}'] hedges to unknown model '{spec.hedge_model}'")
+    return specs
+
+
+def parse_node_models(node_models_json: Optional[str], specs: Dict[str, ModelSpec]) -> Dict[str, str]:
+    """Reads LLM_NODE_MODELS, e.g. {"extract_information": "fast", "format_output": "fast"}."""
+    mapping = json.loads(node_models_json) if node_models_json else {}
+    for stage, model in mapping.items():
+        if stage not in NODE_STAGES:
+            raise ValueError(f"LLM_NODE_MODELS maps unknown stage '{stage}' (known: {sorted(NODE_STAGES)})")
+        if model not in specs:
+            raise ValueError(f"LLM_NODE_MODELS maps '{stage}' to unknown model '{model}'")
+    return mapping
+
+
+class ModelRegistry:
+    """
+    Named chat deployments and the model each stage uses. Clients are built on
+    first use and shared by every stage mapped to them; each is tagged with its
+    model name, so the LLM metrics (node x model latency and tokens) and the LLM
+    scheduler can tell them apart.
+    """
+
+    def __init__(self, specs: Dict[str, ModelSpec], node_models: Dict[str, str]):
+        self.specs = specs
+        self.node_models = node_models
+        self._clients: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def model_for(self, node: Optional[str]) -> str:
+        return self.node_models.get(node, DEFAULT_MODEL) if node else DEFAULT_MODEL
+
+    def get(self, name: str = DEFAULT_MODEL):
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._clients[name] = self._build(self.specs[name])
+        return client
+
+    def for_node(self, node: Optional[str]):
+        return self.get(self.model_for(node))
+
+    def _build(self, spec: ModelSpec):
+        from langchain_openai import AzureChatOpenAI
+        from llm_scheduler import LLMScheduler, register_scheduler, scheduled
+        from hedging import register_hedge
+        if spec.name != DEFAULT_MODEL and (spec.requests_per_minute or spec.tokens_per_minute):
+            # Quotas are per deployment, so a model with its own quota gets its own queue
+            register_scheduler(spec.name, LLMScheduler.from_config(spec.requests_per_minute, spec.tokens_per_minute))
+        if spec.hedge_model:
+            # The hedge client is only built once a call is first hedged
+            register_hedge(spec.name, lambda: self.get(spec.hedge_model))
+        optional = {k: v for k, v in (("temperature", spec.temperature), ("max_tokens", spec.max_tokens),
+                                       ("timeout", spec.timeout)) if v is not None}
+        # Every completion goes through the LLM scheduler, which also does the retrying
+        client = scheduled(AzureChatOpenAI)(
+            azure_endpoint=spec.endpoint,
+            api_key=spec.api_key,
+            azure_deployment=spec.deployment,
+            openai_api_version=spec.api_version,
+            max_retries=0,
+            metadata={"llm_model": spec.name},
+            **optional,
+        )
+        logger.info(f"Azure OpenAI chat client '{spec.name}' initialized (deployment {spec.deployment}).")
+        return client
+
+    def fingerprint(self) -> str:
+        """Changes whenever a stage would be answered by a different deployment or settings."""
+        payload = {
+            "models": {name: spec.fingerprint_fields() for name, spec in sorted(self.specs.items())},
+            "nodes": dict(sorted(self.node_models.items())),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def describe(self) -> dict:
+        return {
+            "models": {name: spec.fingerprint_fields() for name, spec in self.specs.items()},
+            "nodes": {stage: self.model_for(stage) for stage in sorted(NODE_STAGES)},
+            "built": sorted(self._clients),
+        }
+
+
+_SPECS = parse_model_specs(LLM_MODELS)
+MODEL_REGISTRY = ModelRegistry(_SPECS, parse_node_models(LLM_NODE_MODELS, _SPECS))
@@ -1,48 +1,175 @@
 # nodes.py
+import asyncio
+import functools
 import json
 import re
+import threading
+from typing import Any, Dict, List, Optional
 from pydantic import BaseModel, Field
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.agents import AgentExecutor, create_openai_tools_agent
 
 # Import shared components
 from state import WorkflowState
-from config import llm
-from tools import tool_rules_kb, tool_application_kb, tool_domain_kb
+from config import (
+    get_llm, get_embeddings_model, FORMAT_OUTPUT_MODE, FORMAT_OUTPUT_LLM_FALLBACK,
+    CLASSIFY_DEMAND_MODE, CLASSIFY_DOMAIN_MODE, SINGLE_SHOT_TOP_K, APP_EXTRACTION_MODE,
+    APPLICATION_LOOKUP_MODE, APP_VECTOR_MATCH_MIN_SCORE,
+)
+from app_directory import APP_DICTIONARY, APP_DIRECTORY, record_from_row, not_found_record
+from schemas import (
+    DemandClassification, DomainClassification, ApplicationRecord,
+    parse_demand_classification, parse_domain_classification, parse_application_records,
+)
+from report import render_report
+from tools import kb_tool, search_collection, asearch_collection
+
+
+class _LazyRunnable:
+    """
+    A chain or agent built on first use instead of at import. Attribute access
+    (invoke, ainvoke, ...) is forwarded to the built runnable.
+    """
 
-# Node 1: Extract initial information from the raw input
-def extract_information(state: WorkflowState):
-    print("---NODE: Running Information Extractor---")
-    
-    class ExtractedInfo(BaseModel):
-        title: str = Field(description="A concise, descriptive name for the demand, typically summarizing what the user wants or what the feature is. This is often used as the headline.")
-        description: str = Field(description="A full narrative or explanation of the demand, including context, pain points, business reasoning, technical background, and user perspective if available.")
-        request_type: str = Field(description="•Feature: a new capability or functionality \n•Bug: something that is broken and need to be fixed. Issues that requires fixes. Keywords are fix, error, bug, failure and etc. \n•Enhancement: improvement of an existing feature. Can also be described as version numbers 2.0,3.0 and etc. \n•Info/query: request for clarification or investigation. •Strategic Initiatives : Demands related to Strategic programs and the keyword is SP.")
-        urgency_cues: str = Field(description="Any time-sensitive language, phrases, or implications that indicate how urgent the demand is. E.g., “ASAP,” “before launch,” “regulatory deadline,” “customer complaint.” Even if no explicit due date is given, this helps infer priority. Urgency cues should be taken into consideration when it comes to priority assignment for each demand.  If there is urgency cue indicated, please leave it blank.")
-        module_services: str = Field(description="The specific system, product module, or feature area involved in the demand. This helps route work to the right team. The module should be categorized into core module/service or Non-core services that is affected. Core services are services that blocks the platform from being used at all. Non-core services are considered to be less important where the platform works fine but one/some of the features/services have issues.")
-        business_priority: str = Field(description="The perceived business impact or urgency from a business value standpoint. This could be: \n• High: compliance related, revenue-driving, time-sensitive, production issue which impacts customer. \n• Medium: useful but not urgent \n• Low: optional, exploratory, or minor enhancements.")
-        customer_impact: str = Field(description="A detailed explanation of how this demand affects users. It could include: \n• Size and type of affected users. Does it affect one group of users (e.g., Tabung users, split bill users), or all users (e.g., QRPay, Fund Transfer). \n• Pain level (inconvenience vs. critical failure). Critical failures are when there are issues with core services and needs immediate action to be taken. Inconveniences are minor issues that is not impacting the platform entirely. \n• Visibility to customers (internal-only vs. public-facing). The issue is public-facing where customers and users are involved and internal when it doesn’t affect the customer.")
-        due_date: str = Field(description="Any deadline explicitly stated or clearly implied in the description (e.g., “must go live in May”, “before Hari Raya”, “before campaign X”). Useful for planning timelines and SLAs.")
-        regulatory_impact: str = Field(description="Indicates if the demand is required for compliance with a regulation or law (e.g., Bank Negara guidelines, PDPA, GDPR, audit compliance). Important for legal and risk tracking. Failure to rectify this issue will result in fine or legal actions")
-        revenue_impact: str = Field(description="Describes how the demand could impact revenue streams — either by enabling new ones (e.g., launching a product) or preventing loss (e.g., fixing a payment failure).")
-        security_relevance: str = Field(description="Flags whether this demand touches sensitive systems or data, requires authentication changes, addresses vulnerabilities, or affects customer data security.")
+    def __init__(self, builder):
+        self._builder = builder
+        self._runnable = None
+        self._lock = threading.Lock()
+        _LAZY_RUNNABLES.append(self)
+
+    def get(self):
+        if self._runnable is None:
+            with self._lock:
+                if self._runnable is None:
+                    self._runnable = self._builder()
+        return self._runnable
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+_LAZY_RUNNABLES = []
 
+
+def build_runnables():
+    """Builds every chain and agent now (e.g. in a gunicorn master before the workers fork)."""
+    for runnable in _LAZY_RUNNABLES:
+        runnable.get()
+
+# Node 1: Extract initial information from the raw input
+# Defined once at module level so its JSON schema/tool binding is generated once per process
+class ExtractedInfo(BaseModel):
+    title: str = Field(description="A concise, descriptive name for the demand, typically summarizing what the user wants or what the feature is. This is often used as the headline.")
+    description: str = Field(description="A full narrative or explanation of the demand, including context, pain points, business reasoning, technical background, and user perspective if available.")
+    request_type: str = Field(description="•Feature: a new capability or functionality \n•Bug: something that is broken and need to be fixed. Issues that requires fixes. Keywords are fix, error, bug, failure and etc. \n•Enhancement: improvement of an existing feature. Can also be described as version numbers 2.0,3.0 and etc. \n•Info/query: request for clarification or investigation. •Strategic Initiatives : Demands related to Strategic programs and the keyword is SP.")
+    urgency_cues: str = Field(description="Any time-sensitive language, phrases, or implications that indicate how urgent the demand is. E.g., “ASAP,” “before launch,” “regulatory deadline,” “customer complaint.” Even if no explicit due date is given, this helps infer priority. Urgency cues should be taken into consideration when it comes to priority assignment for each demand.  If there is urgency cue indicated, please leave it blank.")
+    module_services: str = Field(description="The specific system, product module, or feature area involved in the demand. This helps route work to the right team. The module should be categorized into core module/service or Non-core services that is affected. Core services are services that blocks the platform from being used at all. Non-core services are considered to be less important where the platform works fine but one/some of the features/services have issues.")
+    business_priority: str = Field(description="The perceived business impact or urgency from a business value standpoint. This could be: \n• High: compliance related, revenue-driving, time-sensitive, production issue which impacts customer. \n• Medium: useful but not urgent \n• Low: optional, exploratory, or minor enhancements.")
+    customer_impact: str = Field(description="A detailed explanation of how this demand affects users. It could include: \n• Size and type of affected users. Does it affect one group of users (e.g., Tabung users, split bill users), or all users (e.g., QRPay, Fund Transfer). \n• Pain level (inconvenience vs. critical failure). Critical failures are when there are issues with core services and needs immediate action to be taken. Inconveniences are minor issues that is not impacting the platform entirely. \n• Visibility to customers (internal-only vs. public-facing). The issue is public-facing where customers and users are involved and internal when it doesn’t affect the customer.")
+    due_date: str = Field(description="Any deadline explicitly stated or clearly implied in the description (e.g., “must go live in May”, “before Hari Raya”, “before campaign X”). Useful for planning timelines and SLAs.")
+    regulatory_impact: str = Field(description="Indicates if the demand is required for compliance with a regulation or law (e.g., Bank Negara guidelines, PDPA, GDPR, audit compliance). Important for legal and risk tracking. Failure to rectify this issue will result in fine or legal actions")
+    revenue_impact: str = Field(description="Describes how the demand could impact revenue streams — either by enabling new ones (e.g., launching a product) or preventing loss (e.g., fixing a payment failure).")
+    security_relevance: str = Field(description="Flags whether this demand touches sensitive systems or data, requires authentication changes, addresses vulnerabilities, or affects customer data security.")
+
+
+def _build_extraction_chain():
     prompt = ChatPromptTemplate.from_messages([
         ("system", "You are an AI assistant that extracts structured information from demand descriptions. Based on the schema below, extract each field."),
         ("human", "{input}")
     ])
     
-    structured_llm = llm.with_structured_output(ExtractedInfo)
-    chain = prompt | structured_llm
-    result = chain.invoke({"input": state["raw_input"]})
-    
+    structured_llm = get_llm("extract_information").with_structured_output(ExtractedInfo)
+    return prompt | structured_llm
+
+# Batch variant used by batch.py: several demands extracted in one LLM round trip
+class IndexedExtractedInfo(ExtractedInfo):
+    demand_index: int = Field(description="The number of the demand this extraction belongs to, exactly as given in its 'DEMAND <n>' header.")
+
+class BatchExtractedInfo(BaseModel):
+    demands: List[IndexedExtractedInfo] = Field(description="One entry per demand in the input, in the same order.")
+
+def _build_batch_extraction_chain():
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", "You are an AI assistant that extracts structured information from demand descriptions. The input contains several independent demands, each starting with a 'DEMAND <n>' header. Extract each field of the schema for every demand separately, never mixing information between demands."),
+        ("human", "{input}")
+    ])
+    return prompt | get_llm("extract_information").with_structured_output(BatchExtractedInfo)
+
+# Built once (on first use, or by build_runnables()) and shared by every request. Runnables and AgentExecutors
+# keep no per-call state, so concurrent invoke()/ainvoke() calls are safe.
+EXTRACTION_CHAIN = _LazyRunnable(_build_extraction_chain)
+BATCH_EXTRACTION_CHAIN = _LazyRunnable(_build_batch_extraction_chain)
+
+def extract_information(state: WorkflowState):
+    if state.get("extracted_info"):
+        # Already extracted upstream (e.g. by abatch_extract_information)
+        return {}
+    print("---NODE: Running Information Extractor---")
+    result = EXTRACTION_CHAIN.invoke({"input": state["raw_input"]})
     return {"extracted_info": result.model_dump()} # Use .model_dump() for Pydantic V2
 
+async def aextract_information(state: WorkflowState):
+    if state.get("extracted_info"):
+        return {}
+    print("---NODE: Running Information Extractor (async)---")
+    result = await EXTRACTION_CHAIN.ainvoke({"input": state["raw_input"]})
+    return {"extracted_info": result.model_dump()}
+
+async def abatch_extract_information(raw_inputs: List[str]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Extracts several demands with a single structured-output call. Returns one
+    extracted_info dict per input, or None where the model skipped or garbled a
+    demand (extract_information then handles that one on its own).
+    """
+    print(f"---Running batched Information Extractor for {len(raw_inputs)} demands---")
+    text = "\n\n".join(f"DEMAND {i}\n{raw_input}" for i, raw_input in enumerate(raw_inputs))
+    result = await BATCH_EXTRACTION_CHAIN.ainvoke({"input": text})
+    extracted: List[Optional[Dict[str, Any]]] = [None] * len(raw_inputs)
+    for item in result.demands:
+        if 0 <= item.demand_index < len(raw_inputs) and extracted[item.demand_index] is None:
+            extracted[item.demand_index] = item.model_dump(exclude={"demand_index"})
+    return extracted
+
+# Retrieve-then-classify ("single_shot") mode for nodes 2 and 3: instead of an agent
+# deciding when to query the KB, the demand is embedded once, the top-k KB rows are
+# fetched directly and a single structured-output call classifies with that context.
+SINGLE_SHOT_SYSTEM_SUFFIX = """
+
+Execution note: you have no tools in this mode. The relevant excerpts of the knowledge base have already been retrieved and are given to you together with the demand. Base your answer only on those excerpts."""
+
+SINGLE_SHOT_HUMAN_PROMPT = """## Knowledge Base Excerpts ##
+{context}
+
+## Demand Information ##
+{input}"""
+
+def _build_single_shot_chain(node: str, system_prompt: str, schema):
+    prompt = ChatPromptTemplate.from_messages([("system", system_prompt + SINGLE_SHOT_SYSTEM_SUFFIX), ("human", SINGLE_SHOT_HUMAN_PROMPT)])
+    return prompt | get_llm(node).with_structured_output(schema)
+
+def _demand_query_text(extracted_info: Dict[str, Any]) -> str:
+    """The text embedded for single-shot retrieval: the parts of the demand that describe what it is."""
+    fields = ["title", "description", "request_type", "module_services", "regulatory_impact"]
+    return "\n".join(str(extracted_info.get(f, "")) for f in fields if extracted_info.get(f))
+
+def _format_context(documents) -> str:
+    if not documents:
+        return "No knowledge base entries were found."
+    return "\n\n".join(f"[{i}] {doc.page_content}" for i, doc in enumerate(documents, start=1))
+
+def _single_shot_input(state: WorkflowState, documents):
+    return {"context": _format_context(documents), "input": str(state["extracted_info"])}
+
+def _retrieve_context(collection_name: str, state: WorkflowState):
+    query_vector = get_embeddings_model().embed_query(_demand_query_text(state["extracted_info"]))
+    return search_collection(collection_name, query_vector, k=SINGLE_SHOT_TOP_K)
+
+async def _aretrieve_context(collection_name: str, state: WorkflowState):
+    # Both single-shot nodes embed the same text concurrently; the embeddings cache shares that request
+    query_vector = await get_embeddings_model().aembed_query(_demand_query_text(state["extracted_info"]))
+    return await asearch_collection(collection_name, query_vector, k=SINGLE_SHOT_TOP_K)
+
 # Node 2: Classify the demand using an agent and the 'rules_kb' tool
-def classify_demand(state: WorkflowState):
-    print("---NODE: Running Demand Classifier (Agent)---")
-    
-    system_prompt = """Objective:
+DEMAND_SYSTEM_PROMPT = """Objective:
 Your primary task is to classify a given input (e.g., a project description, demand request, initiative summary) into a specific Category and Sub-category as defined in the "Knowledge Base: RULES KB IN THE VECTOR STORE." You must also provide a Justification for your classification.
 
 Knowledge Base Reference:
@@ -111,22 +238,49 @@ Category : Non-Discretionary
 Sub-category : Regulatory Compliance
 Justification : The input mentions 'BNM,' 'e-KYC guidelines,' and 'mandatory submission,' which are common keywords and meet the classification criteria for Regulatory Compliance, such as referencing a regulatory authority and mandatory obligations.
 """
-    tools = [tool_rules_kb]
+
+def _build_demand_agent():
+    from langchain.agents import AgentExecutor, create_openai_tools_agent
+    tools = [kb_tool("rules_kb")]
     
-    prompt = ChatPromptTemplate.from_messages([("system", system_prompt), ("human", "{input}"), ("placeholder", "{agent_scratchpad}")])
-    agent = create_openai_tools_agent(llm, tools, prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools, handle_parsing_errors=True, verbose=True)
+    prompt = ChatPromptTemplate.from_messages([("system", DEMAND_SYSTEM_PROMPT), ("human", "{input}"), ("placeholder", "{agent_scratchpad}")])
+    agent = create_openai_tools_agent(get_llm("classify_demand"), tools, prompt)
+    return AgentExecutor(agent=agent, tools=tools, handle_parsing_errors=True, verbose=True)
+
+DEMAND_AGENT = _LazyRunnable(_build_demand_agent)
+DEMAND_SINGLE_SHOT_CHAIN = _LazyRunnable(functools.partial(_build_single_shot_chain, "classify_demand", DEMAND_SYSTEM_PROMPT, DemandClassification))
+
+def _demand_agent_input(state: WorkflowState):
+    return {"input": f"Please classify the following demand information based on your knowledge base: {str(state['extracted_info'])}"}
+
+def _demand_update(output: str):
+    parsed = parse_demand_classification(output)
+    return {"demand_classification": output, "demand_result": parsed.model_dump() if parsed else None}
 
-    result = agent_executor.invoke({
-        "input": f"Please classify the following demand information based on your knowledge base: {str(state['extracted_info'])}"
-    })
-    return {"demand_classification": result['output']}
+def _demand_structured_update(result: DemandClassification):
+    # Same text format the agent produces, so the LLM formatter and clients see no difference
+    return {"demand_classification": result.to_text(), "demand_result": result.model_dump()}
+
+def classify_demand(state: WorkflowState):
+    if CLASSIFY_DEMAND_MODE == "single_shot":
+        print("---NODE: Running Demand Classifier (single-shot)---")
+        documents = _retrieve_context("rules_kb", state)
+        return _demand_structured_update(DEMAND_SINGLE_SHOT_CHAIN.invoke(_single_shot_input(state, documents)))
+    print("---NODE: Running Demand Classifier (Agent)---")
+    result = DEMAND_AGENT.invoke(_demand_agent_input(state))
+    return _demand_update(result['output'])
+
+async def aclassify_demand(state: WorkflowState):
+    if CLASSIFY_DEMAND_MODE == "single_shot":
+        print("---NODE: Running Demand Classifier (single-shot, async)---")
+        documents = await _aretrieve_context("rules_kb", state)
+        return _demand_structured_update(await DEMAND_SINGLE_SHOT_CHAIN.ainvoke(_single_shot_input(state, documents)))
+    print("---NODE: Running Demand Classifier (Agent, async)---")
+    result = await DEMAND_AGENT.ainvoke(_demand_agent_input(state))
+    return _demand_update(result['output'])
 
 # Node 3: Classify the domain using an agent and the 'domain_kb' tool
-def classify_domain(state: WorkflowState):
-    print("---NODE: Running Domain Classifier (Agent)---")
-    
-    system_prompt = """Your Role: You are an AI assistant tasked with classifying new demand requirements into the correct business domains based on the provided knowledge base.
+DOMAIN_SYSTEM_PROMPT = """Your Role: You are an AI assistant tasked with classifying new demand requirements into the correct business domains based on the provided knowledge base.
 
 Your Primary Tool: You must use the "Knowledge Base" as your single source of truth for this task. All classifications, reasoning, and Domain Lead information must be based only on the information contained within it. You will consult the Knowledge Base for domain definitions and to retrieve the "Domain Lead" for each identified domain. Assume Domain Lead information is accessible within or via the Knowledge Base (this may involve searching a dedicated section or a vector store where Domain Lead information is stored).
 
@@ -164,21 +318,48 @@ Domain Lead: [Secondary Domain Lead]
 Reasoning: According to the Rules of Engagement, since the request also affects [functionality of secondary domain], this domain will be [Responsible/Consulted]."
 
 """
-    tools = [tool_domain_kb]
+
+def _build_domain_agent():
+    from langchain.agents import AgentExecutor, create_openai_tools_agent
+    tools = [kb_tool("domain_kb")]
     
-    prompt = ChatPromptTemplate.from_messages([("system", system_prompt), ("human", "{input}"), ("placeholder", "{agent_scratchpad}")])
-    agent = create_openai_tools_agent(llm, tools, prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools, handle_parsing_errors=True, verbose=True)
+    prompt = ChatPromptTemplate.from_messages([("system", DOMAIN_SYSTEM_PROMPT), ("human", "{input}"), ("placeholder", "{agent_scratchpad}")])
+    agent = create_openai_tools_agent(get_llm("classify_domain"), tools, prompt)
+    return AgentExecutor(agent=agent, tools=tools, handle_parsing_errors=True, verbose=True)
+
+DOMAIN_AGENT = _LazyRunnable(_build_domain_agent)
+DOMAIN_SINGLE_SHOT_CHAIN = _LazyRunnable(functools.partial(_build_single_shot_chain, "classify_domain", DOMAIN_SYSTEM_PROMPT, DomainClassification))
+
+def _domain_agent_input(state: WorkflowState):
+    return {"input": f"Please classify the following demand into a business domain based on your knowledge base: {str(state['extracted_info'])}"}
 
-    result = agent_executor.invoke({
-        "input": f"Please classify the following demand into a business domain based on your knowledge base: {str(state['extracted_info'])}"
-    })
-    return {"domain_classification": result['output']}
+def _domain_update(output: str):
+    parsed = parse_domain_classification(output)
+    return {"domain_classification": output, "domain_result": parsed.model_dump() if parsed else None}
+
+def _domain_structured_update(result: DomainClassification):
+    return {"domain_classification": result.to_text(), "domain_result": result.model_dump()}
+
+def classify_domain(state: WorkflowState):
+    if CLASSIFY_DOMAIN_MODE == "single_shot":
+        print("---NODE: Running Domain Classifier (single-shot)---")
+        documents = _retrieve_context("domain_kb", state)
+        return _domain_structured_update(DOMAIN_SINGLE_SHOT_CHAIN.invoke(_single_shot_input(state, documents)))
+    print("---NODE: Running Domain Classifier (Agent)---")
+    result = DOMAIN_AGENT.invoke(_domain_agent_input(state))
+    return _domain_update(result['output'])
+
+async def aclassify_domain(state: WorkflowState):
+    if CLASSIFY_DOMAIN_MODE == "single_shot":
+        print("---NODE: Running Domain Classifier (single-shot, async)---")
+        documents = await _aretrieve_context("domain_kb", state)
+        return _domain_structured_update(await DOMAIN_SINGLE_SHOT_CHAIN.ainvoke(_single_shot_input(state, documents)))
+    print("---NODE: Running Domain Classifier (Agent, async)---")
+    result = await DOMAIN_AGENT.ainvoke(_domain_agent_input(state))
+    return _domain_update(result['output'])
 
 # Node 4: Extract and then classify the applications
-def extract_and_classify_applications(state: WorkflowState):
-    print("---NODE: Running Application Extractor & Classifier---")
-    
+def _build_app_extractor_chain():
     extractor_prompt_text = """You are an AI assistant specialized in analyzing IT project titles and descriptions, particularly within a banking or financial technology context. Your task is to identify and extract the names of specific **Systems/Applications** mentioned.
 
 ENTITY DEFINITION:
@@ -235,16 +416,18 @@ Now, analyze the following text and provide the JSON output according to all the
     """
     
     extractor_prompt = ChatPromptTemplate.from_messages([("system", extractor_prompt_text), ("human", "{demand_info}")])
-    extractor_chain = extractor_prompt | llm
-    extractor_result = extractor_chain.invoke({"demand_info": str(state["extracted_info"])})
-    
-    print(f"RAW LLM OUTPUT FOR EXTRACTION: '{extractor_result.content}'")  
+    return extractor_prompt | get_llm("application_extractor")
+
+APP_EXTRACTOR_CHAIN = _LazyRunnable(_build_app_extractor_chain)
+
+def _parse_app_list(content: str):
+    print(f"RAW LLM OUTPUT FOR EXTRACTION: '{content}'")  
      
     app_list = []
     try:
         # Use a regular expression to find the JSON object within the backticks
         # re.DOTALL makes the '.' character match newlines as well
-        json_match = re.search(r'\{.*\}', extractor_result.content, re.DOTALL)
+        json_match = re.search(r'\{.*\}', content, re.DOTALL)
         
         if json_match:
             json_string = json_match.group(0)
@@ -259,10 +442,10 @@ Now, analyze the following text and provide the JSON output according to all the
         print(f"Failed to parse extracted JSON: {e}")
 
     print(f"Extracted applications: {app_list}")
+    return app_list
 
-    if not app_list:
-        return {"application_list": [], "application_details": "No applications were extracted from the input."}
-
+def _build_app_classifier_agent():
+    from langchain.agents import AgentExecutor, create_openai_tools_agent
     classifier_system_prompt = """
     
     ### IMPORTANT INSTRUCTIONS ###
@@ -339,18 +522,117 @@ the sample expected output is as below :
     "platform": "N/A"
   }}
 ]"""
-    tools = [tool_application_kb]
+    tools = [kb_tool("application_kb")]
     prompt = ChatPromptTemplate.from_messages([("system", classifier_system_prompt), ("human", "{input}"), ("placeholder", "{agent_scratchpad}")])
-    agent = create_openai_tools_agent(llm, tools, prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools, handle_parsing_errors=True, verbose=True)
-    
-    result = agent_executor.invoke({"input": f"Please provide details for the following applications: {str(app_list)}"})
-    return {"application_list": app_list, "application_details": result['output']}
-    
-# Node 5: The final formatter agent
-def format_output(state: WorkflowState):
-    print("---NODE: Formatting Final Output---")
+    agent = create_openai_tools_agent(get_llm("extract_and_classify_applications"), tools, prompt)
+    return AgentExecutor(agent=agent, tools=tools, handle_parsing_errors=True, verbose=True)
+
+APP_CLASSIFIER_AGENT = _LazyRunnable(_build_app_classifier_agent)
+
+# The dictionary also resolves aliases to the canonical names the directory lookup is keyed on
+USES_APP_DICTIONARY = APP_EXTRACTION_MODE == "dictionary" or APPLICATION_LOOKUP_MODE == "directory"
+
+NO_APPLICATIONS_RESULT = {"application_list": [], "application_details": "No applications were extracted from the input.", "application_records": []}
+
+def _applications_update(app_list, output: str):
+    parsed = parse_application_records(output)
+    return {
+        "application_list": app_list,
+        "application_details": output,
+        "application_records": [record.model_dump() for record in parsed] if parsed is not None else None,
+    }
+
+def _dictionary_text(state: WorkflowState) -> str:
+    # Same sources the LLM extractor is told to look at: the title and the description
+    info = state.get("extracted_info") or {}
+    return "\n".join([state.get("raw_input", ""), str(info.get("title", "")), str(info.get("description", ""))])
+
+def _dictionary_app_list(state: WorkflowState):
+    """Applications found by the app_kb dictionary; an empty list means 'ask the LLM'."""
+    if APP_EXTRACTION_MODE != "dictionary":
+        return []
+    app_list = APP_DICTIONARY.find(_dictionary_text(state))
+    print(f"Dictionary-extracted applications: {app_list}")
+    return app_list
+
+def _vector_match(name: str, documents) -> ApplicationRecord:
+    # Only trust the nearest app_kb row if it is close; a loose neighbour is a different application
+    if documents and documents[0].metadata.get("score", 0.0) >= APP_VECTOR_MATCH_MIN_SCORE:
+        doc = documents[0]
+        return record_from_row(name, doc.page_content, doc.metadata)
+    return not_found_record(name)
+
+def _directory_update(app_list, records: List[ApplicationRecord]):
+    # application_details keeps the JSON shape the application agent answers with
+    # Records are keyed by canonical name; two aliases of one application give one record
+    by_name = {record.system_name: record for record in records}
+    # A name is missing here if the dictionary was refreshed between the lookup and now
+    # (it then canonicalises differently); its record is kept under the name it was looked up by
+    ordered = [by_name.pop(name) for name in dict.fromkeys(APP_DICTIONARY.canonical(name) for name in app_list) if name in by_name]
+    ordered += by_name.values()
+    dumped = [record.model_dump(exclude_none=True) for record in ordered]
+    return {
+        "application_list": app_list,
+        "application_details": json.dumps(dumped, indent=2),
+        "application_records": [record.model_dump() for record in ordered],
+    }
+
+def _lookup_applications(app_list):
+    """Ownership records from the keyed app_kb lookup; vector search only for names without a row."""
+    records, missing = APP_DIRECTORY.lookup(app_list)
+    if missing:
+        print(f"No exact app_kb row for {missing}; falling back to vector search")
+        vectors = get_embeddings_model().embed_documents(missing)
+        records += [_vector_match(name, search_collection("app_kb", vector, k=1)) for name, vector in zip(missing, vectors)]
+    return _directory_update(app_list, records)
+
+async def _alookup_applications(app_list):
+    records, missing = await APP_DIRECTORY.alookup(app_list)
+    if missing:
+        print(f"No exact app_kb row for {missing}; falling back to vector search")
+        vectors = await get_embeddings_model().aembed_documents(missing)
+        matches = await asyncio.gather(*(asearch_collection("app_kb", vector, k=1) for vector in vectors))
+        records += [_vector_match(name, documents) for name, documents in zip(missing, matches)]
+    return _directory_update(app_list, records)
+
+def extract_and_classify_applications(state: WorkflowState):
+    print("---NODE: Running Application Extractor & Classifier---")
+    if USES_APP_DICTIONARY and APP_DICTIONARY.is_due():
+        APP_DICTIONARY.refresh()
+    app_list = _dictionary_app_list(state)
+    if not app_list:
+        extractor_result = APP_EXTRACTOR_CHAIN.invoke({"demand_info": str(state["extracted_info"])})
+        app_list = _parse_app_list(extractor_result.content)
+    if not app_list:
+        return dict(NO_APPLICATIONS_RESULT)
+
+    if APPLICATION_LOOKUP_MODE == "directory":
+        return _lookup_applications(app_list)
+    result = APP_CLASSIFIER_AGENT.invoke({"input": f"Please provide details for the following applications: {str(app_list)}"})
+    return _applications_update(app_list, result['output'])
+
+async def aextract_and_classify_applications(state: WorkflowState):
+    print("---NODE: Running Application Extractor & Classifier (async)---")
+    if USES_APP_DICTIONARY and APP_DICTIONARY.is_due():
+        # Refresh reads app_kb through the sync pool; keep that off the event loop
+        await asyncio.to_thread(APP_DICTIONARY.refresh)
+    app_list = _dictionary_app_list(state)
+    if not app_list:
+        extractor_result = await APP_EXTRACTOR_CHAIN.ainvoke({"demand_info": str(state["extracted_info"])})
+        app_list = _parse_app_list(extractor_result.content)
+    if not app_list:
+        return dict(NO_APPLICATIONS_RESULT)
 
+    if APPLICATION_LOOKUP_MODE == "directory":
+        return await _alookup_applications(app_list)
+    result = await APP_CLASSIFIER_AGENT.ainvoke({"input": f"Please provide details for the following applications: {str(app_list)}"})
+    return _applications_update(app_list, result['output'])
+    
+# Node 5: The final formatter. By default the report is rendered from the typed
+# node results (report.py); the LLM formatter below is only used when
+# FORMAT_OUTPUT_MODE=llm, or as a fallback if FORMAT_OUTPUT_LLM_FALLBACK is on
+# and a node's answer could not be parsed.
+def _build_formatter_chain():
     system_prompt = """Your task is to take the provided classification sections and present them in a structured output. Follow these guidelines precisely:
 
  Categorization Details:
@@ -434,12 +716,53 @@ This application directly supports online payment processing for e-commerce tran
 """
     
     prompt = ChatPromptTemplate.from_messages([("system", system_prompt), ("human", prompt_template)])
-    chain = prompt | llm
-    
-    result = chain.invoke({
+    return prompt | get_llm("format_output")
+
+FORMATTER_CHAIN = _LazyRunnable(_build_formatter_chain)
+
+def _formatter_input(state: WorkflowState):
+    return {
         "demand": state['demand_classification'],
         "domain": state['domain_classification'],
         "apps": state['application_details']
-    })
+    }
+
+def _structured_results(state: WorkflowState):
+    demand = state.get("demand_result")
+    domain = state.get("domain_result")
+    records = state.get("application_records")
+    return (
+        DemandClassification.model_validate(demand) if demand else None,
+        DomainClassification.model_validate(domain) if domain else None,
+        [ApplicationRecord.model_validate(r) for r in records] if records is not None else None,
+    )
+
+def _use_llm_formatter(state: WorkflowState) -> bool:
+    if FORMAT_OUTPUT_MODE == "llm":
+        return True
+    return FORMAT_OUTPUT_LLM_FALLBACK and any(result is None for result in _structured_results(state))
+
+def _render_template(state: WorkflowState):
+    demand, domain, applications = _structured_results(state)
+    return {"final_output": render_report(
+        demand, domain, applications,
+        raw_demand=state.get("demand_classification", ""),
+        raw_domain=state.get("domain_classification", ""),
+        raw_applications=state.get("application_details", ""),
+    )}
+
+def format_output(state: WorkflowState):
+    print("---NODE: Formatting Final Output---")
+    if not _use_llm_formatter(state):
+        return _render_template(state)
+    result = FORMATTER_CHAIN.invoke(_formatter_input(state))
+    return {"final_output": result.content}
+
+async def aformat_output(state: WorkflowState):
+    print("---NODE: Formatting Final Output (async)---")
+    if not _use_llm_formatter(state):
+        return _render_template(state)
+    result = await FORMATTER_CHAIN.ainvoke(_formatter_input(state))
     return {"final_output": result.content}
+
   
@@ -0,0 +1,84 @@
+# report.py
+from typing import List, Optional
+
+from schemas import DemandClassification, DomainClassification, ApplicationRecord
+
+NOT_FOUND = "not found"
+_MISSING_VALUES = {"", "not found", "n/a", "none", "null"}
+
+APPLICATION_COLUMNS = ["SYSTEM", "TECH LEAD", "IT OWNER", "REGIONAL AVAILABILITY", "PLATFORM"]
+
+
+def _value(value: Optional[str]) -> str:
+    if value is None or value.strip().lower() in _MISSING_VALUES:
+        return NOT_FOUND
+    return value.strip()
+
+
+def _cell(value: str) -> str:
+    # Keep every row on one line and don't let a value close the cell early
+    return " ".join(value.split()).replace("|", "/")
+
+
+def render_demand_section(demand: Optional[DemandClassification], raw_text: str = "") -> str:
+    if demand is None:
+        # Unparseable answer: keep the agent's text rather than dropping it
+        return f"CATEGORY:\n{NOT_FOUND}\n\nSUB CATEGORY:\n{NOT_FOUND}\n\nJUSTIFICATION:\n{_value(raw_text)}"
+    return (
+        f"CATEGORY:\n{_value(demand.category)}\n\n"
+        f"SUB CATEGORY:\n{_value(demand.sub_category)}\n\n"
+        f"JUSTIFICATION:\n{_value(demand.justification)}"
+    )
+
+
+def render_application_table(applications: Optional[List[ApplicationRecord]], raw_text: str = "") -> str:
+    lines = ["### 🧾 APPLICATION INFORMATION", ""]
+    if applications is None and raw_text:
+        lines.append(raw_text.strip())
+        return "\n".join(lines)
+    rows = [[_cell(_value(app.system_name)), _cell(_value(app.tech_lead.name)), _cell(_value(app.it_owner.name)),
+             _cell(_value(app.regional_availability)), _cell(_value(app.platform))]
+            for app in applications or []]
+    if not rows:
+        rows = [[NOT_FOUND] * len(APPLICATION_COLUMNS)]
+    widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(APPLICATION_COLUMNS)]
+
+    def line(cells):
+        return "| " + " | ".join(cell.ljust(width) for cell, width in zip(cells, widths)) + " |"
+
+    lines.append(line(APPLICATION_COLUMNS))
+    lines.append("| " + " | ".join(":" + "-" * (width - 1) for width in widths) + " |")
+    lines.extend(line(row) for row in rows)
+    return "\n".join(lines)
+
+
+def render_domain_section(domains: Optional[DomainClassification], raw_text: str = "") -> str:
+    if domains is None:
+        return f"DOMAIN:\n{NOT_FOUND}\n\nDOMAIN LEAD:\n{NOT_FOUND}\n\nJUSTIFICATION:\n{_value(raw_text)}"
+    assignments = [domains.main_domain, *domains.impacted_domains]
+    domain_lines = "\n".join(f"{_value(a.domain)} ({_value(a.role)})" for a in assignments)
+    lead_lines = "\n".join(f"{_value(a.lead)} ({_value(a.domain)})" for a in assignments)
+    justification_lines = "\n".join(f"{_value(a.domain)}: {_value(a.reasoning)}" for a in assignments)
+    return f"DOMAIN:\n{domain_lines}\n\nDOMAIN LEAD:\n{lead_lines}\n\nJUSTIFICATION:\n{justification_lines}"
+
+
+def render_report(
+    demand: Optional[DemandClassification],
+    domains: Optional[DomainClassification],
+    applications: Optional[List[ApplicationRecord]],
+    raw_demand: str = "",
+    raw_domain: str = "",
+    raw_applications: str = "",
+) -> str:
+    """
+    Builds the final CATEGORY / APPLICATION INFORMATION / DOMAIN report in the
+    layout the format_output prompt describes. A section whose structured result
+    is missing falls back to the node's raw text.
+    """
+    return "\n\n".join([
+        render_demand_section(demand, raw_demand),
+        "---",
+        render_application_table(applications, raw_applications),
+        "---",
+        render_domain_section(domains, raw_domain),
+    ]) + "\n"
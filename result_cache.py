@@ -0,0 +1,184 @@
+# result_cache.py
+import hashlib
+import inspect
+import json
+import math
+import time
+import threading
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from psycopg.types.json import Jsonb
+
+import nodes
+from config import (
+    AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME,
+    RESULT_CACHE_BACKEND, RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_MAX_ENTRIES, KB_FINGERPRINT_TTL_SECONDS,
+)
+from db import get_async_pool, atable_watermark
+from model_registry import MODEL_REGISTRY
+from tools import KB_COLLECTIONS, retrievers_fingerprint
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def canonicalize_input(raw_input: str) -> str:
+    """Resubmissions that only differ in whitespace or casing map to the same text."""
+    return " ".join(raw_input.split()).casefold()
+
+
+# Prompts live in nodes.py, so its source hash changes whenever a prompt, schema or node changes
+_CODE_FINGERPRINT = hashlib.sha256(inspect.getsource(nodes).encode("utf-8")).hexdigest()
+
+_kb_fingerprint = None
+_kb_fingerprint_at = 0.0
+
+
+async def kb_fingerprint() -> str:
+    """Hash of the KB table watermarks, re-read at most every KB_FINGERPRINT_TTL_SECONDS."""
+    global _kb_fingerprint, _kb_fingerprint_at
+    if _kb_fingerprint is None or time.monotonic() - _kb_fingerprint_at > KB_FINGERPRINT_TTL_SECONDS:
+        try:
+            pool = await get_async_pool()
+            async with pool.connection() as conn:
+                watermarks = [await atable_watermark(conn, table) for table in KB_COLLECTIONS]
+            _kb_fingerprint = hashlib.sha256(json.dumps(watermarks).encode("utf-8")).hexdigest()
+        except Exception as e:
+            # Without a KB state we cannot tell whether a cached result is still valid
+            logger.warning(f"Could not read KB watermarks for the cache fingerprint: {e}")
+            _kb_fingerprint = "unavailable"
+        _kb_fingerprint_at = time.monotonic()
+    return _kb_fingerprint
+
+
+def pin_kb_fingerprint(fingerprint: str):
+    """Uses a fixed KB fingerprint instead of reading the watermarks (offline tooling with a seeded KB)."""
+    global _kb_fingerprint, _kb_fingerprint_at
+    _kb_fingerprint, _kb_fingerprint_at = fingerprint, math.inf
+
+
+async def version_fingerprint() -> str:
+    """Everything besides the input that determines the pipeline's output."""
+    parts = [_CODE_FINGERPRINT, MODEL_REGISTRY.fingerprint(), AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME or "",
+             retrievers_fingerprint(), await kb_fingerprint()]
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+async def cache_key(raw_input: str) -> str:
+    version = await version_fingerprint()
+    return hashlib.sha256(f"{version}\x00{canonicalize_input(raw_input)}".encode("utf-8")).hexdigest()
+
+
+class InMemoryResultCache:
+    """Per-process LRU with a TTL per entry."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return dict(entry[1]) # callers may add keys to the response
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    async def set(self, key: str, value: dict):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "memory", "hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+class PostgresResultCache:
+    """Shared by every gunicorn worker (and every pod) through one table."""
+
+    PRUNE_EVERY = 50 # writes between eviction passes
+
+    def __init__(self, max_entries: int, ttl_seconds: float, table_name: str = "analysis_result_cache"):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.table_name = table_name
+        self._table_ready = False
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def _ensure_table(self, conn):
+        if not self._table_ready:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    cache_key text PRIMARY KEY,
+                    result jsonb NOT NULL,
+                    created_at timestamptz NOT NULL DEFAULT now(),
+                    expires_at timestamptz NOT NULL
+                )""")
+            await conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_created_at_idx ON {self.table_name} (created_at)")
+            self._table_ready = True
+
+    async def get(self, key: str) -> Optional[dict]:
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await self._ensure_table(conn)
+            cur = await conn.execute(
+                f"SELECT result FROM {self.table_name} WHERE cache_key = %s AND expires_at > now()", (key,)
+            )
+            row = await cur.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    async def set(self, key: str, value: dict):
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await self._ensure_table(conn)
+            await conn.execute(
+                f"""INSERT INTO {self.table_name} (cache_key, result, expires_at)
+                    VALUES (%s, %s, now() + make_interval(secs => %s))
+                    ON CONFLICT (cache_key) DO UPDATE
+                    SET result = EXCLUDED.result, created_at = now(), expires_at = EXCLUDED.expires_at""",
+                (key, Jsonb(value), self.ttl_seconds),
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                await self._prune(conn)
+
+    async def _prune(self, conn):
+        await conn.execute(f"DELETE FROM {self.table_name} WHERE expires_at <= now()")
+        await conn.execute(
+            f"""DELETE FROM {self.table_name} WHERE cache_key IN (
+                    SELECT cache_key FROM {self.table_name} ORDER BY created_at DESC OFFSET %s)""",
+            (self.max_entries,),
+        )
+
+    def stats(self) -> dict:
+        return {"backend": "postgres", "hits": self.hits, "misses": self.misses}
+
+
+def create_result_cache():
+    if RESULT_CACHE_BACKEND == "postgres":
+        return PostgresResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL_SECONDS)
+    if RESULT_CACHE_BACKEND == "memory":
+        return InMemoryResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL_SECONDS)
+    return None
+
+
+result_cache = create_result_cache()
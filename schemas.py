@@ -0,0 +1,130 @@
+# schemas.py
+import json
+import re
+from typing import Any, List, Optional
+from pydantic import BaseModel, Field, ValidationError, field_validator
+
+# Typed results of the classifier nodes. They are stored in the graph state as
+# plain dicts (model_dump) so the state stays JSON-serializable for the caches.
+
+class DemandClassification(BaseModel):
+    category: str = Field(description="Non-Discretionary, Discretionary or 'Unable to classify'.")
+    sub_category: str = Field(description="The subclass name from the rules knowledge base.")
+    justification: str = Field(description="Why the demand fits this sub-category, citing matched keywords and criteria.")
+
+    def to_text(self) -> str:
+        """The 'Category : ...' layout the demand agent answers in."""
+        return f"Category : {self.category}\nSub-category : {self.sub_category}\nJustification : {self.justification}"
+
+
+class DomainAssignment(BaseModel):
+    domain: str = Field(description="Name of the business domain.")
+    role: str = Field(description="Accountable, Accountable/Responsible, Responsible or Consulted/Informed.")
+    lead: str = Field(description="The Domain Lead from the knowledge base, or 'not found'.")
+    reasoning: str = Field(description="Why this domain is involved, citing keywords and knowledge-base rules.")
+
+
+class DomainClassification(BaseModel):
+    main_domain: DomainAssignment = Field(description="The domain with primary accountability for the demand.")
+    impacted_domains: List[DomainAssignment] = Field(default_factory=list, description="Secondary/impacted domains, if any.")
+
+    def to_text(self) -> str:
+        """The 'Main Domain (Role): ...' layout the domain agent answers in."""
+        blocks = []
+        for kind, a in [("Main", self.main_domain)] + [("Impacted", d) for d in self.impacted_domains]:
+            blocks.append(f"{kind} Domain ({a.role}): {a.domain}\nDomain Lead: {a.lead}\nReasoning: {a.reasoning}")
+        return "\n\n".join(blocks)
+
+
+class Person(BaseModel):
+    name: str = "Not Found"
+    email: str = "Not Found"
+
+
+class ApplicationRecord(BaseModel):
+    system_name: str
+    tech_lead: Person = Field(default_factory=Person)
+    it_owner: Person = Field(default_factory=Person)
+    regional_availability: str = "Not Found"
+    platform: str = "Not Found"
+    status: Optional[str] = None # e.g. "Not found in vector store"
+
+    @field_validator("tech_lead", "it_owner", mode="before")
+    @classmethod
+    def _person_from_string(cls, value: Any):
+        # The agent sometimes answers with a bare name instead of {name, email}
+        if isinstance(value, str):
+            return {"name": value}
+        return value
+
+    @field_validator("regional_availability", "platform", mode="before")
+    @classmethod
+    def _join_lists(cls, value: Any):
+        if isinstance(value, list):
+            return ", ".join(str(v) for v in value)
+        return value
+
+
+# --- Parsers for the text formats the agent prompts ask for ---
+
+def _clean(value: str) -> str:
+    return value.replace("**", "").strip().strip('"').strip()
+
+
+_CATEGORY_RE = re.compile(r"^[\s*#>-]*category[\s*]*:(.*)$", re.IGNORECASE | re.MULTILINE)
+_SUB_CATEGORY_RE = re.compile(r"^[\s*#>-]*sub[\s-]*category[\s*]*:(.*)$", re.IGNORECASE | re.MULTILINE)
+_JUSTIFICATION_RE = re.compile(r"^[\s*#>-]*justification[\s*]*:(.*)", re.IGNORECASE | re.MULTILINE | re.DOTALL)
+
+
+def parse_demand_classification(text: str) -> Optional[DemandClassification]:
+    """Parses the 'Category : / Sub-category : / Justification :' answer of classify_demand."""
+    category = _CATEGORY_RE.search(text or "")
+    sub_category = _SUB_CATEGORY_RE.search(text or "")
+    if not category or not sub_category:
+        return None
+    justification = _JUSTIFICATION_RE.search(text)
+    return DemandClassification(
+        category=_clean(category.group(1)),
+        sub_category=_clean(sub_category.group(1)),
+        justification=_clean(justification.group(1)) if justification else "not found",
+    )
+
+
+_DOMAIN_HEADER_RE = re.compile(
+    r"^[\s*#>-]*(main|impacted|secondary(?:/impacted)?)\s+domain(?:\(s\))?[\s*]*(?:\(([^)]*)\))?[\s*]*:(.*)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+_DOMAIN_LEAD_RE = re.compile(r"^[\s*#>-]*domain\s+lead[\s*]*:(.*)$", re.IGNORECASE | re.MULTILINE)
+_REASONING_RE = re.compile(r"^[\s*#>-]*(?:reasoning|justification)[\s*]*:(.*)", re.IGNORECASE | re.MULTILINE | re.DOTALL)
+
+
+def parse_domain_classification(text: str) -> Optional[DomainClassification]:
+    """Parses the 'Main Domain (Role): X / Domain Lead: / Reasoning:' blocks of classify_domain."""
+    headers = list(_DOMAIN_HEADER_RE.finditer(text or ""))
+    assignments = []
+    for i, header in enumerate(headers):
+        block = text[header.end():headers[i + 1].start() if i + 1 < len(headers) else len(text)]
+        lead = _DOMAIN_LEAD_RE.search(block)
+        reasoning = _REASONING_RE.search(block)
+        assignments.append((header.group(1).lower(), DomainAssignment(
+            domain=_clean(header.group(3)) or "not found",
+            role=_clean(header.group(2) or "") or "not found",
+            lead=_clean(lead.group(1)) if lead else "not found",
+            reasoning=_clean(reasoning.group(1)) if reasoning else "not found",
+        )))
+    main = [a for kind, a in assignments if kind == "main"]
+    if not main:
+        return None
+    return DomainClassification(main_domain=main[0], impacted_domains=[a for kind, a in assignments if kind != "main"])
+
+
+def parse_application_records(text: str) -> Optional[List[ApplicationRecord]]:
+    """Parses the JSON list of application objects the application agent returns."""
+    json_match = re.search(r"\[.*\]", text or "", re.DOTALL)
+    if not json_match:
+        return None
+    try:
+        items = json.loads(json_match.group(0))
+        return [ApplicationRecord.model_validate(item) for item in items if isinstance(item, dict)]
+    except (json.JSONDecodeError, ValidationError):
+        return None
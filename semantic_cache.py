@@ -0,0 +1,310 @@
+# semantic_cache.py
+import asyncio
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+import logging
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import numpy as np
+from psycopg.types.json import Jsonb
+
+from config import (
+    get_embeddings_model, SEMANTIC_CACHE_BACKEND, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL_SECONDS,
+    SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_NODES,
+)
+from db import get_async_pool
+from metrics import SEMANTIC_CACHE_LOOKUPS, SEMANTIC_CACHE_SIMILARITY, SEMANTIC_CACHE_REUSED
+from result_cache import version_fingerprint
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# State keys each classifier node writes, i.e. what a match hands back instead of running it.
+# The last key is the node's parsed result: None means the answer could not be parsed, and such runs are not stored.
+NODE_OUTPUTS = {
+    "classify_demand": ["demand_classification", "demand_result"],
+    "classify_domain": ["domain_classification", "domain_result"],
+    "extract_and_classify_applications": ["application_list", "application_details", "application_records"],
+}
+for _node in SEMANTIC_CACHE_NODES:
+    if _node not in NODE_OUTPUTS:
+        raise ValueError(f"SEMANTIC_CACHE_NODES names unknown node '{_node}' (known: {sorted(NODE_OUTPUTS)})")
+
+# Set for a run that must not reuse past results (bypass_cache); graph nodes run in copies of the caller's context
+_bypass: contextvars.ContextVar = contextvars.ContextVar("semantic_cache_bypass", default=False)
+# Stores in flight: the event loop only holds weak references to tasks
+_store_tasks: set = set()
+
+
+@contextlib.contextmanager
+def semantic_cache_bypass(enabled: bool = True):
+    """Graph runs started inside this block analyze the demand afresh (their results are still stored)."""
+    token = _bypass.set(enabled)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class InMemorySemanticCache:
+    """Per-process store of past demands, searched with one matrix product."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # id -> (version, expires_at, unit vector, raw_input, outputs); least recently used first
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self._matrix = None # stacked vectors of _ids, rebuilt after an entry is added or removed
+        self._ids: List[int] = []
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    async def search(self, vector, version: str) -> Optional[dict]:
+        with self._lock:
+            now = time.monotonic()
+            # Entries of an older KB/model/code version or past their TTL can never match again
+            stale = [i for i, entry in self._entries.items() if entry[0] != version or entry[1] <= now]
+            for entry_id in stale:
+                del self._entries[entry_id]
+            if stale:
+                self._matrix = None
+            if not self._entries:
+                return None
+            if self._matrix is None:
+                self._ids = list(self._entries)
+                self._matrix = np.stack([self._entries[i][2] for i in self._ids])
+            scores = self._matrix @ _unit(vector)
+            best = int(np.argmax(scores))
+            entry_id = self._ids[best]
+            _, _, _, raw_input, outputs = self._entries[entry_id]
+            self._entries.move_to_end(entry_id)
+            return {"entry": entry_id, "similarity": float(scores[best]), "matched_input": raw_input, "outputs": outputs}
+
+    async def add(self, vector, version: str, raw_input: str, outputs: dict):
+        with self._lock:
+            self._next_id += 1
+            self._entries[self._next_id] = (version, time.monotonic() + self.ttl_seconds, _unit(vector), raw_input, outputs)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "memory", "size": len(self._entries)}
+
+
+class PostgresSemanticCache:
+    """Shared by every gunicorn worker (and every pod) through one pgvector table with an HNSW index."""
+
+    PRUNE_EVERY = 50 # writes between eviction passes
+
+    def __init__(self, max_entries: int, ttl_seconds: float, table_name: str = "semantic_demand_cache"):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.table_name = table_name
+        self._table_dims = None
+        self._version = None # fingerprint the table was last pruned for
+        self._writes = 0
+
+    async def _ensure_table(self, conn, dims: int):
+        if self._table_dims == dims:
+            return
+        cur = await conn.execute(
+            "SELECT atttypmod FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'embedding'", (self.table_name,)
+        )
+        row = await cur.fetchone()
+        if row is not None and row[0] != dims:
+            # The embedding deployment changed: none of the stored vectors are comparable any more
+            logger.warning(f"Recreating {self.table_name} for {dims}-dimensional embeddings (was {row[0]})")
+            await conn.execute(f"DROP TABLE {self.table_name}")
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table_name} (
+                id bigserial PRIMARY KEY,
+                version text NOT NULL,
+                raw_input text NOT NULL,
+                outputs jsonb NOT NULL,
+                embedding vector({dims}) NOT NULL,
+                created_at timestamptz NOT NULL DEFAULT now(),
+                used_at timestamptz NOT NULL DEFAULT now(),
+                expires_at timestamptz NOT NULL
+            )""")
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_embedding_idx ON {self.table_name} "
+                           f"USING hnsw (embedding vector_cosine_ops)")
+        self._table_dims = dims
+
+    async def search(self, vector, version: str) -> Optional[dict]:
+        vector = np.asarray(vector, dtype=np.float32)
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await self._ensure_table(conn, len(vector))
+            if version != self._version:
+                # Dropped at once, so the index is not left searching mostly unmatchable rows
+                await self._prune(conn, version)
+                self._version = version
+            cur = await conn.execute(
+                f"""SELECT id, raw_input, outputs, 1 - (embedding <=> %s::vector) FROM {self.table_name}
+                    WHERE version = %s AND expires_at > now()
+                    ORDER BY embedding <=> %s::vector LIMIT 1""",
+                (vector, version, vector),
+                prepare=True,
+            )
+            row = await cur.fetchone()
+            if row is None:
+                return None
+            await conn.execute(f"UPDATE {self.table_name} SET used_at = now() WHERE id = %s", (row[0],))
+        return {"entry": row[0], "similarity": float(row[3]), "matched_input": row[1], "outputs": row[2]}
+
+    async def add(self, vector, version: str, raw_input: str, outputs: dict):
+        vector = np.asarray(vector, dtype=np.float32)
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await self._ensure_table(conn, len(vector))
+            await conn.execute(
+                f"""INSERT INTO {self.table_name} (version, raw_input, outputs, embedding, expires_at)
+                    VALUES (%s, %s, %s, %s, now() + make_interval(secs => %s))""",
+                (version, raw_input, Jsonb(outputs), vector, self.ttl_seconds),
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                await self._prune(conn, version)
+
+    async def _prune(self, conn, version: str):
+        # Entries from before a KB, model or code change are never matched again
+        await conn.execute(f"DELETE FROM {self.table_name} WHERE expires_at <= now() OR version <> %s", (version,))
+        await conn.execute(
+            f"""DELETE FROM {self.table_name} WHERE id IN (
+                    SELECT id FROM {self.table_name} ORDER BY used_at DESC OFFSET %s)""",
+            (self.max_entries,),
+        )
+
+    def stats(self) -> dict:
+        return {"backend": "postgres"}
+
+
+class SemanticCache:
+    """
+    Reuses the classifier results of an earlier demand whose raw input embeds
+    within SEMANTIC_CACHE_THRESHOLD cosine similarity of the new one. Entries
+    carry the result cache's version fingerprint (KB watermarks, models, prompts,
+    retriever settings), so a KB change invalidates them.
+    """
+
+    def __init__(self, store, threshold: float, nodes: List[str]):
+        self.store = store
+        self.threshold = threshold
+        self.nodes = nodes
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+
+    async def lookup(self, raw_input: str) -> dict:
+        """The response flag of a run: {"hit": bool, "similarity": ..., ...}, with the reusable outputs on a hit."""
+        try:
+            vector = await get_embeddings_model().aembed_query(raw_input)
+            match = await self.store.search(vector, await version_fingerprint())
+        except Exception as e:
+            # The cache only ever saves work; a failing lookup means a normal run
+            SEMANTIC_CACHE_LOOKUPS.labels("error").inc()
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return {"hit": False}
+        if match is not None:
+            SEMANTIC_CACHE_SIMILARITY.observe(match["similarity"])
+        if match is None or match["similarity"] < self.threshold:
+            self.misses += 1
+            SEMANTIC_CACHE_LOOKUPS.labels("miss").inc()
+            return {"hit": False, "similarity": round(match["similarity"], 4) if match else None}
+        self.hits += 1
+        SEMANTIC_CACHE_LOOKUPS.labels("hit").inc()
+        outputs = {node: match["outputs"][node] for node in self.nodes if node in match["outputs"]}
+        logger.info(f"Semantic cache hit (similarity {match['similarity']:.3f}), reusing {sorted(outputs)}")
+        return {"hit": True, "similarity": round(match["similarity"], 4), "entry": match["entry"],
+                "matched_input": match["matched_input"][:200], "reused": sorted(outputs), "outputs": outputs}
+
+    async def store_run(self, state: dict):
+        outputs = {node: {key: state.get(key) for key in NODE_OUTPUTS[node]} for node in self.nodes}
+        if any(output[NODE_OUTPUTS[node][-1]] is None for node, output in outputs.items()):
+            # An unparsed answer is not worth handing to other demands
+            return
+        try:
+            vector = await get_embeddings_model().aembed_query(state["raw_input"]) # an embedding cache hit by now
+            await self.store.add(vector, await version_fingerprint(), state["raw_input"], outputs)
+            self.stored += 1
+        except Exception as e:
+            logger.warning(f"Could not store the demand in the semantic cache: {e}")
+
+    def stats(self) -> dict:
+        return {**self.store.stats(), "hits": self.hits, "misses": self.misses, "stored": self.stored}
+
+
+def create_semantic_cache() -> Optional[SemanticCache]:
+    if SEMANTIC_CACHE_BACKEND == "postgres":
+        store = PostgresSemanticCache(SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_TTL_SECONDS)
+    elif SEMANTIC_CACHE_BACKEND == "memory":
+        store = InMemorySemanticCache(SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_TTL_SECONDS)
+    else:
+        return None
+    return SemanticCache(store, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_NODES)
+
+
+semantic_cache = create_semantic_cache()
+
+
+def semantic_node(name: str, func: Callable, afunc: Callable):
+    """
+    Wraps a node's async implementation for the semantic cache:
+      extract_information also looks the raw input up (concurrently with the extraction),
+      the reused classifier nodes return the matched demand's outputs instead of running,
+      format_output stores the run's classifier outputs after a miss (in the background) and slims the flag.
+    The sync implementation is returned as is, like the cache is off.
+    """
+    if semantic_cache is None or not (name == "extract_information" or name == "format_output" or name in semantic_cache.nodes):
+        return func, afunc
+
+    if name == "extract_information":
+        @functools.wraps(afunc)
+        async def alooked_up(state):
+            if _bypass.get():
+                return {**await afunc(state), "semantic_cache": {"hit": False, "bypassed": True}}
+            lookup = asyncio.ensure_future(semantic_cache.lookup(state["raw_input"]))
+            try:
+                update = await afunc(state)
+            except BaseException:
+                lookup.cancel()
+                raise
+            return {**update, "semantic_cache": await lookup}
+        return func, alooked_up
+
+    if name == "format_output":
+        @functools.wraps(afunc)
+        async def astoring(state):
+            update = await afunc(state)
+            flag = state.get("semantic_cache")
+            if flag is None:
+                return update
+            if not flag["hit"]:
+                # In the background: the response does not wait for the embedding and the insert
+                task = asyncio.ensure_future(semantic_cache.store_run(state))
+                _store_tasks.add(task)
+                task.add_done_callback(_store_tasks.discard)
+            # The reused outputs are already in the state; the response only needs the flag
+            return {**update, "semantic_cache": {key: value for key, value in flag.items() if key != "outputs"}}
+        return func, astoring
+
+    @functools.wraps(afunc)
+    async def areused(state):
+        outputs = ((state.get("semantic_cache") or {}).get("outputs") or {}).get(name)
+        if outputs is None:
+            return await afunc(state)
+        SEMANTIC_CACHE_REUSED.labels(name).inc()
+        return dict(outputs)
+    return func, areused
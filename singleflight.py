@@ -0,0 +1,96 @@
+# singleflight.py
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Optional
+
+from db import get_lock_connection
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller starts the work,
+    later callers attach to the same task until it finishes. The work runs as its
+    own task, so a caller that disconnects or times out does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.leaders = 0     # calls that started a run
+        self.coalesced = 0   # calls that attached to a run already in flight
+        self.timeouts = 0    # coalesced callers that gave up waiting
+        self.failures = 0    # runs that raised (every attached caller gets the exception)
+
+    def _on_done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            # Reading the exception here also stops asyncio from logging it as "never retrieved"
+            self.failures += 1
+
+    async def do(self, key: str, fn: Callable[[], Awaitable], wait_timeout: Optional[float] = None):
+        """
+        Runs fn() once per key at a time. wait_timeout bounds how long a coalesced
+        caller waits; the caller that started the run waits for it to finish.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+            return await asyncio.shield(task)
+
+        self.coalesced += 1
+        logger.info(f"Coalescing request onto in-flight run {key[:12]}...")
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), wait_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+        }
+
+
+def _advisory_key(key: str) -> int:
+    # pg advisory locks take a signed bigint; the first 8 bytes of the sha256 key are plenty
+    return int.from_bytes(bytes.fromhex(key)[:8], "big", signed=True)
+
+
+@asynccontextmanager
+async def advisory_lock(key: str, timeout: float, poll_interval: float = 0.5):
+    """
+    Cross-worker single flight: holds a Postgres session advisory lock for the key
+    while the body runs. Yields True if the lock was taken, or False if it could not
+    be taken within timeout (the caller then just runs without it).
+    All locks of a process share one session, so they only exclude other
+    processes; within a process SingleFlight already coalesces the key.
+    """
+    lock_id = _advisory_key(key)
+    # Not a pool connection: the run inside the lock needs those for its own queries
+    conn = await get_lock_connection()
+    deadline = time.monotonic() + timeout
+    acquired = False
+    while True:
+        cur = await conn.execute("SELECT pg_try_advisory_lock(%s)", (lock_id,))
+        acquired = (await cur.fetchone())[0]
+        if acquired or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(poll_interval)
+    try:
+        yield acquired
+    finally:
+        # If the connection dropped meanwhile, the server has already released the lock
+        if acquired and not conn.closed:
+            await conn.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
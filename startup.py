@@ -0,0 +1,152 @@
+# startup.py
+import asyncio
+import threading
+import time
+import logging
+from typing import Dict, Optional
+
+from config import RETRIEVAL_BACKEND, get_llm, get_embeddings_model
+from metrics import STARTUP_SECONDS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Readiness:
+    """
+    Status of each startup phase of this process ("pending", "ok", "failed" or
+    "skipped") with its duration. The process is ready once no phase is
+    pending or failed.
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def set(self, phase: str, status: str, seconds: Optional[float] = None, error: Optional[str] = None):
+        with self._lock:
+            self.phases[phase] = {"status": status, "seconds": seconds, "error": error}
+
+    def _finish(self, phase: str, start: float, error: Optional[Exception]) -> bool:
+        seconds = time.perf_counter() - start
+        if error is not None:
+            logger.error(f"Startup phase '{phase}' failed: {error}")
+            self.set(phase, "failed", seconds, str(error))
+            return False
+        STARTUP_SECONDS.labels(phase).set(seconds)
+        logger.info(f"Startup phase '{phase}' took {seconds:.3f}s")
+        self.set(phase, "ok", seconds)
+        return True
+
+    def run(self, phase: str, fn) -> bool:
+        """Runs one phase, timing it. Failures are recorded, not raised. Returns True on success."""
+        self.set(phase, "pending")
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            return self._finish(phase, start, e)
+        return self._finish(phase, start, None)
+
+    async def arun(self, phase: str, fn) -> bool:
+        """run() for a coroutine function; sync functions are run in a thread."""
+        if not asyncio.iscoroutinefunction(fn):
+            return await asyncio.to_thread(self.run, phase, fn)
+        self.set(phase, "pending")
+        start = time.perf_counter()
+        try:
+            await fn()
+        except Exception as e:
+            return self._finish(phase, start, e)
+        return self._finish(phase, start, None)
+
+    def report(self) -> dict:
+        with self._lock:
+            phases = {name: dict(p) for name, p in self.phases.items()}
+        ready = bool(phases) and all(p["status"] in ("ok", "skipped") for p in phases.values())
+        return {"ready": ready, "phases": phases}
+
+    @property
+    def ready(self) -> bool:
+        return self.report()["ready"]
+
+
+readiness = Readiness()
+_preload_lock = threading.Lock()
+
+
+def preload():
+    """
+    CPU-only setup: builds the Azure clients, every chain and agent, and compiles
+    the graph (checkpoints.get_run_app only attaches the worker's checkpointer to
+    it). Opens no sockets or threads, so it can run in a gunicorn master before
+    forking (see gunicorn.conf.py); workers then share the result copy-on-write.
+    Idempotent.
+    """
+    with _preload_lock:
+        if readiness.phases.get("graph", {}).get("status") == "ok":
+            return
+        import nodes
+        from graph import get_app
+
+        readiness.run("clients", lambda: (get_llm(), get_embeddings_model()))
+        readiness.run("runnables", nodes.build_runnables)
+        readiness.run("graph", get_app)
+
+
+async def _run_until_ok(phase: str, fn, max_backoff: float = 30.0):
+    """Runs a phase, retrying with backoff until it succeeds (e.g. while Postgres is still starting)."""
+    delay = 1.0
+    while not await readiness.arun(phase, fn):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_backoff)
+
+
+def _refresh_app_dictionary():
+    from app_directory import APP_DICTIONARY
+    APP_DICTIONARY.refresh()
+    if not APP_DICTIONARY.loaded:
+        raise RuntimeError("the application dictionary could not be loaded from app_kb")
+
+
+async def _open_db_pool():
+    from db import get_async_pool
+    pool = await get_async_pool()
+    # Waits for min_size connections, so the first requests do not pay for the handshakes
+    await pool.wait(timeout=30)
+
+
+async def warm_up():
+    """
+    Per-worker warm-up after the fork: preload (if the master did not), then the
+    in-memory KB indexes, the application dictionary, the Postgres pool and the
+    run checkpointer, in parallel and retried until they succeed. Progress is visible on /ready.
+    """
+    from tools import KB_COLLECTIONS
+    from vector_index import warm_indexes
+    from nodes import USES_APP_DICTIONARY
+    from checkpoints import CHECKPOINTS_ENABLED, get_run_app
+
+    started = time.perf_counter()
+    await asyncio.to_thread(preload)
+
+    tasks = [_run_until_ok("db_pool", _open_db_pool)]
+    if RETRIEVAL_BACKEND == "memory":
+        # Load the KB mirrors before the first request instead of on it
+        tasks.append(_run_until_ok("vector_index", lambda: warm_indexes(KB_COLLECTIONS)))
+    else:
+        readiness.set("vector_index", "skipped")
+    if CHECKPOINTS_ENABLED:
+        # Opens the checkpointer (and creates its tables) and compiles the checkpointed graph
+        tasks.append(_run_until_ok("checkpointer", get_run_app))
+    else:
+        readiness.set("checkpointer", "skipped")
+    if USES_APP_DICTIONARY:
+        tasks.append(_run_until_ok("app_dictionary", _refresh_app_dictionary))
+    else:
+        readiness.set("app_dictionary", "skipped")
+    await asyncio.gather(*tasks)
+
+    total = time.perf_counter() - started
+    STARTUP_SECONDS.labels("warm_up").set(total)
+    logger.info(f"Worker warm-up finished in {total:.3f}s")
@@ -1,5 +1,5 @@
 # state.py
-from typing import TypedDict, List, Dict, Any
+from typing import TypedDict, List, Dict, Any, Optional
 
 class WorkflowState(TypedDict):
     """Represents the state of our graph, holding data passed between nodes."""
@@ -10,4 +10,11 @@ class WorkflowState(TypedDict):
     application_list: List[str]
     application_details: str
     final_output: str
-    team_lead_prompt: str
\ No newline at end of file
+    team_lead_prompt: str
+    # Typed counterparts of the text fields above (schemas.py models, dumped to dicts);
+    # None when the node's answer could not be parsed
+    demand_result: Optional[Dict[str, Any]]
+    domain_result: Optional[Dict[str, Any]]
+    application_records: Optional[List[Dict[str, Any]]]
+    # Semantic cache outcome (semantic_cache.py): {"hit": bool, "similarity": ...}; absent when the cache is off
+    semantic_cache: Optional[Dict[str, Any]]
@@ -0,0 +1,109 @@
+# streaming.py
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Optional
+
+from config import REQUEST_DEADLINE_SECONDS
+from checkpoints import get_run_app, new_run_id, run_config, run_kwargs, run_failed, run_finished
+from deadlines import request_deadline
+from semantic_cache import semantic_cache_bypass
+from metrics import GRAPH_RUNS_IN_FLIGHT
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Only the report is streamed token by token; the classifier agents' tokens are
+# intermediate reasoning and arrive as one "node" event when each node finishes
+TOKEN_STREAM_NODES = {"format_output"}
+
+
+async def analysis_events(raw_input: str, cached_state: Optional[dict] = None, bypass_cache: bool = False) -> AsyncIterator[dict]:
+    """
+    Yields progress events for one demand:
+      {"event": "node", "node": <name>, "data": <state update>} as each node completes,
+      {"event": "token", "node": "format_output", "data": <text>} for each report token,
+      {"event": "done", "data": <final state>, "run_id": ...} at the end, or {"event": "error", "run_id": ...}.
+    A failed run's run_id can be resumed like one from /analyze; a run stopped by
+    REQUEST_DEADLINE_SECONDS or a node deadline ends with an error event after
+    the node events of what did complete.
+    A cached_state is replayed as node events instead of running the graph;
+    bypass_cache also keeps the run from reusing a near-duplicate demand's results.
+    """
+    if cached_state is not None:
+        for key, value in cached_state.items():
+            if key != "raw_input":
+                yield {"event": "node", "node": "cache", "data": {key: value}}
+        yield {"event": "done", "cached": True, "data": cached_state}
+        return
+
+    final_state = {"raw_input": raw_input}
+    run_id = new_run_id()
+    with GRAPH_RUNS_IN_FLIGHT.track_inprogress(), request_deadline(REQUEST_DEADLINE_SECONDS), semantic_cache_bypass(bypass_cache):
+        try:
+            app = await get_run_app()
+            async for mode, chunk in app.astream({"raw_input": raw_input}, run_config(run_id),
+                                                 stream_mode=["updates", "messages"], **run_kwargs()):
+                if mode == "updates":
+                    for node_name, update in chunk.items():
+                        if update:
+                            final_state.update(update)
+                        yield {"event": "node", "node": node_name, "data": update}
+                elif mode == "messages":
+                    message, metadata = chunk
+                    node_name = metadata.get("langgraph_node")
+                    if node_name in TOKEN_STREAM_NODES and message.content:
+                        yield {"event": "token", "node": node_name, "data": message.content}
+        except Exception as e:
+            logger.error(f"Error during streamed LangGraph run: {e}", exc_info=True)
+            run_failed(run_id)
+            yield {"event": "error", "error": f"Error during LangGraph invocation: {str(e)}", "run_id": run_id}
+            return
+        except asyncio.CancelledError:
+            run_failed(run_id)
+            raise
+    await run_finished(run_id)
+    yield {"event": "done", "cached": False, "data": final_state, "run_id": run_id}
+
+
+async def with_heartbeat(events: AsyncIterator[dict], interval: float) -> AsyncIterator[Optional[dict]]:
+    """
+    Re-yields events, inserting None whenever nothing arrived for `interval` seconds
+    so the caller can write a keep-alive and proxies don't time the connection out.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put(event)
+        finally:
+            await queue.put(finished)
+
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=interval)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            if event is finished:
+                break
+            yield event
+    finally:
+        # Client went away (or we finished): stop the graph run feeding the queue
+        task.cancel()
+
+
+def encode_sse(event: Optional[dict]) -> str:
+    if event is None:
+        return ": keep-alive\n\n"
+    return f"event: {event['event']}\ndata: {json.dumps(event, default=str)}\n\n"
+
+
+def encode_ndjson(event: Optional[dict]) -> str:
+    if event is None:
+        event = {"event": "ping"}
+    return json.dumps(event, default=str) + "\n"
@@ -1,13 +1,23 @@
 # tools.py
-import psycopg2
-from typing import List, Dict, Union # Import Dict and Union
-from pgvector.psycopg2 import register_vector
-from langchain.tools import Tool
+import functools
+import hashlib
+import json
+import weakref
+import numpy as np
+from psycopg import sql
+from dataclasses import asdict, dataclass, field, fields
+from typing import Any, List, Dict, Optional, Union # Import Dict and Union
 from langchain_core.documents import Document
 from langchain_core.messages import BaseMessage, HumanMessage # Potentially useful if message objects are passed
 
-# Import shared clients and credentials from the config file
-from config import embeddings_model, DB_HOST, DB_NAME, DB_USER, DB_PASSWORD
+# Import shared clients from the config file; connections come from the shared pool
+from config import (
+    get_embeddings_model, RETRIEVAL_BACKEND, KB_RETRIEVERS, KB_TOP_K, KB_INDEX_TYPE, KB_HNSW_M, KB_HNSW_EF_CONSTRUCTION,
+    KB_HNSW_EF_SEARCH, KB_IVFFLAT_PROBES,
+)
+from db import get_pool, get_async_pool
+from vector_index import get_index
+from metrics import retrieval_timer
 
 # Add a logger for this module
 import logging
@@ -15,60 +25,218 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO) # Set to INFO or DEBUG for debugging
 
 
+# Changed the input type hint to Union[str, Dict[str, str], BaseMessage]
+# to handle various ways LLMs/Agents might pass data.
+def _extract_query(input_data: Union[str, Dict[str, str], BaseMessage]) -> str:
+    """Pulls the query string out of whatever the agent passed to the tool."""
+    query_str = ""
+    if isinstance(input_data, str):
+        query_str = input_data
+    elif isinstance(input_data, dict):
+        # Agent often passes the input as a dict with "input" or "query" key
+        query_str = input_data.get("query") or input_data.get("input")
+        if query_str is None:
+            raise ValueError("Dictionary input to tool must contain 'query' or 'input' key.")
+    elif isinstance(input_data, BaseMessage):
+        # If an Agent passes a message object directly
+        query_str = input_data.content
+    else:
+        raise TypeError(f"Unsupported input type for tool: {type(input_data)}. Expected str, dict, or BaseMessage.")
+
+    if not isinstance(query_str, str) or not query_str: # Ensure it's a non-empty string
+        logger.error(f"Invalid or empty query string extracted for embeddings: '{query_str}' (type: {type(query_str)})")
+        raise ValueError("Invalid or empty query string provided to embeddings model.")
+    return query_str
+
+
+KB_COLLECTIONS = ["rules_kb", "app_kb", "domain_kb"]
+
+
+@dataclass(frozen=True)
+class RetrieverConfig:
+    """How one KB collection is searched and indexed (KB_RETRIEVERS overrides the KB_* defaults)."""
+    top_k: int = KB_TOP_K
+    # Hits below this cosine similarity are dropped
+    min_score: Optional[float] = None
+    # Metadata the rows must contain (jsonb @>), e.g. {"Country": "MY"}; pushed into the SQL
+    filters: Dict[str, Any] = field(default_factory=dict)
+    index: str = KB_INDEX_TYPE
+    hnsw_m: int = KB_HNSW_M
+    hnsw_ef_construction: int = KB_HNSW_EF_CONSTRUCTION
+    ivfflat_lists: int = 0 # 0 = rows / 1000 (at least 10), pgvector's rule of thumb
+    ef_search: int = KB_HNSW_EF_SEARCH
+    probes: int = KB_IVFFLAT_PROBES
+    # pgvector >= 0.8: keep scanning the index until enough rows pass the filters ("relaxed_order" or "strict_order")
+    iterative_scan: Optional[str] = None
+
+    def session_settings(self) -> Dict[str, str]:
+        """The planner settings a search of this collection runs with."""
+        settings = {}
+        if self.index == "hnsw" and self.ef_search:
+            # ef_search below k would cap the number of results
+            settings["hnsw.ef_search"] = str(max(self.ef_search, self.top_k))
+        if self.index == "ivfflat" and self.probes:
+            settings["ivfflat.probes"] = str(self.probes)
+        if self.iterative_scan and self.index in ("hnsw", "ivfflat"):
+            settings[f"{self.index}.iterative_scan"] = self.iterative_scan
+        return settings
+
+
+def parse_retriever_configs(retrievers_json: Optional[str]) -> Dict[str, RetrieverConfig]:
+    raw = json.loads(retrievers_json) if retrievers_json else {}
+    known = {f.name for f in fields(RetrieverConfig)}
+    for name, settings in raw.items():
+        unknown = set(settings) - known
+        if unknown:
+            raise ValueError(f"KB_RETRIEVERS['{name}'] has unknown settings {sorted(unknown)}")
+        index = settings.get("index", KB_INDEX_TYPE)
+        if index not in ("hnsw", "ivfflat", "none"):
+            raise ValueError(f"KB_RETRIEVERS['{name}'] has unknown index type '{index}'")
+        iterative_scan = settings.get("iterative_scan")
+        if iterative_scan and iterative_scan not in ("relaxed_order", "strict_order", "off"):
+            raise ValueError(f"KB_RETRIEVERS['{name}'] has unknown iterative_scan '{iterative_scan}'")
+        if iterative_scan and index == "none":
+            raise ValueError(f"KB_RETRIEVERS['{name}'] sets iterative_scan, which needs an hnsw or ivfflat index")
+        if iterative_scan == "strict_order" and index == "ivfflat":
+            raise ValueError(f"KB_RETRIEVERS['{name}'] sets iterative_scan 'strict_order', which ivfflat does not support")
+    return {name: RetrieverConfig(**settings) for name, settings in raw.items()}
+
+
+RETRIEVER_CONFIGS = parse_retriever_configs(KB_RETRIEVERS)
+
+
+def retriever_config(collection_name: str) -> RetrieverConfig:
+    return RETRIEVER_CONFIGS.get(collection_name) or RetrieverConfig()
+
+
+def retrievers_fingerprint() -> str:
+    """Changes whenever a KB collection would be searched differently (result_cache.py keys on it)."""
+    payload = {name: asdict(retriever_config(name)) for name in KB_COLLECTIONS}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _similarity_sql(collection_name: str, filtered: bool = False) -> str:
+    # Ordering by the distance operator itself is what lets the ANN index serve the query
+    where = "WHERE metadata @> %s::jsonb" if filtered else ""
+    return f"""
+        SELECT content, metadata, 1 - (embedding <=> %s::vector) AS similarity_score
+        FROM {collection_name}
+        {where}
+        ORDER BY embedding <=> %s::vector
+        LIMIT %s;
+    """
+
+
+def _similarity_params(query_vector, filters: Dict[str, Any], k: int) -> tuple:
+    if filters:
+        # In the order of the placeholders: score, WHERE, ORDER BY, LIMIT
+        return (query_vector, json.dumps(filters), query_vector, k)
+    return (query_vector, query_vector, k)
+
+
+# Planner settings each pooled connection was last given, so a SET is only sent when they change
+_session_settings: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _settings_sql(conn, settings: Dict[str, str]):
+    current = _session_settings.get(conn, {})
+    statements = [sql.SQL("SET {} = {}").format(sql.SQL(name), sql.Literal(value))
+                  for name, value in settings.items() if current.get(name) != value]
+    # Settings another collection left on this connection go back to the server's value
+    statements += [sql.SQL("RESET {}").format(sql.SQL(name)) for name in current if name not in settings]
+    if not statements:
+        return None
+    # Without parameters the statements go in one round trip
+    return sql.SQL("; ").join(statements), dict(settings)
+
+
+def _apply_settings(conn, settings: Dict[str, str]):
+    pending = _settings_sql(conn, settings)
+    if pending is not None:
+        statement, applied = pending
+        conn.execute(statement)
+        _session_settings[conn] = applied
+
+
+async def _aapply_settings(conn, settings: Dict[str, str]):
+    pending = _settings_sql(conn, settings)
+    if pending is not None:
+        statement, applied = pending
+        await conn.execute(statement)
+        _session_settings[conn] = applied
+
+
+def _rows_to_documents(results, min_score: Optional[float] = None) -> List[Document]:
+    documents = []
+    for row in results:
+        content, metadata, score = row
+        if min_score is not None and score < min_score:
+            continue
+        # Copy: the in-memory index hands out its own metadata dicts
+        doc = Document(page_content=content, metadata=dict(metadata or {}))
+        doc.metadata['score'] = score
+        documents.append(doc)
+    return documents
+
+
+def search_collection(collection_name: str, query_vector, k: Optional[int] = None,
+                      filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+    """
+    Top-k similarity search for an already-embedded query, on the configured backend.
+    k defaults to the collection's top_k; filters add to its configured ones.
+    """
+    config = retriever_config(collection_name)
+    k = k or config.top_k
+    filters = {**config.filters, **(filters or {})}
+    query_vector = np.asarray(query_vector)
+    with retrieval_timer(collection_name, RETRIEVAL_BACKEND):
+        if RETRIEVAL_BACKEND == "memory":
+            return _rows_to_documents(get_index(collection_name).search(query_vector, k=k, filters=filters), config.min_score)
+        # Pooled connections already have the vector type registered
+        with get_pool().connection() as conn:
+            _apply_settings(conn, config.session_settings())
+            with conn.cursor() as cur:
+                # prepare=True makes the server plan the similarity query once per connection
+                cur.execute(_similarity_sql(collection_name, bool(filters)), _similarity_params(query_vector, filters, k), prepare=True)
+                return _rows_to_documents(cur.fetchall(), config.min_score)
+
+
+async def asearch_collection(collection_name: str, query_vector, k: Optional[int] = None,
+                             filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+    config = retriever_config(collection_name)
+    k = k or config.top_k
+    filters = {**config.filters, **(filters or {})}
+    query_vector = np.asarray(query_vector)
+    with retrieval_timer(collection_name, RETRIEVAL_BACKEND):
+        if RETRIEVAL_BACKEND == "memory":
+            # A vectorized top-k over a few thousand rows takes microseconds; no need to leave the loop
+            return _rows_to_documents(get_index(collection_name).search(query_vector, k=k, filters=filters), config.min_score)
+        pool = await get_async_pool()
+        async with pool.connection() as conn:
+            await _aapply_settings(conn, config.session_settings())
+            async with conn.cursor() as cur:
+                await cur.execute(_similarity_sql(collection_name, bool(filters)), _similarity_params(query_vector, filters, k),
+                                  prepare=True)
+                return _rows_to_documents(await cur.fetchall(), config.min_score)
+
+
 def create_raw_sql_retriever(collection_name: str):
     """
     Creates a custom retriever function that executes a raw SQL query
     against a specific table in our PostgreSQL database.
     """
-    # Changed the input type hint to Union[str, Dict[str, str], BaseMessage]
-    # to handle various ways LLMs/Agents might pass data.
     def get_relevant_documents(input_data: Union[str, Dict[str, str], BaseMessage]) -> List[Document]:
         """
         This inner function is the actual retriever. It takes a query,
         embeds it, and runs the raw SQL search.
         """
-        query_str = ""
-        if isinstance(input_data, str):
-            query_str = input_data
-        elif isinstance(input_data, dict):
-            # Agent often passes the input as a dict with "input" or "query" key
-            query_str = input_data.get("query") or input_data.get("input")
-            if query_str is None:
-                raise ValueError("Dictionary input to tool must contain 'query' or 'input' key.")
-        elif isinstance(input_data, BaseMessage):
-            # If an Agent passes a message object directly
-            query_str = input_data.content
-        else:
-            raise TypeError(f"Unsupported input type for tool: {type(input_data)}. Expected str, dict, or BaseMessage.")
-
-        if not isinstance(query_str, str) or not query_str: # Ensure it's a non-empty string
-            logger.error(f"Invalid or empty query string extracted for embeddings: '{query_str}' (type: {type(query_str)})")
-            raise ValueError("Invalid or empty query string provided to embeddings model.")
+        query_str = _extract_query(input_data)
 
         logger.info(f"Embedding query: '{query_str[:100]}...'") # Log the actual string being embedded
-        query_vector = embeddings_model.embed_query(query_str) # Use the extracted string
+        query_vector = np.array(get_embeddings_model().embed_query(query_str)) # Use the extracted string
 
-        conn = None
         try:
-            conn = psycopg2.connect(host=DB_HOST, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD)
-            register_vector(conn)
-            cur = conn.cursor()
-            
-            sql_query = f"""
-                SELECT content, metadata, 1 - (embedding <=> %s::vector) AS similarity_score
-                FROM {collection_name}
-                ORDER BY embedding <=> %s::vector
-                LIMIT 3;
-            """
-            cur.execute(sql_query, (query_vector, query_vector))
-            results = cur.fetchall()
-            
-            documents = []
-            for row in results:
-                content, metadata, score = row
-                doc = Document(page_content=content, metadata=metadata or {})
-                doc.metadata['score'] = score
-                documents.append(doc)
+            documents = search_collection(collection_name, query_vector)
             
             logger.info(f"Custom retriever for '{collection_name}' found {len(documents)} documents for query: '{query_str[:50]}...'")
             return documents
@@ -76,32 +244,60 @@ def create_raw_sql_retriever(collection_name: str):
         except Exception as e:
             logger.error(f"Error in custom retriever for table {collection_name} with query '{query_str[:50]}...': {e}", exc_info=True)
             return []
-        finally:
-            if conn:
-                conn.close()
 
     return get_relevant_documents
 
-# Create tools using the custom retriever
-logger.info("Creating tools with custom raw SQL retrievers...")
 
-rules_retriever_func = create_raw_sql_retriever(collection_name="rules_kb")
-app_retriever_func = create_raw_sql_retriever(collection_name="app_kb")
-domain_retriever_func = create_raw_sql_retriever(collection_name="domain_kb")
+def create_async_raw_sql_retriever(collection_name: str):
+    """
+    Async twin of create_raw_sql_retriever. Embeds with the async embeddings client and
+    queries through the shared async pool, so agent tool calls never block the event loop.
+    """
+    async def aget_relevant_documents(input_data: Union[str, Dict[str, str], BaseMessage]) -> List[Document]:
+        query_str = _extract_query(input_data)
 
-tool_rules_kb = Tool(
-    name="rules_kb",
-    func=rules_retriever_func,
-    description="Use this tool to get knowledge about demand categorization rules. The input should be a descriptive query about the rules."
-)
-tool_application_kb = Tool(
-    name="application_kb",
-    func=app_retriever_func,
-    description="Use this tool to find details about company systems and applications. The input should be a descriptive query."
-)
-tool_domain_kb = Tool(
-    name="domain_kb",
-    func=domain_retriever_func,
-    description="Use this tool to get knowledge about business domain classifications. The input should be a descriptive query."
-)
-logger.info("Successfully created custom tools.")
+        logger.info(f"Embedding query (async): '{query_str[:100]}...'")
+        query_vector = np.array(await get_embeddings_model().aembed_query(query_str))
+
+        try:
+            documents = await asearch_collection(collection_name, query_vector)
+
+            logger.info(f"Async retriever for '{collection_name}' found {len(documents)} documents for query: '{query_str[:50]}...'")
+            return documents
+
+        except Exception as e:
+            logger.error(f"Error in async retriever for table {collection_name} with query '{query_str[:50]}...': {e}", exc_info=True)
+            return []
+
+    return aget_relevant_documents
+
+# Agent tools over the KB collections: tool name -> (collection, description)
+KB_TOOL_SPECS = {
+    "rules_kb": ("rules_kb", "Use this tool to get knowledge about demand categorization rules. The input should be a descriptive query about the rules."),
+    "application_kb": ("app_kb", "Use this tool to find details about company systems and applications. The input should be a descriptive query."),
+    "domain_kb": ("domain_kb", "Use this tool to get knowledge about business domain classifications. The input should be a descriptive query."),
+}
+
+
+@functools.lru_cache(maxsize=None)
+def kb_tool(name: str):
+    """
+    The Tool for one KB collection, created on first use. The sync retriever serves
+    invoke(), the async one ainvoke()/astream().
+    """
+    from langchain.tools import Tool
+    collection_name, description = KB_TOOL_SPECS[name]
+    logger.info(f"Creating tool '{name}' with custom raw SQL retrievers...")
+    return Tool(
+        name=name,
+        func=create_raw_sql_retriever(collection_name=collection_name),
+        coroutine=create_async_raw_sql_retriever(collection_name=collection_name),
+        description=description,
+    )
+
+
+def __getattr__(name: str):
+    # Keeps `tools.tool_rules_kb` / `tool_application_kb` / `tool_domain_kb` working; each is created on first access
+    if name.startswith("tool_") and name[len("tool_"):] in KB_TOOL_SPECS:
+        return kb_tool(name[len("tool_"):])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,224 @@
+# vector_index.py
+import contextlib
+import threading
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import VECTOR_INDEX_REFRESH_SECONDS
+from db import get_pool, table_watermark
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def as_array(value) -> np.ndarray:
+    """A fetched embedding as a float32 array (pgvector >= 0.4 loads vector columns as Vector objects)."""
+    return np.asarray(value.to_numpy() if hasattr(value, "to_numpy") else value, dtype=np.float32)
+
+
+@contextlib.contextmanager
+def _consistent_read(conn):
+    """
+    Runs the block's queries in one REPEATABLE READ snapshot. Otherwise a row
+    committed between the watermark and the fetch would be loaded but not
+    covered by the watermark, and appended a second time by the next refresh.
+    """
+    with conn.transaction():
+        conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        yield
+
+
+class _Snapshot:
+    """Immutable view of a table; queries read one snapshot while a refresh builds the next."""
+
+    def __init__(self, contents: List[str], metadatas: List[dict], matrix: np.ndarray, watermark: Tuple[int, int]):
+        self.contents = contents
+        self.metadatas = metadatas
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        # Row norms are precomputed so a query is one matmul plus a division
+        self.norms = np.linalg.norm(self.matrix, axis=1) if len(contents) else np.zeros(0, dtype=np.float32)
+        self.watermark = watermark
+
+
+class InMemoryVectorIndex:
+    """
+    In-process mirror of one pgvector KB table (content, metadata, embedding).
+
+    search() reproduces `ORDER BY embedding <=> q LIMIT k` and its
+    `1 - (embedding <=> q)` score: cosine similarity on the same float32
+    values pgvector stores, clamped to [-1, 1] like pgvector does. Rows with a
+    NULL embedding are skipped, as pgvector sorts them after every real match.
+    """
+
+    def __init__(self, collection_name: str):
+        self.collection_name = collection_name
+        self._snapshot: Optional[_Snapshot] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_rows(cls, collection_name: str, rows: List[Tuple[str, dict, List[float]]]) -> "InMemoryVectorIndex":
+        """Builds an index from (content, metadata, embedding) rows without touching the database."""
+        index = cls(collection_name)
+        contents = [r[0] for r in rows]
+        metadatas = [r[1] or {} for r in rows]
+        matrix = np.array([r[2] for r in rows], dtype=np.float32).reshape(len(rows), -1)
+        index._snapshot = _Snapshot(contents, metadatas, matrix, (len(rows), 0))
+        return index
+
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not None
+
+    def __len__(self):
+        return len(self._snapshot.contents) if self._snapshot else 0
+
+    def _fetch(self, conn, since_xmin: int = 0):
+        with conn.cursor() as cur:
+            cur.execute(
+                f"""SELECT content, metadata, embedding FROM {self.collection_name}
+                    WHERE embedding IS NOT NULL AND xmin::text::bigint > %s""",
+                (since_xmin,),
+            )
+            rows = cur.fetchall()
+        contents = [r[0] for r in rows]
+        metadatas = [r[1] or {} for r in rows]
+        if rows:
+            matrix = np.array([as_array(r[2]) for r in rows], dtype=np.float32)
+        else:
+            dims = self._snapshot.matrix.shape[1] if self._snapshot is not None else 0
+            matrix = np.zeros((0, dims), dtype=np.float32)
+        return contents, metadatas, matrix
+
+    def load(self):
+        """Full (re)load of the table."""
+        with get_pool().connection() as conn, _consistent_read(conn):
+            # One snapshot for both, so the watermark covers exactly the rows loaded
+            watermark = table_watermark(conn, self.collection_name)
+            contents, metadatas, matrix = self._fetch(conn)
+        with self._lock:
+            self._snapshot = _Snapshot(contents, metadatas, matrix, watermark)
+        logger.info(f"Loaded {len(contents)} rows from '{self.collection_name}' into the in-memory index")
+
+    def refresh(self) -> bool:
+        """
+        Reloads only if the table changed. Pure inserts are appended incrementally;
+        anything else (updates, deletes) triggers a full reload. Returns True if the index changed.
+        """
+        if self._snapshot is None:
+            self.load()
+            return True
+        current = self._snapshot
+        with get_pool().connection() as conn, _consistent_read(conn):
+            watermark = table_watermark(conn, self.collection_name)
+            if watermark == current.watermark:
+                return False
+            old_count, old_xmin = current.watermark
+            contents, metadatas, matrix = self._fetch(conn, since_xmin=old_xmin)
+        if watermark[0] == old_count + len(contents):
+            # Row count grew by exactly the number of new tuples: inserts only
+            new_matrix = np.vstack([current.matrix, matrix]) if len(current.contents) else matrix
+            snapshot = _Snapshot(current.contents + contents, current.metadatas + metadatas, new_matrix, watermark)
+            with self._lock:
+                self._snapshot = snapshot
+            logger.info(f"Appended {len(contents)} new rows to the in-memory index for '{self.collection_name}'")
+        else:
+            self.load()
+        return True
+
+    def search(self, query_vector, k: int = 3, filters: Optional[dict] = None) -> List[Tuple[str, dict, float]]:
+        """
+        Top-k rows by cosine similarity, best first, as (content, metadata, score).
+        With filters, only rows whose metadata contains all of them are ranked (like jsonb @>).
+        """
+        snapshot = self._snapshot
+        if snapshot is None or not snapshot.contents:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        denominators = snapshot.norms * np.linalg.norm(query)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = (snapshot.matrix @ query).astype(np.float64) / denominators
+        # pgvector returns NaN distance for zero vectors; push them to the end
+        scores = np.clip(np.nan_to_num(scores, nan=-np.inf), -1.0, 1.0)
+        if filters:
+            candidates = np.flatnonzero([_contains(m, filters) for m in snapshot.metadatas])
+            if not len(candidates):
+                return []
+        else:
+            candidates = np.arange(len(scores))
+        k = min(k, len(candidates))
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(snapshot.contents[i], snapshot.metadatas[i], float(scores[i])) for i in top]
+
+
+def _contains(metadata: dict, filters: dict) -> bool:
+    """jsonb containment (metadata @> filters) for the flat filters retrievers use; a list matches any member."""
+    for key, wanted in filters.items():
+        value = metadata.get(key)
+        if value != wanted and not (isinstance(value, list) and wanted in value):
+            return False
+    return True
+
+
+_indexes: Dict[str, InMemoryVectorIndex] = {}
+_indexes_lock = threading.Lock()
+_refresher: Optional[threading.Thread] = None
+
+
+def get_index(collection_name: str) -> InMemoryVectorIndex:
+    """Returns the process-wide index for a collection, loading it on first use."""
+    index = _indexes.get(collection_name)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(collection_name)
+            if index is None:
+                index = InMemoryVectorIndex(collection_name)
+                index.load()
+                _indexes[collection_name] = index
+    return index
+
+
+def register_index(index: InMemoryVectorIndex):
+    """Installs a pre-built index (e.g. from InMemoryVectorIndex.from_rows) for a collection."""
+    with _indexes_lock:
+        _indexes[index.collection_name] = index
+
+
+_stop_refresher = threading.Event()
+
+
+def _refresh_loop(stop: threading.Event):
+    while not stop.wait(VECTOR_INDEX_REFRESH_SECONDS):
+        for index in list(_indexes.values()):
+            try:
+                index.refresh()
+            except Exception as e:
+                # Keep serving the previous snapshot; the next tick retries
+                logger.error(f"Refreshing in-memory index for '{index.collection_name}' failed: {e}", exc_info=True)
+
+
+def start_refresher():
+    """Starts the background thread that polls the table watermarks (once per process)."""
+    global _refresher
+    if _refresher is None and VECTOR_INDEX_REFRESH_SECONDS > 0:
+        _refresher = threading.Thread(target=_refresh_loop, args=(_stop_refresher,), name="vector-index-refresh", daemon=True)
+        _refresher.start()
+
+
+def stop_refresher():
+    global _refresher
+    _stop_refresher.set()
+    _refresher = None
+
+
+def warm_indexes(collection_names: List[str]):
+    for name in collection_names:
+        get_index(name)
+    start_refresher()
+
+
+def index_stats() -> dict:
+    return {name: {"rows": len(index), "watermark": index._snapshot.watermark if index.loaded else None}
+            for name, index in _indexes.items()}